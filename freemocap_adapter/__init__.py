@@ -30,8 +30,10 @@ from .addon_interface import (FMC_ADAPTER_PROPERTIES,
                               FMC_ADAPTER_OT_add_rig,
                               FMC_ADAPTER_OT_add_body_mesh,
                               FMC_ADAPTER_OT_export_fbx,
+                              FMC_ADAPTER_OT_export_animation_columns,
                               FMC_ADAPTER_OT_retarget_animation,
 )
+from .core_functions import invalidate_empty_positions_handler
 
 classes = [AdjustEmptiesProperties,
            ReduceBoneLengthDispersionProperties,
@@ -52,6 +54,7 @@ classes = [AdjustEmptiesProperties,
            FMC_ADAPTER_OT_add_rig,
            FMC_ADAPTER_OT_add_body_mesh,
            FMC_ADAPTER_OT_export_fbx,
+           FMC_ADAPTER_OT_export_animation_columns,
            FMC_ADAPTER_OT_retarget_animation,
 ]
 
@@ -65,6 +68,10 @@ def register():
 
     bpy.types.Scene.fmc_adapter_tool = bpy.props.PointerProperty(type = FMC_ADAPTER_PROPERTIES)
 
+    # Invalidate the stored empty positions when the scene data is replaced
+    for handlers in (bpy.app.handlers.load_post, bpy.app.handlers.undo_post, bpy.app.handlers.redo_post):
+        handlers.append(invalidate_empty_positions_handler)
+
 def unregister():
     """
     Function to unregister classes and delete an attribute
@@ -73,6 +80,10 @@ def unregister():
     for cls in classes:
         bpy.utils.unregister_class(cls)
 
+    for handlers in (bpy.app.handlers.load_post, bpy.app.handlers.undo_post, bpy.app.handlers.redo_post):
+        if invalidate_empty_positions_handler in handlers:
+            handlers.remove(invalidate_empty_positions_handler)
+
     del bpy.types.Scene.fmc_adapter_tool
 
 # Register the Add-on
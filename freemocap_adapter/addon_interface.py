@@ -57,6 +57,7 @@ from .data_definitions.interface.panels.retarget_animation_panel import (
     draw_retarget_animation_panel
 )
 from .core_functions import (
+    invalidate_empty_positions,
     adjust_empties,
     reduce_bone_length_dispersion,
     add_rig,
@@ -65,6 +66,7 @@ from .core_functions import (
     apply_foot_locking,
     apply_butterworth_filters,
     export_fbx,
+    export_animation_columns,
     retarget_animation,
 )
 scipy_available = True
@@ -168,6 +170,9 @@ class FMC_ADAPTER_OT_reduce_bone_length_dispersion(Operator):
         start = time.time()
         print('Executing Reduce Bone Length Dispersion...')
 
+        # Read all the empty positions again in case they were edited
+        invalidate_empty_positions()
+
         reduce_bone_length_dispersion(
             interval_variable=fmc_adapter_tool.reduce_bone_length_dispersion_properties.interval_variable,
             interval_factor=fmc_adapter_tool.reduce_bone_length_dispersion_properties.interval_factor,
@@ -196,6 +201,9 @@ class FMC_ADAPTER_OT_apply_butterworth_filters(Operator):
 
         print('Executing Apply Butterworth Filters...')
 
+        # Read all the empty positions again in case they were edited
+        invalidate_empty_positions()
+
         # Create the global and local filter categories lists
         global_filter_categories=[]
         if fmc_adapter_tool.apply_butterworth_filters_properties.apply_global_filter_core:
@@ -276,7 +284,7 @@ class FMC_ADAPTER_OT_apply_butterworth_filters(Operator):
                 local_filter_origins['feet'] = fmc_adapter_tool.apply_butterworth_filters_properties.local_filter_origin_feet
 
         # Execute export fbx function
-        apply_butterworth_filters(
+        skipped_categories = apply_butterworth_filters(
             global_filter_categories=global_filter_categories,
             global_cutoff_frequencies=global_cutoff_frequencies,
             local_filter_categories=local_filter_categories,
@@ -287,6 +295,12 @@ class FMC_ADAPTER_OT_apply_butterworth_filters(Operator):
             body_height=fmc_adapter_tool.reduce_bone_length_dispersion_properties.body_height
         )
 
+        if skipped_categories:
+            self.report(
+                {'WARNING'},
+                'Cutoff frequency not below half the scene frame rate. '
+                + 'Skipped filters: ' + ', '.join(skipped_categories))
+
         # Get end time and print execution time
         end = time.time()
         print('Finished. Execution time (s): ' + str(m.trunc((end - start)*1000)/1000))
@@ -309,6 +323,9 @@ class FMC_ADAPTER_OT_add_finger_rotation_limits(Operator):
 
         print('Executing Add Finger Rotation Limits...')
 
+        # Read all the empty positions again in case they were edited
+        invalidate_empty_positions()
+
         # Execute export fbx function
         add_finger_rotation_limits()
 
@@ -473,8 +490,15 @@ class FMC_ADAPTER_OT_export_fbx(Operator):
         print('Executing Export FBX...')
 
         # Execute export fbx function
-        export_fbx(self,
-                   fbx_type=fmc_adapter_tool.export_fbx_properties.fbx_type)
+        error_message = export_fbx(self,
+                                   fbx_type=fmc_adapter_tool.export_fbx_properties.fbx_type,
+                                   takes_source=fmc_adapter_tool.export_fbx_properties.takes_source,
+                                   frame_ranges=fmc_adapter_tool.export_fbx_properties.frame_ranges,
+                                   takes_output=fmc_adapter_tool.export_fbx_properties.takes_output)
+
+        if error_message is not None:
+            self.report({'ERROR'}, 'FBX export cancelled: ' + error_message)
+            return {'CANCELLED'}
 
         # Get end time and print execution time
         end = time.time()
@@ -483,6 +507,33 @@ class FMC_ADAPTER_OT_export_fbx(Operator):
 
         return {'FINISHED'}
     
+class FMC_ADAPTER_OT_export_animation_columns(Operator):
+    bl_idname = 'fmc_adapter.export_animation_columns'
+    bl_label = 'Freemocap Adapter - Export Animation Columns'
+    bl_description = 'Exports the rig animation as a columnar binary file with the bone table and the local quaternion and translation arrays'
+    bl_options = {'REGISTER', 'UNDO_GROUPED'}
+
+    def execute(self, context):
+
+        scene = context.scene
+        fmc_adapter_tool = scene.fmc_adapter_tool
+
+        # Get start time
+        start = time.time()
+
+        print('Executing Export Animation Columns...')
+
+        # Execute export animation columns function
+        export_animation_columns(
+            compress=fmc_adapter_tool.export_fbx_properties.compress_animation_columns)
+
+        # Get end time and print execution time
+        end = time.time()
+        print('Finished. Execution time (s): '
+              + str(m.trunc((end - start)*1000)/1000))
+
+        return {'FINISHED'}
+
 class FMC_ADAPTER_OT_retarget_animation(Operator):
     bl_idname = 'fmc_adapter.retarget_animation'
     bl_label = 'Freemocap Adapter - Retarget Animation'
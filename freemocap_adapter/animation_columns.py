@@ -0,0 +1,135 @@
+"""
+Columnar binary file of a baked armature animation: the bone table and
+the per bone local transforms of every frame as contiguous float32 arrays.
+The module only needs NumPy, so the files can be read outside Blender.
+
+File layout (little endian):
+    * 8 bytes: MAGIC
+    * 8 bytes: length of the JSON header
+    * JSON header: the bone names, fps, first frame, compression and the
+      dtype, shape, offset and stored size of each array
+    * The arrays, each one starting at a multiple of ALIGNMENT bytes from
+      the start of the file
+
+Without compression the arrays are read as memory-mapped views of the
+file, without copying them. With compression each array is stored
+byte-shuffled and zlib compressed, and it is decompressed on reading.
+"""
+import json
+import zlib
+import numpy as np
+
+
+# Identifier and version of the file format
+MAGIC = b'FMCANIM1'
+
+# Alignment in bytes of the arrays in the file
+ALIGNMENT = 64
+
+# Compression level of the compressed arrays
+COMPRESSION_LEVEL = 1
+
+# Function to get the first multiple of ALIGNMENT at or after an offset
+def get_aligned_offset(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+# Function to get the stored bytes of a compressed array. The bytes of
+# each position of the items are grouped before compressing, as the float
+# exponent bytes compress much better together
+def compress_array(array: np.ndarray) -> bytes:
+    shuffled = np.ascontiguousarray(array).view(np.uint8).reshape(-1, array.dtype.itemsize).T
+
+    return zlib.compress(np.ascontiguousarray(shuffled).data, COMPRESSION_LEVEL)
+
+# Function to get an array from its compressed stored bytes
+def decompress_array(data, dtype: np.dtype, shape: tuple) -> np.ndarray:
+    dtype = np.dtype(dtype)
+    shuffled = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(dtype.itemsize, -1)
+
+    return np.ascontiguousarray(shuffled.T).view(dtype).reshape(shape)
+
+# Function to write an animation columns file. The arrays dictionary
+# contains the arrays of the animation, like the (n_bones,) parents,
+# the (n_frames, n_bones, 4) quaternions and the (n_frames, n_bones, 3)
+# translations
+def write_animation_columns(filepath,
+                            bone_names: list,
+                            frame_start: int,
+                            fps: float,
+                            arrays: dict,
+                            compress: bool=False) -> None:
+
+    # Stored bytes of each array and its description in the header
+    stored_arrays = []
+    arrays_header = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        data = compress_array(array) if compress else array.data
+
+        arrays_header[name] = {'dtype': array.dtype.str,
+                               'shape': list(array.shape),
+                               'offset': offset,
+                               'size': data.nbytes if isinstance(data, memoryview) else len(data)}
+        stored_arrays.append(data)
+        offset = get_aligned_offset(offset + arrays_header[name]['size'])
+
+    header = json.dumps({'bones': list(bone_names),
+                         'frame_start': int(frame_start),
+                         'fps': float(fps),
+                         'compression': 'zlib' if compress else None,
+                         'arrays': arrays_header}).encode('utf-8')
+
+    # The array offsets in the header are relative to the data start
+    data_start = get_aligned_offset(len(MAGIC) + 8 + len(header))
+
+    with open(filepath, 'wb') as file:
+        file.write(MAGIC)
+        file.write(len(header).to_bytes(8, 'little'))
+        file.write(header)
+
+        for array_header, data in zip(arrays_header.values(), stored_arrays):
+            file.write(bytes(data_start + array_header['offset'] - file.tell()))
+            file.write(data)
+
+# Function to read an animation columns file. Returns a dictionary with
+# the bones, frame_start and fps of the header and the arrays of the file.
+# The arrays of an uncompressed file are read-only views of a memory map
+def read_animation_columns(filepath) -> dict:
+    with open(filepath, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not an animation columns file: ' + str(filepath))
+
+        header_length = int.from_bytes(file.read(8), 'little')
+        header = json.loads(file.read(header_length).decode('utf-8'))
+
+        data_start = get_aligned_offset(len(MAGIC) + 8 + header_length)
+
+        compressed = header['compression'] is not None
+        if compressed:
+            file.seek(data_start)
+            data = file.read()
+
+    # Map the data of the arrays (empty files can't be mapped)
+    if not compressed:
+        data_size = sum(array_header['size'] for array_header in header['arrays'].values())
+        if data_size == 0:
+            data = np.empty(0, dtype=np.uint8)
+        else:
+            data = np.memmap(filepath, dtype=np.uint8, mode='r', offset=data_start)
+
+    animation = {'bones': header['bones'],
+                 'frame_start': header['frame_start'],
+                 'fps': header['fps']}
+
+    for name, array_header in header['arrays'].items():
+        start = array_header['offset']
+        end = start + array_header['size']
+        shape = tuple(array_header['shape'])
+
+        if compressed:
+            animation[name] = decompress_array(data[start:end], array_header['dtype'], shape)
+        else:
+            animation[name] = data[start:end].view(np.dtype(array_header['dtype'])).reshape(shape)
+
+    return animation
@@ -1,7 +1,7 @@
 import bpy
 from bpy.types import Operator
+from bpy.app.handlers import persistent
 import math as m
-import statistics
 import mathutils
 import numpy as np
 import os
@@ -9,13 +9,40 @@ from pathlib import Path
 from importlib.machinery import SourceFileLoader
 import addon_utils
 
-scipy_available = True
-try:
-    from scipy.signal import butter, filtfilt
-    from scipy.optimize import minimize
-except ImportError:
-    scipy_available = False
-    print("scipy is not installed. Please install scipy to use this addon.")
+from .marker_positions import (
+    MarkerPositions,
+    calculate_length_statistics,
+)
+from .fcurve_functions import (
+    read_local_positions,
+    read_world_positions,
+    write_local_positions,
+    write_fcurve_keyframes,
+    translate_local_positions,
+    get_local_to_world_matrix,
+    local_to_world_positions,
+)
+from .empties_hierarchy import EmptiesHierarchy
+from .rig_baking import (
+    bake_rig,
+    decompose_matrices,
+    get_offset_matrix,
+    get_ordered_pose_bones,
+    matrices_to_quaternions,
+)
+from .retargeting import (
+    BoneMapResolver,
+    get_corrected_source_pose,
+    read_source_pose,
+    retarget_rig,
+)
+from .animation_columns import write_animation_columns
+from .fbx_takes import export_fbx_takes, get_rig_takes
+from .filter_functions import (
+    get_butterworth_sos,
+    filter_channels,
+    apply_butterworth_to_fcurves,
+)
 
 from .data_definitions.anthropomorphic_dimensions import (
     anthropomorphic_dimensions)
@@ -61,12 +88,27 @@ adjust_empties_executed = False
 origin_location_pre_reset = (0, 0, 0)
 origin_rotation_pre_reset = (0, 0, 0)
 
-# Dictionary to save the global vector position of all the empties for every animation frame
-empty_positions = {}
+# Array store with the global vector position of all the empties for every
+# animation frame. It keeps the empty_positions[empty]['x'][frame] access
+empty_positions = MarkerPositions()
+
+# Flattened index of the empties hierarchy with the subtree of each empty,
+# its cached location fcurves and its rows in the empty positions store
+empties_hierarchy = EmptiesHierarchy(empties_dict, empty_positions)
+
+# Cache of the bone_name_map armature and bone rolls of each retargeting
+# armature
+bone_map_resolver = BoneMapResolver(bone_name_map)
 
 # Dictionary to save the speed of all the empties for every animation frame
 empty_speeds = {}
 
+# Function to get the names of the marker empties of the scene
+def get_marker_empties() -> list:
+    return [object.name for object in bpy.data.objects if object.type == 'EMPTY' and
+                                                          '_origin' not in object.name and
+                                                          object.name not in ('empties_parent', 'center_of_mass_data_parent', 'center_of_mass', 'rigid_body_meshes_parent', 'videos_parent')]
+
 # Function to update all the empties positions in the dictionary
 def update_empty_positions(target_empty: str='',
                            position_reference: str='local') -> None:
@@ -80,136 +122,201 @@ def update_empty_positions(target_empty: str='',
     if len(bpy.context.selected_objects) != 0:
         bpy.ops.object.mode_set(mode="OBJECT")
 
+    # Number of frames saved in the positions store
+    n_frames = scene.frame_end - scene.frame_start
+
     # Check if the target_empty is defined to avoid iterating through all the empties
     if target_empty != '':
-        # Check if the target_empty variable is a list instead of a single value (a list will mean a bone head and tail pair)
-        if isinstance(target_empty, list):
-            #  Reset the empty positions
-            empty_positions[target_empty[0]] = {'x': [], 'y': [], 'z': []}
-            empty_positions[target_empty[1]] = {'x': [], 'y': [], 'z': []}
-
-            # Iterate through each scene frame and save the coordinates of the
-            # empties in the dictionary. Separate between local and global
-            # position reference
-            if position_reference == 'local':
-                for frame in range (scene.frame_start, scene.frame_end):
-                    # Set scene frame
-                    scene.frame_set(frame)
-                    # Save the x, y, z position of the empties
-                    empty_positions[target_empty[0]]['x'].append(bpy.data.objects[target_empty[0]].location[0])
-                    empty_positions[target_empty[0]]['y'].append(bpy.data.objects[target_empty[0]].location[1])
-                    empty_positions[target_empty[0]]['z'].append(bpy.data.objects[target_empty[0]].location[2])
-                    empty_positions[target_empty[1]]['x'].append(bpy.data.objects[target_empty[1]].location[0])
-                    empty_positions[target_empty[1]]['y'].append(bpy.data.objects[target_empty[1]].location[1])
-                    empty_positions[target_empty[1]]['z'].append(bpy.data.objects[target_empty[1]].location[2])
+        # A list will mean a bone head and tail pair
+        target_empties = target_empty if isinstance(target_empty, list) else [target_empty]
+        # A single target empty has always been read in local reference
+        if not isinstance(target_empty, list):
+            position_reference = 'local'
 
-            elif position_reference == 'global':
-                for frame in range (scene.frame_start, scene.frame_end):
-                    # Set scene frame
-                    scene.frame_set(frame)
-                    # Save the x, y, z position of the empties
-                    empty_positions[target_empty[0]]['x'].append(bpy.data.objects[target_empty[0]].matrix_world.to_translation()[0])
-                    empty_positions[target_empty[0]]['y'].append(bpy.data.objects[target_empty[0]].matrix_world.to_translation()[1])
-                    empty_positions[target_empty[0]]['z'].append(bpy.data.objects[target_empty[0]].matrix_world.to_translation()[2])
-                    empty_positions[target_empty[1]]['x'].append(bpy.data.objects[target_empty[1]].matrix_world.to_translation()[0])
-                    empty_positions[target_empty[1]]['y'].append(bpy.data.objects[target_empty[1]].matrix_world.to_translation()[1])
-                    empty_positions[target_empty[1]]['z'].append(bpy.data.objects[target_empty[1]].matrix_world.to_translation()[2])
-
-        else:
-            #  Reset the empty positions
-            empty_positions[target_empty] = {'x': [], 'y': [], 'z': []}
-
-            # Iterate through each scene frame and save the coordinates of the empty in the dictionary.
-            for frame in range (scene.frame_start, scene.frame_end):
-                # Set scene frame
-                scene.frame_set(frame)
-                # Save the x, y, z position of the empty
-                empty_positions[target_empty]['x'].append(bpy.data.objects[target_empty].location[0])
-                empty_positions[target_empty]['y'].append(bpy.data.objects[target_empty].location[1])
-                empty_positions[target_empty]['z'].append(bpy.data.objects[target_empty].location[2])
+        # If the number of scene frames changed all the stored positions
+        # are stale, so the store is reset before adding the target empties
+        if empty_positions.n_frames != n_frames:
+            empty_positions.reset([], n_frames)
+            empty_positions.invalidate()
+
+        # Add the target empties to the store if they are not in it yet
+        empty_positions.add_markers(target_empties, n_frames)
+
+        # The stored positions would mix position references
+        if position_reference != empty_positions.reference:
+            empty_positions.invalidate()
+
+        # The target empties will be up to date
+        for empty in target_empties:
+            empty_positions.changed.pop(empty, None)
 
     else:
         # Create a list with only the names of the marker empties
-        marker_empties = [object.name for object in bpy.data.objects if object.type == 'EMPTY' and
-                                                                        '_origin' not in object.name and
-                                                                        object.name not in ('empties_parent', 'center_of_mass_data_parent', 'center_of_mass', 'rigid_body_meshes_parent', 'videos_parent')]
+        target_empties = get_marker_empties()
+
+        # Reset the empty positions store with a row for each empty
+        empty_positions.reset(target_empties, n_frames)
+        empty_positions.invalidate()
+        empty_positions.reference = position_reference
+
+    # Empties whose positions need the scene frame stepping
+    frame_stepping_empties = []
+
+    frames = np.arange(scene.frame_start, scene.frame_end)
+
+    if position_reference == 'local':
+        # Read the baked local positions directly from the empties actions
+        for empty in target_empties:
+            positions = read_local_positions(bpy.data.objects[empty], frames)
+            if positions is None:
+                frame_stepping_empties.append(empty)
+            else:
+                empty_positions.set_positions(empty, positions)
+
+    elif position_reference == 'global':
+        # Compose the baked local positions with the static parent chain
+        # (usually the empties_parent) of each empty
+        world_empties = []
+        local_positions = []
+        local_to_world_matrices = []
+        for empty in target_empties:
+            matrix = get_local_to_world_matrix(bpy.data.objects[empty])
+            positions = None
+            if matrix is not None:
+                positions = read_local_positions(bpy.data.objects[empty], frames)
+            if positions is None:
+                frame_stepping_empties.append(empty)
+            else:
+                world_empties.append(empty)
+                local_positions.append(positions)
+                local_to_world_matrices.append(matrix)
 
-        # Reset the empty positions dictionary with empty arrays for each empty
-        for empty in marker_empties:
-            empty_positions[empty] = {'x': [], 'y': [], 'z': []}
+        if len(world_empties) != 0:
+            world_positions = local_to_world_positions(np.stack(local_positions),
+                                                       np.stack(local_to_world_matrices))
+            empty_positions.data[empty_positions.rows(world_empties)] = world_positions
+
+    if len(frame_stepping_empties) != 0:
+        # Get the rows of the frame stepping empties in the store
+        rows = empty_positions.rows(frame_stepping_empties)
+        target_objects = [bpy.data.objects[empty] for empty in frame_stepping_empties]
 
         # Iterate through each scene frame and save the coordinates of each
-        # empty in the dictionary. Separate between local and global
+        # empty in the store. Separate between local and global
         # position reference
-        if position_reference == 'local':
-            for frame in range (scene.frame_start, scene.frame_end):
-                # Set scene frame
-                scene.frame_set(frame)
-                # Iterate through each empty
-                for empty in marker_empties:
-                    # Save the x, y, z position of the empty
-                    empty_positions[empty]['x'].append(bpy.data.objects[empty].location[0])
-                    empty_positions[empty]['y'].append(bpy.data.objects[empty].location[1])
-                    empty_positions[empty]['z'].append(bpy.data.objects[empty].location[2])
-        
-        elif position_reference == 'global':
-            for frame in range (scene.frame_start, scene.frame_end):
-                # Set scene frame
-                scene.frame_set(frame)
-                # Iterate through each empty
-                for empty in marker_empties:
-                    # Save the x, y, z position of the empty
-                    empty_positions[empty]['x'].append(bpy.data.objects[empty].matrix_world.to_translation()[0])
-                    empty_positions[empty]['y'].append(bpy.data.objects[empty].matrix_world.to_translation()[1])
-                    empty_positions[empty]['z'].append(bpy.data.objects[empty].matrix_world.to_translation()[2])
+        for frame_index, frame in enumerate(range(scene.frame_start, scene.frame_end)):
+            # Set scene frame
+            scene.frame_set(frame)
+            # Save the x, y, z position of the empties
+            if position_reference == 'local':
+                empty_positions.data[rows, frame_index] = [tuple(object.location) for object in target_objects]
+            elif position_reference == 'global':
+                empty_positions.data[rows, frame_index] = [tuple(object.matrix_world.translation) for object in target_objects]
 
-    # Reset the scene frame to the start
-    scene.frame_set(scene.frame_start)
+        # Reset the scene frame to the start
+        scene.frame_set(scene.frame_start)
 
     print('Empty Positions Dictionary update completed.')
 
+# Function to force a complete update of the empty positions on the next
+# refresh. Used when the empties animation could have been changed outside
+# the adapter methods
+def invalidate_empty_positions() -> None:
+    empty_positions.invalidate()
+    empties_hierarchy.invalidate()
+
+# Handler to invalidate the empty positions after an undo, a redo or a
+# file load, as the stored positions and rows could refer to other data
+@persistent
+def invalidate_empty_positions_handler(*args) -> None:
+    invalidate_empty_positions()
+
+# Function to update only the positions of the empties changed since the
+# last update. Returns a dictionary with the changed empties and their
+# changed frame indices interval, or None if all the positions were updated
+def refresh_empty_positions(position_reference: str='local') -> dict:
+
+    # Get the scene context
+    scene = bpy.context.scene
+
+    # Update all the positions if the store is not valid for the reference
+    if (empty_positions.reference != position_reference
+            or empty_positions.n_frames != scene.frame_end - scene.frame_start):
+        update_empty_positions(position_reference=position_reference)
+        return None
+
+    changed = empty_positions.pop_changed()
+    if len(changed) == 0:
+        return changed
+
+    # Update the changed empties
+    update_empty_positions(target_empty=list(changed),
+                           position_reference=position_reference)
+
+    # Convert the changed scene frame numbers to store frame indices
+    last_index = empty_positions.n_frames - 1
+    return {empty: (min(max(first - scene.frame_start, 0), last_index),
+                    min(max(last - scene.frame_start, 0), last_index))
+            for empty, (first, last) in changed.items()}
+
+# Array with the length of every virtual bone (rows in the virtual_bones
+# order) for every frame. The lengths of each bone in the virtual_bones
+# dictionary are views of its row
+virtual_bones_lengths = np.empty((0, 0), dtype=np.float64)
+
+# Row of each virtual bone in the virtual bones lengths array
+virtual_bones_rows = {bone: row for row, bone in enumerate(virtual_bones)}
+
+# Function to get the virtual bones lengths array with a column for each
+# frame of the empty positions store
+def get_virtual_bones_lengths() -> np.ndarray:
+    global virtual_bones_lengths
+
+    if virtual_bones_lengths.shape != (len(virtual_bones), empty_positions.n_frames):
+        virtual_bones_lengths = np.full((len(virtual_bones), empty_positions.n_frames), np.nan)
+        for row, bone in enumerate(virtual_bones):
+            virtual_bones[bone]['lengths'] = virtual_bones_lengths[row]
+
+    return virtual_bones_lengths
+
+# Function to update the lengths and the length median and stdev values of a
+# list of virtual bones, only on the frames indices interval if defined
+def update_virtual_bones_lengths(bones: list,
+                                 first_index: int=0,
+                                 last_index: int=None) -> None:
+
+    lengths = get_virtual_bones_lengths()
+    rows = np.array([virtual_bones_rows[bone] for bone in bones], dtype=np.intp)
+
+    if last_index is None:
+        last_index = empty_positions.n_frames - 1
+
+    # Calculate the lengths of all the bones with a single norm over the
+    # gathered head and tail positions
+    heads = empty_positions.rows([virtual_bones[bone]['head'] for bone in bones])
+    tails = empty_positions.rows([virtual_bones[bone]['tail'] for bone in bones])
+    frames = slice(first_index, last_index + 1)
+    lengths[rows, frames] = np.linalg.norm(empty_positions.data[tails, frames]
+                                           - empty_positions.data[heads, frames],
+                                           axis=2)
+
+    # Update the length median and stdev values of the bones
+    medians, stdevs = calculate_length_statistics(lengths[rows])
+    for bone, median, stdev in zip(bones, medians, stdevs):
+        virtual_bones[bone]['median'] = float(median)
+        virtual_bones[bone]['stdev'] = float(stdev)
+
 # Function to update all the information of the virtual bones dictionary (lengths, median and stdev)
 def update_virtual_bones_info(target_bone: str=''):
 
     # Check if the target bone is defined to only update and print what it is necessary
     if target_bone != '':
         print('Updating Virtual Bone: ' + target_bone)
-        # Reset the lengths list of the target virtual bone
-        virtual_bones[target_bone]['lengths'] = []
-
-        # Iterate through the empty_positions dictionary and calculate the distance between the head and tail and append it to the lengths list
-        for frame in range (0, len(empty_positions[virtual_bones[target_bone]['tail']]['x'])):
-            # Calculate the length of the bone for this frame
-            head        = virtual_bones[target_bone]['head']
-            tail        = virtual_bones[target_bone]['tail']
-            head_pos    = (empty_positions[head]['x'][frame], empty_positions[head]['y'][frame], empty_positions[head]['z'][frame])
-            tail_pos    = (empty_positions[tail]['x'][frame], empty_positions[tail]['y'][frame], empty_positions[tail]['z'][frame])
-
-            virtual_bones[target_bone]['lengths'].append(m.dist(head_pos, tail_pos))
-
-        # Update the length median and stdev values of the target bone
-        # Exclude posible length NaN (produced by an empty with NaN values as position) values from the median and standard deviation
-        try:
-            virtual_bones[target_bone]['median'] = statistics.median([length for length in virtual_bones[target_bone]['lengths'] if not m.isnan(length)])
-        except:
-            virtual_bones[target_bone]['median'] = m.nan
-
-        # If the median is nan (every length values was nan) then directly set the stdev as nan to avoid a calculus error
-        if m.isnan(virtual_bones[target_bone]['median']):
-            virtual_bones[target_bone]['stdev'] = m.nan
-        else:
-            try:
-                virtual_bones[target_bone]['stdev'] = statistics.stdev([length for length in virtual_bones[target_bone]['lengths'] if not m.isnan(length)])
-            except:
-                virtual_bones[target_bone]['stdev'] = m.nan
+        update_virtual_bones_lengths([target_bone])
 
     else:
         print('Updating Virtual Bones Information...')
 
-        # Reset the lengths list for every virtual bone
-        for bone in virtual_bones:
-            virtual_bones[bone]['lengths'] = []
-
         # Adjust tail empty of hand bones depending if hand_middle empties exist or not
         try:
             right_hand_middle_name = bpy.data.objects['right_hand_middle'].name
@@ -219,121 +326,119 @@ def update_virtual_bones_info(target_bone: str=''):
             virtual_bones['hand.R']['tail'] = 'right_index'
             virtual_bones['hand.L']['tail'] = 'left_index'
 
-        # Iterate through the empty_positions dictionary and calculate the distance between the head and tail and append it to the lengths list
-        # for frame in range (0, len(empty_positions['hips_center']['x'])):
-        for frame in range (0, len(empty_positions[list(empty_positions.keys())[0]]['x'])):
+        update_virtual_bones_lengths(list(virtual_bones))
 
-            # Iterate through each bone
-            for bone in virtual_bones:
-                # Calculate the length of the bone for this frame
-                head        = virtual_bones[bone]['head']
-                tail        = virtual_bones[bone]['tail']
-                head_pos    = (empty_positions[head]['x'][frame], empty_positions[head]['y'][frame], empty_positions[head]['z'][frame])
-                tail_pos    = (empty_positions[tail]['x'][frame], empty_positions[tail]['y'][frame], empty_positions[tail]['z'][frame])
+        print('Virtual Bones Information update completed.')
 
-                virtual_bones[bone]['lengths'].append(m.dist(head_pos, tail_pos))
+# Function to update the virtual bones information only for the bones
+# whose head or tail empties changed. changed is the dictionary returned by
+# refresh_empty_positions
+def refresh_virtual_bones_info(changed: dict=None):
 
-        # Update the length median and stdev values for each bone
-        for bone in virtual_bones:
-            # Exclude posible length NaN (produced by an empty with NaN values as position) values from the median and standard deviation
-            try:
-                virtual_bones[bone]['median'] = statistics.median([length for length in virtual_bones[bone]['lengths'] if not m.isnan(length)])
-            except:
-                virtual_bones[bone]['median'] = m.nan
+    # All the positions were updated or the lengths were not calculated
+    # for the stored frames
+    if changed is None or virtual_bones_lengths.shape != (len(virtual_bones), empty_positions.n_frames):
+        update_virtual_bones_info()
+        return
 
-            # If the median is nan (every length values was nan) then directly set the stdev as nan to avoid a calculus error
-            if m.isnan(virtual_bones[bone]['median']):
-                virtual_bones[bone]['stdev'] = m.nan
-            else:
-                try:
-                    virtual_bones[bone]['stdev'] = statistics.stdev([length for length in virtual_bones[bone]['lengths'] if not m.isnan(length)])
-                except:
-                    virtual_bones[bone]['stdev'] = m.nan
+    for bone in virtual_bones:
+        intervals = [changed[empty] for empty in (virtual_bones[bone]['head'], virtual_bones[bone]['tail'])
+                     if empty in changed]
+        if len(intervals) == 0:
+            continue
 
-        print('Virtual Bones Information update completed.')
+        # Update the lengths of the changed frames interval
+        update_virtual_bones_lengths([bone],
+                                     min(interval[0] for interval in intervals),
+                                     max(interval[1] for interval in intervals))
 
 def add_hands_middle_empties():
 
     # Try checking if the hand middle empties have been already added
-    try:
-        right_hand_middle_name = bpy.data.objects['right_hand_middle'].name
+    if 'right_hand_middle' in bpy.data.objects:
         # Right Hand Middle Empty exists. Nothing is done
         print('Hand Middle Empties already added.')
+        return
 
-    except:
-        # Hand Middle Empties do not exist
-        print('Adding Hand Middle Empties...')
+    # Hand Middle Empties do not exist
+    print('Adding Hand Middle Empties...')
 
-        # Define the empties that serve as reference to locate the middle empties
-        # middle_references = ['index', 'pinky']
-        middle_references = ['hand_middle_finger_mcp', 'hand_ring_finger_mcp']
+    # Add the empties at the middle point between the hand_middle_finger_mcp
+    # and hand_ring_finger_mcp empty markers of each hand, as defined in empties_dict
+    add_virtual_marker_empties(['right_hand_middle', 'left_hand_middle'])
 
-        # Add the empties
-        bpy.ops.object.empty_add(type='ARROWS', align='WORLD', location=(0, 0, 0), scale=(0.1, 0.1, 0.1))
-        right_hand_middle        = bpy.context.active_object
-        right_hand_middle.name   = 'right_hand_middle'
-        right_hand_middle.scale  = (0.02, 0.02, 0.02)
+    print('Adding Hand Middle completed.')
+
+# Function to add the virtual marker empties defined in empties_dict. Their positions for every frame are the
+# weighted sum of their reference markers positions, calculated as one array product and written with foreach_set.
+# If virtual_markers is not defined all the virtual markers that do not exist yet are added
+def add_virtual_marker_empties(virtual_markers: list=None):
+
+    # Get the virtual markers to add
+    if virtual_markers is None:
+        virtual_markers = [empty for empty in empties_dict
+                           if 'virtual_marker' in empties_dict[empty] and empty not in bpy.data.objects]
 
+    if len(virtual_markers) == 0:
+        return
+
+    # Get the scene context
+    scene = bpy.context.scene
+
+    # Update the local positions of the reference markers
+    refresh_empty_positions()
+
+    # Add the empties
+    virtual_marker_empties = []
+    for virtual_marker in virtual_markers:
         bpy.ops.object.empty_add(type='ARROWS', align='WORLD', location=(0, 0, 0), scale=(0.1, 0.1, 0.1))
-        left_hand_middle        = bpy.context.active_object
-        left_hand_middle.name   = 'left_hand_middle'
-        left_hand_middle.scale  = (0.02, 0.02, 0.02)
+        virtual_marker_empty        = bpy.context.active_object
+        virtual_marker_empty.name   = virtual_marker
+        virtual_marker_empty.scale  = (0.02, 0.02, 0.02)
 
-        # Copy the action data from the index fingers to have the base
-        right_hand_middle.animation_data_create()
-        right_hand_middle.animation_data.action = bpy.data.actions["right_" + middle_references[0] + "Action"].copy()
-        right_hand_middle.animation_data.action.name = 'right_hand_middleAction'
+        # Copy the action data from the first reference marker to have the base
+        reference_marker = list(empties_dict[virtual_marker]['virtual_marker'])[0]
+        virtual_marker_empty.animation_data_create()
+        virtual_marker_empty.animation_data.action = bpy.data.objects[reference_marker].animation_data.action.copy()
+        virtual_marker_empty.animation_data.action.name = virtual_marker + 'Action'
 
-        left_hand_middle.animation_data_create()
-        left_hand_middle.animation_data.action = bpy.data.actions["left_" + middle_references[0] + "Action"].copy()
-        left_hand_middle.animation_data.action.name = 'left_hand_middleAction'
+        virtual_marker_empties.append(virtual_marker_empty)
 
-        # Move the empties_parent empty to the position and rotation previous to the Adjust Empties method ending
-        origin = bpy.data.objects['empties_parent']
-        origin.location         = origin_location_pre_reset
-        origin.rotation_euler   = origin_rotation_pre_reset
+    # Move the empties_parent empty to the position and rotation previous to the Adjust Empties method ending
+    origin = bpy.data.objects['empties_parent']
+    origin.location         = origin_location_pre_reset
+    origin.rotation_euler   = origin_rotation_pre_reset
 
-        # Select the new empties
-        right_hand_middle.select_set(True)
-        left_hand_middle.select_set(True)
+    # Select the new empties
+    for virtual_marker_empty in virtual_marker_empties:
+        virtual_marker_empty.select_set(True)
 
-        # Set the origin active in 3Dview
-        bpy.context.view_layer.objects.active = bpy.data.objects['empties_parent']
-        # Parent selected empties to empties_parent keeping transforms
-        bpy.ops.object.parent_set(type='OBJECT', keep_transform=True)
+    # Set the origin active in 3Dview
+    bpy.context.view_layer.objects.active = bpy.data.objects['empties_parent']
+    # Parent selected empties to empties_parent keeping transforms
+    bpy.ops.object.parent_set(type='OBJECT', keep_transform=True)
 
-        # Reset the position and rotation of the origin
-        origin.location         = mathutils.Vector([0, 0, 0])
-        origin.rotation_euler   = mathutils.Vector([0, 0, 0])
+    # Reset the position and rotation of the origin
+    origin.location         = mathutils.Vector([0, 0, 0])
+    origin.rotation_euler   = mathutils.Vector([0, 0, 0])
 
-        # Create a list with the new hand middle empties
-        hand_middle_empties = [right_hand_middle, left_hand_middle]
+    # The new empties change the rows of the hierarchy index
+    empties_hierarchy.invalidate()
 
-        # Create a list of the hand sides
-        hand_side = ['right', 'left']
+    frames = np.arange(scene.frame_start, scene.frame_start + empty_positions.n_frames)
 
-        # Iterate through each frame and calculate the middle point between the index and pinky empty markers for each hand
-        # Update the new hand middle empties position with that point
-        for frame_index in range (0, len(empty_positions['right_index']['x']) - 1):
-
-            for side_index in range (0, 2):
-                # Get the positions of the middle references
-                ref0_position    = mathutils.Vector([empty_positions[hand_side[side_index] + '_' + middle_references[0]]['x'][frame_index],
-                                                     empty_positions[hand_side[side_index] + '_' + middle_references[0]]['y'][frame_index],
-                                                     empty_positions[hand_side[side_index] + '_' + middle_references[0]]['z'][frame_index]])
-                ref1_position    = mathutils.Vector([empty_positions[hand_side[side_index] + '_' + middle_references[1]]['x'][frame_index],
-                                                     empty_positions[hand_side[side_index] + '_' + middle_references[1]]['y'][frame_index],
-                                                     empty_positions[hand_side[side_index] + '_' + middle_references[1]]['z'][frame_index]])
-                
-                # Get the new position of the middle empties
-                hand_middle_position  = ref0_position + (ref1_position - ref0_position) / 2
+    for virtual_marker in virtual_markers:
+        # Get the virtual marker positions as the weighted sum of the reference markers positions
+        reference_weights = empties_dict[virtual_marker]['virtual_marker']
+        virtual_marker_positions = np.einsum('r,rfi->fi',
+                                             np.array(list(reference_weights.values()), dtype=np.float64),
+                                             empty_positions.gather(list(reference_weights)))
 
-                # Update the action property of the middle empty
-                hand_middle_empties[side_index].animation_data.action.fcurves[0].keyframe_points[frame_index].co[1] = hand_middle_position[0]
-                hand_middle_empties[side_index].animation_data.action.fcurves[1].keyframe_points[frame_index].co[1] = hand_middle_position[1]
-                hand_middle_empties[side_index].animation_data.action.fcurves[2].keyframe_points[frame_index].co[1] = hand_middle_position[2]
+        # Update the action of the virtual marker empty
+        write_local_positions(empties_hierarchy.fcurves(virtual_marker), frames, virtual_marker_positions)
 
-        print('Adding Hand Middle completed.')
+        # Save the positions in the empty positions store
+        empty_positions.set_positions(virtual_marker, virtual_marker_positions)
 
 # Function to draw a vector for debbuging purposes
 def draw_vector(origin, angle, name):
@@ -365,129 +470,249 @@ def quadratic_function(x1, x2, x3, y1, y2, y3):
     
     return quadratic_function
 
-# Function to calculate the position of a an ik pole bone based on the position of the limb markers
-def calculate_ik_pole_position(base_marker_name: str,
-                               pole_marker_name: str,
-                               target_marker_name: str,
-                               aux_markers: list,
-                               dot_product_threshold: float,
-                               transition_function,):
+# Function to get the start and end (exclusive) indices of the runs of
+# consecutive True values of a boolean array
+def get_true_runs(mask: np.ndarray) -> tuple:
+    # Pad the mask with False so every run has a rising and a falling edge
+    edges = np.diff(np.concatenate(([False], mask, [False])).astype(np.int8))
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+
+    return run_starts, run_ends
+
+# Function to get the concatenated indices of a list of [start, end)
+# ranges, with the range index and the offset of each index in its range
+def get_range_indices(range_starts: np.ndarray, range_ends: np.ndarray) -> tuple:
+    range_sizes = np.maximum(np.asarray(range_ends) - np.asarray(range_starts), 0)
+    range_index = np.repeat(np.arange(len(range_sizes)), range_sizes)
+    offsets = np.arange(range_sizes.sum()) - np.repeat(np.cumsum(range_sizes) - range_sizes, range_sizes)
+
+    return np.asarray(range_starts)[range_index] + offsets, range_index, offsets
+
+# Function to solve in batch the z coordinate of points C with known x, y
+# coordinates so their distances to the points A and B are as close as
+# possible to length_A_to_C and length_B_to_C. For each point it finds the
+# minimum of the quartic error
+#   ((x_A - x_C)**2 + (y_A - y_C)**2 + (z_A - z_C)**2 - length_A_to_C**2)**2
+#   + ((x_B - x_C)**2 + (y_B - y_C)**2 + (z_B - z_C)**2 - length_B_to_C**2)**2
+# reached by descending from initial_z, using the roots of its derivative.
+# Points with NaN values keep their initial_z
+def solve_two_sphere_heights(points_C_xy: np.ndarray,
+                             points_A: np.ndarray,
+                             points_B: np.ndarray,
+                             length_A_to_C: float,
+                             length_B_to_C: float,
+                             initial_z: np.ndarray) -> np.ndarray:
+
+    solved_z = np.array(initial_z, dtype=np.float64)
+
+    # Horizontal squared distances minus the squared lengths
+    p_A = np.sum((points_A[:, :2] - points_C_xy)**2, axis=1) - length_A_to_C**2
+    p_B = np.sum((points_B[:, :2] - points_C_xy)**2, axis=1) - length_B_to_C**2
+    z_A = points_A[:, 2]
+    z_B = points_B[:, 2]
+
+    valid = np.isfinite(p_A) & np.isfinite(p_B) & np.isfinite(z_A) & np.isfinite(z_B) & np.isfinite(solved_z)
+    if not np.any(valid):
+        return solved_z
+
+    p_A, p_B, z_A, z_B, guess = p_A[valid], p_B[valid], z_A[valid], z_B[valid], solved_z[valid]
+
+    # The error derivative divided by 4 is the cubic
+    #   (z - z_A)**3 + p_A * (z - z_A) + (z - z_B)**3 + p_B * (z - z_B)
+    # Get its monic coefficients and its roots as the eigenvalues of the
+    # companion matrices
+    c2 = -1.5 * (z_A + z_B)
+    c1 = 1.5 * (z_A**2 + z_B**2) + 0.5 * (p_A + p_B)
+    c0 = -0.5 * (z_A**3 + z_B**3 + p_A * z_A + p_B * z_B)
+
+    companion = np.zeros((len(c0), 3, 3))
+    companion[:, 0, 0] = -c2
+    companion[:, 0, 1] = -c1
+    companion[:, 0, 2] = -c0
+    companion[:, 1, 0] = 1
+    companion[:, 2, 1] = 1
+    roots = np.linalg.eigvals(companion)
+
+    # Get the real roots sorted. A cubic always has one real root, the
+    # complex ones are replaced by it
+    real_roots = np.abs(roots.imag) <= 1e-7 * np.maximum(1, np.abs(roots.real))
+    closest_real_root = roots.real[np.arange(len(roots)), np.argmin(np.abs(roots.imag), axis=1)]
+    sorted_roots = np.sort(np.where(real_roots, roots.real, closest_real_root[:, np.newaxis]), axis=1)
+
+    # With three real roots the middle one is a maximum of the error and the
+    # other two are minima. Descending from the initial z reaches the
+    # minimum on its side of the maximum
+    solved_z[valid] = np.where(guess < sorted_roots[:, 1], sorted_roots[:, 0], sorted_roots[:, 2])
+
+    return solved_z
+
+# Function to get the (n, 3, 3) matrices of the rotations by the angles
+# around the axes (not necessarily normalized)
+def get_rotation_matrices(axes: np.ndarray, angles: np.ndarray) -> np.ndarray:
+    with np.errstate(invalid='ignore', divide='ignore'):
+        axes = axes / np.linalg.norm(axes, axis=1)[:, np.newaxis]
+    x, y, z = axes[:, 0], axes[:, 1], axes[:, 2]
+    cos = np.cos(angles)
+    sin = np.sin(angles)
+    one_minus_cos = 1 - cos
+
+    return np.stack([
+        np.stack([cos + x * x * one_minus_cos, x * y * one_minus_cos - z * sin, x * z * one_minus_cos + y * sin], axis=-1),
+        np.stack([y * x * one_minus_cos + z * sin, cos + y * y * one_minus_cos, y * z * one_minus_cos - x * sin], axis=-1),
+        np.stack([z * x * one_minus_cos - y * sin, z * y * one_minus_cos + x * sin, cos + z * z * one_minus_cos], axis=-1),
+    ], axis=-2)
+
+# Function to rotate (n, 3) arrays of vectors by the shortest arc rotations
+# that take the from_vectors to the to_vectors, as the rotation_difference
+# quaternion of each pair of vectors
+def rotate_vectors_by_difference(from_vectors: np.ndarray,
+                                 to_vectors: np.ndarray,
+                                 vectors: list) -> list:
+    with np.errstate(invalid='ignore', divide='ignore'):
+        from_vectors = from_vectors / np.linalg.norm(from_vectors, axis=1)[:, np.newaxis]
+        to_vectors = to_vectors / np.linalg.norm(to_vectors, axis=1)[:, np.newaxis]
+        cosine = np.einsum('ij,ij->i', from_vectors, to_vectors)[:, np.newaxis]
+        cross = np.cross(from_vectors, to_vectors)
+
+        # Rodrigues formula with the unnormalized rotation axis
+        rotated_vectors = [vector * cosine
+                           + np.cross(cross, vector)
+                           + cross * np.einsum('ij,ij->i', cross, vector)[:, np.newaxis] / (1 + cosine)
+                           for vector in vectors]
+
+    return rotated_vectors
+
+# Function to rotate the (n_empties, n_frames, 3) positions of a group of
+# empties around the (n_frames, 3) origins with the (n_frames, 3, 3)
+# rotation matrices of each frame
+def rotate_positions(positions: np.ndarray,
+                     origins: np.ndarray,
+                     rot_matrices: np.ndarray) -> np.ndarray:
+    return origins + np.einsum('fij,efj->efi', rot_matrices, positions - origins)
+
+# Function to normalize a (n, 3) array of vectors. Zero vectors stay as zero vectors
+def normalize_vectors(vectors: np.ndarray) -> np.ndarray:
+    lengths = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, lengths, out=np.zeros_like(vectors), where=lengths != 0)
+
+# Function to calculate the positions of a an ik pole bone for every frame based on the (n_frames, 3) positions
+# of the limb markers (base, pole, target and the two auxiliary markers)
+def calculate_ik_pole_positions(base_positions: np.ndarray,
+                                pole_positions: np.ndarray,
+                                target_positions: np.ndarray,
+                                aux_positions: list,
+                                dot_product_threshold: float,
+                                transition_function,) -> np.ndarray:
+
+    # Get the base vectors (vectors from base marker to pole marker)
+    base_vectors    = pole_positions - base_positions
+
+    # Get the target vectors (vectors from target marker to pole marker)
+    target_vectors  = pole_positions - target_positions
 
-    # Get the marker objects
-    base_marker    = bpy.data.objects[base_marker_name]
-    pole_marker    = bpy.data.objects[pole_marker_name]
-    target_marker  = bpy.data.objects[target_marker_name]
+    # Normalize the vectors
+    base_vectors_normalized = normalize_vectors(base_vectors)
+    target_vectors_normalized = normalize_vectors(target_vectors)
 
-    # Get the base vector (vector from base marker to pole marker)
-    base_vector     = pole_marker.matrix_world.translation - base_marker.matrix_world.translation
+    #  Calculate the pole projection vectors as the sum of the base vectors and the target vectors
+    pole_projections = normalize_vectors(base_vectors_normalized + target_vectors_normalized)
 
-    # Get the target vector (vector from target marker to pole marker)
-    target_vector   = pole_marker.matrix_world.translation - target_marker.matrix_world.translation
+    # Get the dot products of the base vectors and the target vectors
+    dot_products = np.einsum('ij,ij->i', base_vectors_normalized, target_vectors_normalized)
 
-    # Normalize the vectors
-    base_vector_normalized = base_vector.normalized()
-    target_vector_normalized = target_vector.normalized()
+    # If the vectors are almost parallel (dot product near minus one), use the auxiliary markers to determine approximate direction
+    parallel_frames = np.flatnonzero(dot_products < (dot_product_threshold * -1))
+    final_pole_projections = pole_projections.copy()
 
-    #  Calculate the pole projection vector as the sum of the base vector and the target vector
-    pole_projection = (base_vector_normalized + target_vector_normalized).normalized()
+    if len(parallel_frames) != 0:
+        base_parallel = base_vectors_normalized[parallel_frames]
 
-    # Get the dot product of the base vector and the target vector
-    dot_product = base_vector_normalized.dot(target_vector_normalized)
+        # Get the auxiliary vectors
+        aux_vectors = normalize_vectors(aux_positions[0][parallel_frames] - aux_positions[1][parallel_frames])
 
-    # If the vectors are almost parallel (dot product near minus one), use the auxiliary markers to determine approximate direction
-    if dot_product < (dot_product_threshold * -1):
-        # Get auxiliary markers
-        aux_0 = bpy.data.objects[aux_markers[0]]
-        aux_1 = bpy.data.objects[aux_markers[1]]
-        
-        # Get the auxiliary vector
-        aux_vector = (aux_0.matrix_world.translation - aux_1.matrix_world.translation).normalized()
-        
-        # Get the perpendicular projection of the aux_vector onto the base vector
-        perpendicular_aux = (aux_vector - base_vector_normalized * (base_vector_normalized.dot(aux_vector) / base_vector_normalized.length_squared)).normalized()
+        # Get the perpendicular projection of the aux_vectors onto the base vectors
+        with np.errstate(invalid='ignore', divide='ignore'):
+            projection_coefficients = np.einsum('ij,ij->i', base_parallel, aux_vectors) / np.einsum('ij,ij->i', base_parallel, base_parallel)
+        perpendicular_aux = normalize_vectors(aux_vectors - base_parallel * projection_coefficients[:, np.newaxis])
 
-        # Get the pondered coefficient from the transition function
-        pondered_coefficient = transition_function(abs(dot_product))
+        # Get the pondered coefficients from the transition function
+        pondered_coefficients = transition_function(np.abs(dot_products[parallel_frames]))[:, np.newaxis]
 
-        # Get the final pole projection vector as pondered sum of the base vector and the perpendicular aux vector
-        final_pole_projection = mathutils.Vector((1 - pondered_coefficient) * pole_projection + pondered_coefficient * perpendicular_aux).normalized()
-    
-    else:
-        final_pole_projection = pole_projection
+        # Get the final pole projection vectors as pondered sum of the base vectors and the perpendicular aux vectors
+        final_pole_projections[parallel_frames] = normalize_vectors((1 - pondered_coefficients) * pole_projections[parallel_frames]
+                                                                    + pondered_coefficients * perpendicular_aux)
 
-    # Debug
-    # bpy.ops.object.mode_set(mode='OBJECT')
-    # draw_vector(pole_marker.matrix_world.translation, base_vector_normalized, 'base_vector')
-    # draw_vector(pole_marker.matrix_world.translation, target_vector_normalized, 'target_vector')    
-    # draw_vector(pole_marker.matrix_world.translation, pole_projection, 'pole_projection_' + str(dot_product))
-    # if perpendicular_aux is not None:
-    #     draw_vector(pole_marker.matrix_world.translation, perpendicular_aux, 'perpendicular_aux_' + str(dot_product))
-    # draw_vector(pole_marker.matrix_world.translation, final_pole_projection, 'final_pole_projection_' + str(dot_product))
-    # bpy.context.view_layer.objects.active = bpy.data.objects['root']
-    # bpy.ops.object.mode_set(mode='POSE')
+    # Get the pole bone positions as the projection vectors multiplied by the sum of the length of the base vectors and the length of the target vectors
+    pole_bone_positions = pole_positions + final_pole_projections * (np.linalg.norm(base_vectors, axis=1) + np.linalg.norm(target_vectors, axis=1))[:, np.newaxis]
 
-    # Get the pole bone position as the projection vector multiplied by the sum of the length of the base vector and the length of the target vector
-    pole_bone_position = mathutils.Vector(pole_marker.matrix_world.translation + final_pole_projection * (base_vector.length + target_vector.length))
+    return pole_bone_positions
 
-    return pole_bone_position
+# Function to translate a list of empties by the (n_empties, n_frames, 3)
+# global position deltas on the frames. The deltas are converted to each
+# empty local axes and written once per location fcurve. NaN deltas are
+# ignored
+def translate_global_positions(empties: list,
+                               position_deltas: np.ndarray,
+                               frames: np.ndarray) -> None:
 
-# Function to translate the empties recursively
-def translate_empty(empties_dict, empty, frame_index, delta, recursivity: bool=True):
+    position_deltas = np.where(np.isnan(position_deltas), 0, position_deltas)
 
-    try:
-        # Translate the empty in the animation location curve
-        actual_x = bpy.data.objects[empty].animation_data.action.fcurves[0].keyframe_points[frame_index].co[1]
-        bpy.data.objects[empty].animation_data.action.fcurves[0].keyframe_points[frame_index].co[1] = actual_x + delta[0]
-        actual_y = bpy.data.objects[empty].animation_data.action.fcurves[1].keyframe_points[frame_index].co[1]
-        bpy.data.objects[empty].animation_data.action.fcurves[1].keyframe_points[frame_index].co[1] = actual_y + delta[1]
-        actual_z = bpy.data.objects[empty].animation_data.action.fcurves[2].keyframe_points[frame_index].co[1]
-        bpy.data.objects[empty].animation_data.action.fcurves[2].keyframe_points[frame_index].co[1] = actual_z + delta[2]
-    except:
-        # Empty does not exist or does not have animation data
-        #print('Empty ' + empty + ' does not have animation data on frame ' + str(frame_index))
-        pass
-
-    # If recursivity is set to True then call this function to the children of the empty
-    if recursivity:
-
-        # If empty has children then call this function for every child
-        if empty in empties_dict:
-            for child in empties_dict[empty]['children']:
-                translate_empty(empties_dict, child, frame_index, delta, recursivity)
-
-# Function to rotate the virtual bones by its tail empty using a rotation matrix. Do it recursively for its children
-def rotate_virtual_bone(empty, origin, rot_matrix: mathutils.Matrix):
-    # Get the scene current frame
-    frame_index = bpy.context.scene.frame_current
-
-    # Get the current location of the empty
-    empty_current_location = bpy.data.objects[empty].matrix_world.translation
-
-    # Get local vector from origin to the virtual bone tail empty
-    empty_local_vector = empty_current_location - origin
-
-    # Rotate the local vector using the rotation matrix
-    rotated_empty_vector = rot_matrix @ empty_local_vector
-
-    # Get the world space rotated empty vector
-    new_empty_vector = origin + rotated_empty_vector
-
-    # Change the position of the empty in the world space
-    bpy.data.objects[empty].matrix_world.translation = new_empty_vector
-
-    # Translate the empty in the animation location curve
-    try:
-        bpy.data.objects[empty].animation_data.action.fcurves[0].keyframe_points[frame_index].co[1] = new_empty_vector[0]
-        bpy.data.objects[empty].animation_data.action.fcurves[1].keyframe_points[frame_index].co[1] = new_empty_vector[1]
-        bpy.data.objects[empty].animation_data.action.fcurves[2].keyframe_points[frame_index].co[1] = new_empty_vector[2]
-    except:
-        # Empty does not exist or does not have animation data
-        print('Empty ' + empty + ' does not have animation data on frame ' + str(frame_index))
-
-    # If empty has children then call this function for every child
-    if empty in empties_dict:
-        for child in empties_dict[empty]['children']:
-            rotate_virtual_bone(child, origin, rot_matrix)
+    for row in np.flatnonzero(np.any(position_deltas != 0, axis=(1, 2))):
+        empty = empties[row]
+        fcurves = empties_hierarchy.fcurves(empty)
+        if fcurves is None:
+            # Empty does not exist or does not have animation data
+            print('Empty ' + empty + ' does not have animation data')
+            continue
+
+        # Convert the global deltas to the empty local axes. If the parent
+        # is animated the deltas are applied directly on the local location
+        local_deltas = position_deltas[row]
+        local_to_world_matrix = get_local_to_world_matrix(bpy.data.objects[empty])
+        if local_to_world_matrix is not None:
+            local_deltas = local_deltas @ np.linalg.inv(local_to_world_matrix[:3, :3]).T
+
+        changed_frames = np.flatnonzero(np.any(position_deltas[row] != 0, axis=1))
+        translate_local_positions(bpy.data.objects[empty],
+                                  frames[changed_frames],
+                                  local_deltas[changed_frames],
+                                  fcurves)
+
+        # Record the change for the positions refresh
+        empty_positions.mark_changed(empty, int(frames[changed_frames[0]]), int(frames[changed_frames[-1]]))
+
+# Function to rotate the virtual bones by its tail empty for a whole timeline. The empty and all its
+# descendants are rotated around the (n, 3) origins with the (n, 3, 3) rotation matrices of the
+# frame_indices frames. The rotation is done in place on the (n_markers, n_frames, 3) global positions
+# array, by default the empty positions store. If write is True the position deltas are written on the
+# location curves in bulk. Callers that chain several rotations on a working copy can pass write=False
+# and write all the deltas once with translate_global_positions
+def rotate_virtual_bone_timeline(empty: str,
+                                 origins: np.ndarray,
+                                 rot_matrices: np.ndarray,
+                                 frame_indices: np.ndarray,
+                                 positions: np.ndarray=None,
+                                 write: bool=True) -> None:
+
+    # Use the updated global positions of the store by default
+    if positions is None:
+        refresh_empty_positions(position_reference='global')
+        positions = empty_positions.data
+
+    # Get the positions store rows of the empty subtree
+    subtree_rows = empties_hierarchy.subtree_rows(empty)[:, np.newaxis]
+
+    # Rotate the positions of all the subtree empties with one batched product
+    subtree_positions = positions[subtree_rows, frame_indices]
+    rotated_positions = rotate_positions(subtree_positions, origins, rot_matrices)
+    positions[subtree_rows, frame_indices] = rotated_positions
+
+    # Translate the empties in their location curves
+    if write:
+        translate_global_positions([empty_positions.names[row] for row in subtree_rows[:, 0]],
+                                   rotated_positions - subtree_positions,
+                                   bpy.context.scene.frame_start + np.asarray(frame_indices))
 
 def adjust_empties(z_align_ref_empty: str='left_knee',
                    z_align_angle_offset: float=0,
@@ -628,20 +853,33 @@ def adjust_empties(z_align_ref_empty: str='left_knee',
     if correct_fingers_empties:
         hand_side = ['right', 'left']
 
-        # Iterate through each scene frame and calculate the position delta from x_hand_wrist to x_wrist and move all the fingers empties by that delta
-        for frame in range (scene.frame_start, scene.frame_end):
-            # Set scene frame
-            scene.frame_set(frame)
+        # Read the local positions of all the empties again, as they were
+        # reparented above
+        invalidate_empty_positions()
+        refresh_empty_positions(position_reference='local')
 
-            for side in hand_side:
-                # Get the position delta
-                position_delta      = bpy.data.objects[side + '_wrist'].location - bpy.data.objects[side + '_hand_wrist'].location
+        frames = np.arange(scene.frame_start, scene.frame_start + empty_positions.n_frames)
 
-                # Translate the hand_wrist empty and its children by the position delta
-                translate_empty(empties_dict, side + '_hand_wrist', frame, position_delta)
+        for side in hand_side:
+            # Get the position deltas from x_hand_wrist to x_wrist on every frame
+            position_deltas = empty_positions.positions(side + '_wrist') - empty_positions.positions(side + '_hand_wrist')
 
-        # Reset the scene frame to the start
-        scene.frame_set(scene.frame_start)
+            # Skip the frames with NaN positions
+            valid_frames = ~np.any(np.isnan(position_deltas), axis=1)
+            if not np.any(valid_frames):
+                continue
+
+            # Translate the hand_wrist empty and its children by the position deltas
+            for row in empties_hierarchy.subtree_rows(side + '_hand_wrist'):
+                empty = empty_positions.names[row]
+                if translate_local_positions(bpy.data.objects[empty],
+                                             frames[valid_frames],
+                                             position_deltas[valid_frames],
+                                             empties_hierarchy.fcurves(empty)):
+                    # Record the change for the positions refresh
+                    empty_positions.mark_changed(empty,
+                                                 int(frames[valid_frames][0]),
+                                                 int(frames[valid_frames][-1]))
 
     # Add the hand middle empties if the option is enabled
     if add_hand_middle_empty:
@@ -675,10 +913,11 @@ def reduce_bone_length_dispersion(interval_variable: str='capture_median', inter
     else:
         # Set the recursivity mode to True to adjust the children bones
         recursivity = True
-        # Update the empty positions dictionary
-        update_empty_positions()
-        # Update the information of the virtual bones
-        update_virtual_bones_info()
+        # Update the positions of the changed empties (all of them if
+        # the positions store is not valid)
+        changed = refresh_empty_positions()
+        # Update the information of the affected virtual bones
+        refresh_virtual_bones_info(changed)
 
         # Print the current bones length median, standard deviation and coefficient of variation
         print('Current Virtual Bone Information:')
@@ -693,9 +932,11 @@ def reduce_bone_length_dispersion(interval_variable: str='capture_median', inter
 
             print('{:<15} {:>12} {:>12} {:>12}'.format(bone, str(m.trunc(current_median*100*10000000)/10000000), str(m.trunc(current_stdev*100*10000000)/10000000), str(m.trunc(current_cv*100*10000)/10000)))
 
-    # Iterate through the lengths array of each bone and check if the length is outside the interval defined by x*stdev with x as a factor
-    # If the bone length is outside the interval, adjust the coordinates of the tail empty and its children so the new bone length is at the border of the interval
+    # Check for each bone the lengths outside the interval defined by x*stdev with x as a factor
+    # If the bone length is outside the interval, get the delta that moves the tail empty and its children so the new bone length is at the border of the interval
+    # The deltas of all the frames are accumulated in an array and written to each empty animation at the end
     empties_positions_corrected = 0
+    position_deltas = np.zeros_like(empty_positions.data)
 
     for bone in virtual_bones:
 
@@ -703,68 +944,80 @@ def reduce_bone_length_dispersion(interval_variable: str='capture_median', inter
         if target_bone != '':
             if bone != target_bone:
                 continue
-        
-        frame_index = 0
 
-        for length in virtual_bones[bone]['lengths']:
-        
-            # If the length is equal to nan (bone head or/and tail is nan) then continue with the next length
-            if m.isnan(length):
-                frame_index += 1
-                continue
+        lengths = np.asarray(virtual_bones[bone]['lengths'])
+
+        # If all the lengths are nan (bone head or/and tail is nan) then continue with the next bone
+        if np.all(np.isnan(lengths)):
+            continue
+
+        # Get the bone median and stdev values
+        median  = virtual_bones[bone]['median']
+        stdev   = virtual_bones[bone]['stdev']
+
+        # Calculate inferior and superior interval limit depending on interval variable
+        if interval_variable == 'capture_median':
+            # Fix interval_factor to 1 in case is greater than 1
+            if interval_factor > 1:
+                interval_factor = 1
+            # Calculate limits
+            inferior_limit  = median * (1 - interval_factor)
+            superior_limit  = median * (1 + interval_factor)
+        elif interval_variable == 'capture_stdev':
+            # Fix interval_factor to median/stdev in case is greater than median/stdev
+            if stdev != 0 and interval_factor > (median/stdev):
+                interval_factor = median / stdev
+            # Calculate limits
+            inferior_limit  = median - interval_factor * stdev
+            superior_limit  = median + interval_factor * stdev
+        elif interval_variable == 'standard_length':
+            # Use the bone standard anthropomorphic dimension relative to the body height
+            inferior_limit  = anthropomorphic_dimensions[bone]['dimension'] * body_height * (1 - interval_factor)
+            superior_limit  = anthropomorphic_dimensions[bone]['dimension'] * body_height * (1 + interval_factor)
+
+        # Get the frames with the bone length outside the interval (nan lengths are never outside)
+        with np.errstate(invalid='ignore'):
+            under_limit = lengths < inferior_limit
+            over_limit  = lengths > superior_limit
+        corrected_frames = np.flatnonzero(under_limit | over_limit)
+
+        if len(corrected_frames) == 0:
+            continue
+
+        head        = virtual_bones[bone]['head']
+        tail        = virtual_bones[bone]['tail']
+        corrected_lengths = lengths[corrected_frames]
+        # Get vectors between the bone's tail and head empties
+        bone_vectors    = empty_positions.positions(tail)[corrected_frames] - empty_positions.positions(head)[corrected_frames]
+        # Get the new bone lengths depending of the actual length values (interval inferior or superior limit)
+        new_lengths     = np.where(under_limit[corrected_frames], inferior_limit, superior_limit)
+        # Get the tail position deltas by multiplying the normalized bone vectors by the substraction of new_length and length
+        bone_deltas     = bone_vectors / corrected_lengths[:, np.newaxis] * (new_lengths - corrected_lengths)[:, np.newaxis]
+
+        # Add the deltas to the tail empty and, if recursivity is set to True, to its children
+        translated_rows = empties_hierarchy.subtree_rows(tail, recursivity)
+        position_deltas[translated_rows[:, np.newaxis], corrected_frames] += bone_deltas
+
+        empties_positions_corrected += len(corrected_frames)
+
+    # Write the accumulated deltas once on each translated empty location curves
+    frames = np.arange(scene.frame_start, scene.frame_start + empty_positions.n_frames)
+    for row in np.flatnonzero(np.any(position_deltas != 0, axis=(1, 2))):
+        empty = empty_positions.names[row]
+        if translate_local_positions(bpy.data.objects[empty],
+                                     frames,
+                                     position_deltas[row],
+                                     empties_hierarchy.fcurves(empty)):
+            # Record the change for the positions refresh
+            changed_frames = frames[np.any(position_deltas[row] != 0, axis=1)]
+            empty_positions.mark_changed(empty, int(changed_frames[0]), int(changed_frames[-1]))
 
-            # Get the bone median and stdev values
-            median  = virtual_bones[bone]['median']
-            stdev   = virtual_bones[bone]['stdev']
-
-            # Calculate inferior and superior interval limit depending on interval variable
-            if interval_variable == 'capture_median':
-                # Fix interval_factor to 1 in case is greater than 1
-                if interval_factor > 1:
-                    interval_factor = 1
-                # Calculate limits
-                inferior_limit  = median * (1 - interval_factor)
-                superior_limit  = median * (1 + interval_factor)
-            elif interval_variable == 'capture_stdev':
-                # Fix interval_factor to median/stdev in case is greater than median/stdev
-                if interval_factor > (median/stdev):
-                    interval_factor = median / stdev
-                # Calculate limits
-                inferior_limit  = median - interval_factor * stdev
-                superior_limit  = median + interval_factor * stdev
-            elif interval_variable == 'standard_length':
-                # Use the bone standard anthropomorphic dimension relative to the body height
-                inferior_limit  = anthropomorphic_dimensions[bone]['dimension'] * body_height * (1 - interval_factor)
-                superior_limit  = anthropomorphic_dimensions[bone]['dimension'] * body_height * (1 + interval_factor)
-
-            # Check if bone length is outside the interval
-            if length < inferior_limit or length > superior_limit:
-
-                head        = virtual_bones[bone]['head']
-                tail        = virtual_bones[bone]['tail']
-                # Get vector between the bone's tail and head empties
-                head_position   = mathutils.Vector([empty_positions[head]['x'][frame_index], empty_positions[head]['y'][frame_index], empty_positions[head]['z'][frame_index]])
-                tail_position   = mathutils.Vector([empty_positions[tail]['x'][frame_index], empty_positions[tail]['y'][frame_index], empty_positions[tail]['z'][frame_index]])
-                bone_vector     = tail_position - head_position
-                # Get the new bone length depending of the actual length value (interval inferior or superior limit)
-                new_length      = inferior_limit if length < inferior_limit else superior_limit
-                # Get the normalized bone vector by dividing the bone_vector by its length
-                bone_vector_norm = bone_vector / length
-                # Get the tail position delta by multiplying the normalized bone vector by the substraction of new_length and length
-                position_delta  = bone_vector_norm * (new_length - length)
-                # Translate the tail empty and its children by the position delta.
-                translate_empty(empties_dict, tail, frame_index, position_delta, recursivity)
-
-                empties_positions_corrected += 1
-            
-            frame_index += 1
-    
     # Only update empty positions and virtual bones info and show statistics if the target bone is not defined
     if target_bone == '':
-        # Update the empty positions dictionary
-        update_empty_positions()
-        # Update the information of the virtual bones
-        update_virtual_bones_info()
+        # Update the positions of the translated empties
+        changed = refresh_empty_positions()
+        # Update the information of the affected virtual bones
+        refresh_virtual_bones_info(changed)
 
         # Print the new bones length median, standard deviation and coefficient of variation
         print('New Virtual Bone Information:')
@@ -791,157 +1044,140 @@ def reduce_bone_length_dispersion(interval_variable: str='capture_median', inter
 # The resulting rotation will be just on the border of the limits interval. The rotation analysis will be done separately
 # on the local x and z axes of the virtual bone. When an empty is rotated, all of its children empties will be rotated equally recursevily
 def add_finger_rotation_limits():
-    
+
+    # Function to calculate the bone's local axes for every frame by rotating its parent bone's axes
+    # with the rotation between the parent bone's y axis and the bone's y axis
     def calculate_bone_axes_from_parent(bone):
         # Calculate the bone's y axis
-        bone_y_axis = mathutils.Vector(bpy.data.objects[virtual_bones[bone]['tail']].matrix_world.translation - bpy.data.objects[virtual_bones[bone]['head']].matrix_world.translation)
-
-        # Calculate the difference between the bone's y axis and its parent bone's y axis
-        rotation_quat = virtual_bones[virtual_bones[bone]['parent_bone']]['bone_y_axis'].rotation_difference(bone_y_axis)
+        bone_y_axis = positions[empty_positions.index[virtual_bones[bone]['tail']]] - positions[empty_positions.index[virtual_bones[bone]['head']]]
 
         # Rotate the parent x and z axes to get the bones local x and z axes
-        bone_x_axis = virtual_bones[virtual_bones[bone]['parent_bone']]['bone_x_axis'].copy()
-        bone_x_axis.rotate(rotation_quat)
-        bone_z_axis = virtual_bones[virtual_bones[bone]['parent_bone']]['bone_z_axis'].copy()
-        bone_z_axis.rotate(rotation_quat)
+        parent_bone_axes = bone_axes[virtual_bones[bone]['parent_bone']]
+        bone_x_axis, bone_z_axis = rotate_vectors_by_difference(parent_bone_axes['y'],
+                                                                bone_y_axis,
+                                                                [parent_bone_axes['x'], parent_bone_axes['z']])
 
-        # Save the vectors in the virtual_bones dictionary
-        virtual_bones[bone]['bone_x_axis'] = mathutils.Vector(bone_x_axis)
-        virtual_bones[bone]['bone_y_axis'] = mathutils.Vector(bone_y_axis)
-        virtual_bones[bone]['bone_z_axis'] = mathutils.Vector(bone_z_axis)
+        # Save the axes arrays
+        bone_axes[bone] = {'x': bone_x_axis, 'y': bone_y_axis, 'z': bone_z_axis}
 
         return
-    
+
+    # Function to get the (n_frames,) rotation deltas on the axis that put the bone rotation on the border of its limits
     def get_rot_delta(bone, axis):
 
         # Get the ortogonal axis
         ort_axis = 'z' if axis == 'x' else 'x'
 
         # Set the bone axis
-        bone_axis = virtual_bones[bone]['bone_' + axis + '_axis']
+        bone_axis = bone_axes[bone][axis]
         # Set the parent bone axis
-        parent_bone_axis = virtual_bones[virtual_bones[bone]['parent_bone']]['bone_' + axis + '_axis']
+        parent_bone_axis = bone_axes[virtual_bones[bone]['parent_bone']][axis]
         # Set the parent bone ortogonal axis
-        parent_bone_ort_axis = virtual_bones[virtual_bones[bone]['parent_bone']]['bone_' + ort_axis + '_axis']
-
-        # Calculate the dot product between the x axes of the bone and its parent bone
-        dot_product = bone_axis.dot(parent_bone_axis)
+        parent_bone_ort_axis = bone_axes[virtual_bones[bone]['parent_bone']][ort_axis]
 
-        # Based on the dot product calculate the rotation angle cosine between the axis of the bone and its parent bone
-        angle_cosine = dot_product / (bone_axis.magnitude * parent_bone_axis.magnitude)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # Based on the dot product calculate the rotation angle cosine between the axis of the bone and its parent bone
+            angle_cosine = np.einsum('ij,ij->i', bone_axis, parent_bone_axis) / (np.linalg.norm(bone_axis, axis=1) * np.linalg.norm(parent_bone_axis, axis=1))
 
-        # Calculate the angle between the perpendicular vectors in radians
-        if angle_cosine > 1:
-            angle = m.acos(1)
-        elif angle_cosine < -1:
-            angle = m.acos(-1)
-        else:
-            angle = m.acos(angle_cosine)
+            # Calculate the angle between the perpendicular vectors in radians
+            angle = np.arccos(np.clip(angle_cosine, -1, 1))
 
-        # Calculate the cross product between the axis of the bone and its parent bone axis
-        cross_product = mathutils.Vector(parent_bone_axis.cross(bone_axis))
+            # Calculate the dot product between the cross product of the bone and parent bone axes and the parent ortogonal axis
+            cross_dot_product = np.einsum('ij,ij->i', np.cross(parent_bone_axis, bone_axis), parent_bone_ort_axis)
 
-        # Calculate the dot product between the cross product and the parent ortogonal axis
-        cross_dot_product = cross_product.dot(parent_bone_ort_axis)
+            # If the dot product is negative then the rotation angle is negative
+            angle = np.where(cross_dot_product < 0, -angle, angle)
 
-        # If the dot product is negative then the rotation angle is negative
-        if cross_dot_product < 0:
-            angle = -angle
+            # Calculate the angle difference between the rotation limits and the angle.
+            # Angles within the limits (or NaN) have a zero delta
+            rot_limit_min = m.radians(virtual_bones[bone]['rot_limit_min_' + axis])
+            rot_limit_max = m.radians(virtual_bones[bone]['rot_limit_max_' + axis])
+            rot_delta = np.where(angle < rot_limit_min, rot_limit_min - angle,
+                                 np.where(angle > rot_limit_max, rot_limit_max - angle, 0))
 
-        # Check if the angle is within the rotation limit values.
-        # If it is outside, rotate the bone tail empty around the cross product
-        # so the angle is on the closest rotation limit.
-        # Rotate the bone tail children by the same delta recursively.
-        rot_delta = 0
-
-        # Calculate the angle difference between the rotation limit and the x_angle
-        if angle < m.radians(virtual_bones[bone]['rot_limit_min_' + axis]):
-            rot_delta = m.radians(virtual_bones[bone]['rot_limit_min_' + axis]) - angle
-        elif angle > m.radians(virtual_bones[bone]['rot_limit_max_' + axis]):
-            rot_delta = m.radians(virtual_bones[bone]['rot_limit_max_' + axis]) - angle
-
-        # Adjust the rotation delta according to the dot product
-        if cross_dot_product < 0:
-            rot_delta = -rot_delta
+            # Adjust the rotation delta according to the dot product
+            rot_delta = np.where(cross_dot_product < 0, -rot_delta, rot_delta)
 
         return rot_delta
 
     # Get the scene context
     scene = bpy.context.scene
 
-    for frame in range (scene.frame_start, scene.frame_end):
+    # Update the empties global positions of all the frames
+    refresh_empty_positions(position_reference='global')
 
-        # Set scene frame
-        scene.frame_set(frame)
+    # Working copy of the global positions where the rotations are applied
+    positions = empty_positions.data.copy()
 
-        # Calculate the hand bones origin axes
-        for side in ['left', 'right']:
-            # y_axis
-            hand_y_axis = bpy.data.objects[side + '_hand_middle'].matrix_world.translation - bpy.data.objects[side + '_wrist'].matrix_world.translation
-            
-            # z_axis
-            hand_to_thumb_cmc = bpy.data.objects[side + '_hand_thumb_cmc'].matrix_world.translation - bpy.data.objects[side + '_wrist'].matrix_world.translation
-            hand_z_axis = hand_to_thumb_cmc - hand_y_axis * (hand_y_axis.dot(hand_to_thumb_cmc) / hand_y_axis.length_squared)
+    # Dictionary with the (n_frames, 3) x, y, z axes arrays of the hand and fingers bones
+    bone_axes = {}
 
-            # x_axis as the orthogonal vector of the y_axis and z_axis
-            hand_x_axis = mathutils.Vector(hand_y_axis.cross(hand_z_axis))
+    # Calculate the hand bones origin axes
+    for side in ['left', 'right']:
+        wrist_position = positions[empty_positions.index[side + '_wrist']]
 
-            # Save the vectors in the virtual_bones dictionary
-            virtual_bones['hand.' + side[0].upper()]['bone_x_axis'] = mathutils.Vector(hand_x_axis)
-            virtual_bones['hand.' + side[0].upper()]['bone_y_axis'] = mathutils.Vector(hand_y_axis)
-            virtual_bones['hand.' + side[0].upper()]['bone_z_axis'] = mathutils.Vector(hand_z_axis)
+        # y_axis
+        hand_y_axis = positions[empty_positions.index[side + '_hand_middle']] - wrist_position
 
-        # Iterate through the virtual bones dictionary and add constraints if the bone has the finger category
-        for bone in virtual_bones:
+        # z_axis
+        hand_to_thumb_cmc = positions[empty_positions.index[side + '_hand_thumb_cmc']] - wrist_position
+        with np.errstate(invalid='ignore', divide='ignore'):
+            hand_z_axis = hand_to_thumb_cmc - hand_y_axis * (np.einsum('ij,ij->i', hand_y_axis, hand_to_thumb_cmc) / np.einsum('ij,ij->i', hand_y_axis, hand_y_axis))[:, np.newaxis]
 
-            # If the bone has the hands or fingers category then calculate its origin axes based on its parent bone's axes
-            if virtual_bones[bone]['category'] in ['hands', 'fingers']:
-                
-                calculate_bone_axes_from_parent(bone)
+        # x_axis as the orthogonal vector of the y_axis and z_axis
+        hand_x_axis = np.cross(hand_y_axis, hand_z_axis)
+
+        # Save the axes arrays
+        bone_axes['hand.' + side[0].upper()] = {'x': hand_x_axis, 'y': hand_y_axis, 'z': hand_z_axis}
+
+    # Iterate through the virtual bones dictionary and add constraints if the bone has the finger category
+    for bone in virtual_bones:
+
+        # If the bone has the hands or fingers category then calculate its origin axes based on its parent bone's axes
+        if virtual_bones[bone]['category'] in ['hands', 'fingers']:
+
+            calculate_bone_axes_from_parent(bone)
 
-                # If the bone has the fingers category then calculate its origin axes based on its parent bone's axes and rotate the tail empty (and its children) to meet the constraints
-                if virtual_bones[bone]['category'] == 'fingers':
+            # If the bone has the fingers category then rotate the tail empty (and its children) to meet the constraints
+            if virtual_bones[bone]['category'] == 'fingers':
 
-                    parent_bone = virtual_bones[bone]['parent_bone']
+                parent_bone = virtual_bones[bone]['parent_bone']
 
-                    for axis in ['x', 'z']:
+                for axis in ['x', 'z']:
 
-                        # Get the rotation delta
-                        rot_delta = get_rot_delta(bone, axis)
-                        
-                        # If the rot_delta is different than 0 then rotate the bone tail empty
-                        if rot_delta != 0:
-                            
-                            # Calculate the rotation matrix axis as the cross products of the bone and parent axes
-                            matrix_axis = mathutils.Vector(virtual_bones[parent_bone]['bone_' + axis + '_axis'].cross(virtual_bones[bone]['bone_' + axis + '_axis']))
-                            matrix_axis.normalize()
-                            
-                            # Get the rotation matrix
-                            rot_matrix = mathutils.Matrix.Rotation(rot_delta, 4, matrix_axis)
+                    # Get the rotation deltas
+                    rot_delta = get_rot_delta(bone, axis)
 
-                            # Rotate the virtual bone tail empty
-                            rotate_virtual_bone(virtual_bones[bone]['tail'], bpy.data.objects[virtual_bones[bone]['head']].matrix_world.translation, rot_matrix)
+                    # Get the frames where the rot_delta is different than 0
+                    rotated_frames = np.flatnonzero(rot_delta != 0)
+                    if len(rotated_frames) == 0:
+                        continue
 
-                            # Recalculate the bone's y axis
-                            bone_y_axis = mathutils.Vector(bpy.data.objects[virtual_bones[bone]['tail']].matrix_world.translation - bpy.data.objects[virtual_bones[bone]['head']].matrix_world.translation)
+                    # Calculate the rotation matrices axes as the cross products of the bone and parent axes
+                    matrix_axes = np.cross(bone_axes[parent_bone][axis][rotated_frames], bone_axes[bone][axis][rotated_frames])
 
-                            # Calculate the difference between the bone's y axis and its parent bone's y axis
-                            rotation_quat = virtual_bones[virtual_bones[bone]['parent_bone']]['bone_y_axis'].rotation_difference(bone_y_axis)
+                    # Get the rotation matrices
+                    rot_matrices = get_rotation_matrices(matrix_axes, rot_delta[rotated_frames])
 
-                            # Rotate the parent x and z axes to get the bones local x and z axes
-                            bone_x_axis = virtual_bones[virtual_bones[bone]['parent_bone']]['bone_x_axis'].copy()
-                            bone_x_axis.rotate(rotation_quat)
-                            bone_z_axis = virtual_bones[virtual_bones[bone]['parent_bone']]['bone_z_axis'].copy()
-                            bone_z_axis.rotate(rotation_quat)
+                    # Rotate the virtual bone tail empty and its children around the bone head empty
+                    rotate_virtual_bone_timeline(virtual_bones[bone]['tail'],
+                                                 positions[empty_positions.index[virtual_bones[bone]['head']], rotated_frames],
+                                                 rot_matrices,
+                                                 rotated_frames,
+                                                 positions,
+                                                 write=False)
 
-                            # Save the vectors in the virtual_bones dictionary
-                            virtual_bones[bone]['bone_x_axis'] = mathutils.Vector(bone_x_axis)
-                            virtual_bones[bone]['bone_y_axis'] = mathutils.Vector(bone_y_axis)
-                            virtual_bones[bone]['bone_z_axis'] = mathutils.Vector(bone_z_axis)
+                    # Recalculate the bone's axes
+                    calculate_bone_axes_from_parent(bone)
 
-    # Reset the scene frame
-    scene.frame_set(scene.frame_start)
+    # Save the last frame axes in the virtual_bones dictionary
+    for bone in bone_axes:
+        for axis in ['x', 'y', 'z']:
+            virtual_bones[bone]['bone_' + axis + '_axis'] = mathutils.Vector(bone_axes[bone][axis][-1])
 
+    # Write the position deltas of the rotated empties once on their location curves
+    frames = np.arange(scene.frame_start, scene.frame_start + empty_positions.n_frames)
+    translate_global_positions(empty_positions.names, positions - empty_positions.data, frames)
 
 # Function to apply different butterworth filters to the empty positions
 def apply_butterworth_filters(global_filter_categories: list=[],
@@ -960,66 +1196,53 @@ def apply_butterworth_filters(global_filter_categories: list=[],
     for object in bpy.data.objects:
         object.select_set(False)
 
+    # Get the scene frame rate as the filters sample rate
+    fps = scene.render.fps / scene.render.fps_base
+
+    # Skip the categories with a cutoff frequency that is not below half
+    # the sample rate (it can't be designed) before changing any curve
+    skipped_categories = []
+    for filter_type, categories, cutoff_frequencies in (('global', global_filter_categories, global_cutoff_frequencies),
+                                                        ('local', local_filter_categories, local_cutoff_frequencies)):
+        for category in categories:
+            if cutoff_frequencies[category] >= fps / 2:
+                skipped_categories.append(filter_type + ' ' + category + ' (' + str(cutoff_frequencies[category]) + ' Hz)')
+    if len(skipped_categories) > 0:
+        print('Cutoff frequency not below half the scene frame rate (' + str(fps / 2) + ' Hz). Skipping: ' + ', '.join(skipped_categories))
+
+    global_filter_categories = [category for category in global_filter_categories
+                                if global_cutoff_frequencies[category] < fps / 2]
+    local_filter_categories = [category for category in local_filter_categories
+                               if local_cutoff_frequencies[category] < fps / 2]
+
     # Apply global filters
     if len(global_filter_categories) > 0:
-        
-        # Check if all the categories have the same cutoff frequency
-        if all(value == list(global_cutoff_frequencies.values())[0] for value in global_cutoff_frequencies.values()):
-            # Select all the empties that are in the categories
-            for empty in empties_dict:
-                if empties_dict[empty]['category'] in global_filter_categories:
-                    # Select the empty
-                    bpy.data.objects[empty].select_set(True)
-
-            # Save the current area
-            current_area = bpy.context.area.type
 
-            # Change the current area to the graph editor
-            bpy.context.area.type = "GRAPH_EDITOR"
+        # Group the categories by cutoff frequency so each frequency is
+        # applied with one filter call over all its empties curves
+        cutoff_categories = {}
+        for category in global_filter_categories:
+            cutoff_categories.setdefault(global_cutoff_frequencies[category], []).append(category)
+
+        for cutoff_frequency, categories in cutoff_categories.items():
+            # Get the empties that are in the categories
+            filtered_empties = [empty for empty in empties_dict
+                                if empties_dict[empty]['category'] in categories
+                                and empty in bpy.data.objects]
+
+            # Get the location fcurves of the empties
+            fcurves = []
+            for empty in filtered_empties:
+                empty_fcurves = empties_hierarchy.fcurves(empty)
+                if empty_fcurves is not None:
+                    fcurves += empty_fcurves
 
             # Apply the butterworth filter
-            bpy.ops.graph.butterworth_smooth(cutoff_frequency=list(global_cutoff_frequencies.values())[0],
-                                            filter_order=4,
-                                            samples_per_frame=1,
-                                            blend=1.0,
-                                            blend_in_out=1)
-            
-            # Restore the area
-            bpy.context.area.type = current_area
-
-            # Deselect all objects
-            for object in bpy.data.objects:
-                object.select_set(False)
-
-        else:
-            #  Iterate through the categories dictionary
-            for category in global_filter_categories:
-                # Iterate through the empties_dict
-                for empty in empties_dict:
-                    # If the empty is in the category
-                    if empties_dict[empty]['category'] == category:
-                        # Select the empty
-                        bpy.data.objects[empty].select_set(True)
-
-                # Save the current area
-                current_area = bpy.context.area.type
-
-                # Change the current area to the graph editor
-                bpy.context.area.type = "GRAPH_EDITOR"
-
-                # Apply the butterworth filter
-                bpy.ops.graph.butterworth_smooth(cutoff_frequency=global_cutoff_frequencies[category],
-                                                filter_order=4,
-                                                samples_per_frame=1,
-                                                blend=1.0,
-                                                blend_in_out=1)
-                
-                # Restore the area
-                bpy.context.area.type = current_area
+            apply_butterworth_to_fcurves(fcurves, cutoff_frequency, fps, filter_order=4, blend=1.0, blend_in_out=1)
 
-                # Deselect all objects
-                for object in bpy.data.objects:
-                    object.select_set(False)
+            # Record the change for the positions refresh
+            for empty in filtered_empties:
+                empty_positions.mark_changed(empty, scene.frame_start, scene.frame_end)
 
     # Apply local filters
     if len(local_filter_categories) > 0:
@@ -1027,20 +1250,17 @@ def apply_butterworth_filters(global_filter_categories: list=[],
         # Iterate through the local filter categories
         for category in local_filter_categories:
 
-            # Update the empties position dictionary
-            update_empty_positions()
-
-            # Prepare the butterworth filter parameters
-            normalized_cutoff = local_cutoff_frequencies[category] / (0.5 * 60)
+            # Update the positions of the empties changed since the
+            # previous category
+            refresh_empty_positions()
 
-            # Create Butterworth filter coefficients
-            b, a = butter(4, normalized_cutoff, btype='low', analog=False, output='ba')
-
-            # Iterate through the empties_dict
+            # Get the empties of the category and their filter origins.
+            # Replace the side prefix of the origin with the empty's side
+            filtered_empties = []
+            filter_origins = []
             for empty in empties_dict:
                 # If the empty is in the category
                 if empties_dict[empty]['category'] == category:
-                    #  Get the origin of the filter. Replace the side prefix with the empty's side
                     filter_origin = local_filter_origins[category]
                     if 'side' in filter_origin:
                         if 'right' in empty:
@@ -1048,30 +1268,44 @@ def apply_butterworth_filters(global_filter_categories: list=[],
                         elif 'left' in empty:
                             filter_origin = filter_origin.replace('side', 'left')
 
-                    # Get the local position lists as the difference between the empty and filter origin for each frame
-                    local_x = [empty_pos_x - filter_origin_pos_x for empty_pos_x, filter_origin_pos_x in zip(empty_positions[empty]['x'], empty_positions[filter_origin]['x'])]
-                    local_y = [empty_pos_y - filter_origin_pos_y for empty_pos_y, filter_origin_pos_y in zip(empty_positions[empty]['y'], empty_positions[filter_origin]['y'])]
-                    local_z = [empty_pos_z - filter_origin_pos_z for empty_pos_z, filter_origin_pos_z in zip(empty_positions[empty]['z'], empty_positions[filter_origin]['z'])]
-
-                    # Filter each position delta list
-                    filtered_local_x = filtfilt(b, a, local_x)
-                    filtered_local_y = filtfilt(b, a, local_y)
-                    filtered_local_z = filtfilt(b, a, local_z)
-
-                    # Translate the empty in the animation location curve
-                    for frame_index in range(scene.frame_start, len(filtered_local_x)):
-                        # Get the delta vector between the unfiltered and filtered local position
-                        delta_pos = [filtered_local_x[frame_index] - local_x[frame_index],
-                                     filtered_local_y[frame_index] - local_y[frame_index],
-                                     filtered_local_z[frame_index] - local_z[frame_index]]
-                        # Check if the filtered delta is not equal to the [0, 0, 0] vector
-                        if delta_pos != [0, 0, 0]:
-                            # Translate the empty
-                            translate_empty(empties_dict, empty, frame_index, delta_pos, recursivity=False)
+                    if empty in empty_positions and filter_origin in empty_positions:
+                        filtered_empties.append(empty)
+                        filter_origins.append(filter_origin)
+
+            if len(filtered_empties) == 0:
+                continue
+
+            # Get the (n_empties, n_frames, 3) local positions as the difference between each empty and its filter origin
+            local_positions = empty_positions.gather(filtered_empties) - empty_positions.gather(filter_origins)
+
+            # Filter all the local position channels of the category with one call
+            filtered_local_positions = filter_channels(
+                local_positions.transpose(0, 2, 1).reshape(-1, empty_positions.n_frames),
+                get_butterworth_sos(4, local_cutoff_frequencies[category], fps),
+            ).reshape(len(filtered_empties), 3, -1).transpose(0, 2, 1)
+
+            # Get the delta vectors between the unfiltered and filtered local positions
+            position_deltas = filtered_local_positions - local_positions
+
+            # Translate each empty in its animation location curves
+            frames = np.arange(scene.frame_start, scene.frame_start + empty_positions.n_frames)
+            for empty, empty_deltas in zip(filtered_empties, position_deltas):
+                # Check if any filtered delta is not equal to the [0, 0, 0] vector
+                changed_frames = frames[np.any(empty_deltas != 0, axis=1)]
+                if len(changed_frames) == 0:
+                    continue
+                if translate_local_positions(bpy.data.objects[empty],
+                                             frames,
+                                             empty_deltas,
+                                             empties_hierarchy.fcurves(empty)):
+                    # Record the change for the positions refresh
+                    empty_positions.mark_changed(empty, int(changed_frames[0]), int(changed_frames[-1]))
 
     # Reduce the bone length dispersion
     reduce_bone_length_dispersion(interval_variable=interval_variable, interval_factor=interval_factor, body_height=body_height, target_bone='')
 
+    return skipped_categories
+
 def add_rig(add_rig_method: str='using_rigify',
             armature_name: str='armature_freemocap',
             pose_name: str='freemocap_tpose',
@@ -2041,31 +2275,59 @@ def add_rig(add_rig_method: str='using_rigify',
                                                 y2=0.25,
                                                 y3=1)
 
-        # Loop through the scene frames and calculate the pole angle for each IK constraint to animate the pole_angle variable
-        for frame in range(scene.frame_start, scene.frame_end + 1):
-            bpy.context.scene.frame_set(frame)
-
-            for bone in ik_pole_bones:
-                #  Calculate the pole bone position
-                pole_bone_position = calculate_ik_pole_position(ik_pole_bones[bone]['base_marker'],
-                                                                ik_pole_bones[bone]['pole_marker'],
-                                                                ik_pole_bones[bone]['target_marker'],
-                                                                ik_pole_bones[bone]['aux_markers'],
-                                                                ik_transition_threshold,
-                                                                ik_quadratic_function)
-
-                rig.pose.bones[bone].location = pole_bone_position
-                rig.pose.bones[bone].keyframe_insert(data_path="location")
-
-        # Reset the scene frame to the start
-        scene.frame_set(scene.frame_start)
+        # Get the global positions of the limb markers of the IK constraints for all the scene frames
+        frames = np.arange(scene.frame_start, scene.frame_end + 1)
+        limb_markers = list(dict.fromkeys(marker for bone in ik_pole_bones
+                                          for marker in [ik_pole_bones[bone]['base_marker'],
+                                                         ik_pole_bones[bone]['pole_marker'],
+                                                         ik_pole_bones[bone]['target_marker']]
+                                                         + ik_pole_bones[bone]['aux_markers']))
+        limb_marker_positions = read_world_positions([bpy.data.objects[marker] for marker in limb_markers], frames)
+
+        # If the markers positions need the depsgraph evaluation, loop through the scene frames to get them
+        if limb_marker_positions is None:
+            limb_marker_positions = np.empty((len(limb_markers), len(frames), 3))
+            for frame_index, frame in enumerate(frames):
+                scene.frame_set(frame)
+                limb_marker_positions[:, frame_index] = [tuple(bpy.data.objects[marker].matrix_world.translation) for marker in limb_markers]
+
+            # Reset the scene frame to the start
+            scene.frame_set(scene.frame_start)
+
+        limb_marker_positions = dict(zip(limb_markers, limb_marker_positions))
+
+        # Make sure the rig has an action for the pole bones animation
+        if rig.animation_data is None:
+            rig.animation_data_create()
+        if rig.animation_data.action is None:
+            rig.animation_data.action = bpy.data.actions.new(rig.name + 'Action')
+
+        for bone in ik_pole_bones:
+            #  Calculate the pole bone positions of all the frames to animate the pole target
+            pole_bone_positions = calculate_ik_pole_positions(limb_marker_positions[ik_pole_bones[bone]['base_marker']],
+                                                              limb_marker_positions[ik_pole_bones[bone]['pole_marker']],
+                                                              limb_marker_positions[ik_pole_bones[bone]['target_marker']],
+                                                              [limb_marker_positions[marker] for marker in ik_pole_bones[bone]['aux_markers']],
+                                                              ik_transition_threshold,
+                                                              ik_quadratic_function)
+
+            # Write the pole bone location keyframes in bulk
+            for axis in range(3):
+                write_fcurve_keyframes(rig.animation_data.action,
+                                       'pose.bones["' + bone + '"].location',
+                                       axis,
+                                       frames,
+                                       pole_bone_positions[:, axis],
+                                       group=bone)
 
     ### Bake animation to the rig ###
     # Get the empties ending frame
     ending_frame = int(bpy.data.actions[0].frame_range[1])
-    # Bake animation
+    # Bake animation evaluating the constraints directly. Use the bake
+    # operator if the rig has constraints that can't be evaluated directly
     # bpy.ops.nla.bake(frame_start=0, frame_end=ending_frame, bake_types={'POSE'})
-    bpy.ops.nla.bake(frame_start=0, frame_end=ending_frame, only_selected=False, visual_keying=True, clear_constraints=clear_constraints, bake_types={'POSE'})
+    if not bake_rig(rig, 0, ending_frame, clear_constraints=clear_constraints):
+        bpy.ops.nla.bake(frame_start=0, frame_end=ending_frame, only_selected=False, visual_keying=True, clear_constraints=clear_constraints, bake_types={'POSE'})
 
     # Change back to Object Mode
     bpy.ops.object.mode_set(mode='OBJECT')
@@ -2811,8 +3073,13 @@ def add_mesh_to_rig(body_mesh_mode: str="custom",
     else:
         print("Unknown add mesh mode")
 
+# Function to export the rig and the mesh to a FBX file. Returns an error
+# message if the export was cancelled
 def export_fbx(self: Operator,
-               fbx_type: str='standard'):
+               fbx_type: str='standard',
+               takes_source: str='current',
+               frame_ranges: str='',
+               takes_output: str='single_file'):
 
     # Deselect all
     bpy.ops.object.select_all(action='DESELECT')
@@ -2837,6 +3104,20 @@ def export_fbx(self: Operator,
 
     bpy.data.objects['skelly_mesh'].select_set(True)
 
+    # Get the takes to export if the export is not of the current action
+    takes = None
+    if takes_source != 'current':
+        try:
+            takes = get_rig_takes(bpy.data.objects['root'], takes_source, frame_ranges)
+            error_message = 'No takes to export' if len(takes) == 0 else None
+        except ValueError as error:
+            error_message = str(error)
+
+        # Restore the rig name and cancel the export if there are no takes
+        if error_message is not None:
+            bpy.data.objects['root'].name = rig_original_name
+            return error_message
+
     # Get the Blender file directory
     file_directory = Path(bpy.data.filepath).parent
 
@@ -2981,7 +3262,7 @@ def export_fbx(self: Operator,
             export_fbx_bin.fbx_data_armature_elements   = fbx_data_armature_elements_blender4
             export_fbx_bin.fbx_data_object_elements     = fbx_data_object_elements_blender4
             export_fbx_bin.fbx_data_bindpose_element    = fbx_data_bindpose_element_blender4
-    
+
     # Simulate the FBX Export Operator Class
     self = type(
         'FMCExportFBX',
@@ -2990,7 +3271,17 @@ def export_fbx(self: Operator,
     )
 
     # Export the FBX file
-    export_fbx_bin.save(self, bpy.context, **export_parameters)
+    if takes is None:
+        export_fbx_bin.save(self, bpy.context, **export_parameters)
+    else:
+        # Export the takes as animation stacks of the FBX file or as
+        # separate FBX files sharing the mesh, skin and bind pose elements
+        export_fbx_takes(export_fbx_bin,
+                         self,
+                         export_parameters,
+                         bpy.data.objects['root'],
+                         takes,
+                         separate_files=takes_output == 'separate_files')
 
     # Restore the modified functions with the saved backups if the FBX type is unreal engine
     if fbx_type == 'unreal_engine':
@@ -3005,6 +3296,96 @@ def export_fbx(self: Operator,
             # Restore the original rig name
             capture_object.name = rig_original_name
 
+# Function to get the (n_frames, 4, 4) armature space pose matrices of the
+# bones of a rig on the frames. The matrices are computed from the bone
+# fcurves of baked rigs, otherwise they are read on each frame
+def get_rig_pose_matrices(rig: bpy.types.Object, frames: np.ndarray) -> dict:
+
+    source_pose = read_source_pose(rig, frames)
+    if source_pose is not None:
+        return get_corrected_source_pose(source_pose, {})
+
+    scene = bpy.context.scene
+    current_frame = scene.frame_current
+
+    # The pose bone matrices are read in column major order
+    pose_bone_count = len(rig.pose.bones)
+    matrices = np.empty((len(frames), pose_bone_count * 16), dtype=np.float32)
+    for frame_index, frame in enumerate(frames):
+        scene.frame_set(int(frame))
+        rig.pose.bones.foreach_get('matrix', matrices[frame_index])
+
+    scene.frame_set(current_frame)
+
+    matrices = matrices.reshape(len(frames), pose_bone_count, 4, 4).transpose(1, 0, 3, 2).astype(np.float64)
+
+    return {pose_bone.name: matrices[pose_bone_index] for pose_bone_index, pose_bone in enumerate(rig.pose.bones)}
+
+# Function to export the animation of the rig as an animation columns file:
+# the bone table and the local quaternion and translation of each bone on
+# each frame, relative to its parent bone (the armature for the root bones).
+# The rest arrays have the rest transforms of the bones in the same space
+def export_animation_columns(compress: bool=False) -> None:
+
+    scene = bpy.context.scene
+
+    # Get the rig
+    rig = None
+    for capture_object in bpy.data.objects:
+        if capture_object.type == "ARMATURE":
+            rig = capture_object
+            break
+
+    if rig is None:
+        print('No rig to export')
+        return
+
+    frames = np.arange(scene.frame_start, scene.frame_end + 1)
+    pose_matrices = get_rig_pose_matrices(rig, frames)
+
+    # Bones with the parents before their children
+    pose_bones = get_ordered_pose_bones(rig)
+    bone_names = [pose_bone.name for pose_bone in pose_bones]
+    bone_indices = {bone_name: bone_index for bone_index, bone_name in enumerate(bone_names)}
+
+    parents = np.full(len(pose_bones), -1, dtype=np.int32)
+    rest_matrices = np.empty((len(pose_bones), 4, 4), dtype=np.float64)
+    quaternions = np.empty((len(frames), len(pose_bones), 4), dtype=np.float32)
+    translations = np.empty((len(frames), len(pose_bones), 3), dtype=np.float32)
+
+    for bone_index, pose_bone in enumerate(pose_bones):
+        rest_matrices[bone_index] = get_offset_matrix(pose_bone.bone)
+
+        # Pose matrices relative to the parent pose matrices
+        matrices = pose_matrices[pose_bone.name]
+        if pose_bone.parent is not None:
+            parents[bone_index] = bone_indices[pose_bone.parent.name]
+            matrices = np.linalg.inv(pose_matrices[pose_bone.parent.name]) @ matrices
+
+        locations, bone_quaternions, _ = decompose_matrices(matrices)
+        quaternions[:, bone_index] = bone_quaternions
+        translations[:, bone_index] = locations
+
+    rest_quaternions = matrices_to_quaternions(rest_matrices[:, :3, :3])
+    rest_translations = rest_matrices[:, :3, 3]
+
+    # Get the Blender file directory
+    file_directory = Path(bpy.data.filepath).parent
+
+    export_folder = file_directory / 'animation_columns'
+    export_folder.mkdir(parents=True, exist_ok=True)
+
+    write_animation_columns(export_folder / 'fmc_export.fmcanim',
+                            bone_names,
+                            scene.frame_start,
+                            scene.render.fps / scene.render.fps_base,
+                            {'parents': parents,
+                             'rest_quaternions': rest_quaternions.astype(np.float32),
+                             'rest_translations': rest_translations.astype(np.float32),
+                             'quaternions': quaternions,
+                             'translations': translations},
+                            compress=compress)
+
 def apply_foot_locking(
         target_foot: list=['left_foot', 'right_foot'],
         target_base_markers: list=['foot_index', 'heel'],
@@ -3053,13 +3434,6 @@ def apply_foot_locking(
         y2=ground_level + (z_threshold - ground_level) * 3 / 4,
         y3=z_threshold)
     
-    # Define the error function to be optimized when adjusting the
-    # ankle position
-    def error_function(z_C, x_C, y_C, x_A, y_A, z_A, x_B, y_B, z_B, length_A_to_C, length_B_to_C):
-        error1 = (x_A - x_C)**2 + (y_A - y_C)**2 + (z_A - z_C)**2 - length_A_to_C**2
-        error2 = (x_B - x_C)**2 + (y_B - y_C)**2 + (z_B - z_C)**2 - length_B_to_C**2
-        return error1**2 + error2**2
-    
     # Set the overall_changed_frames variable to save all the frames
     # that were changed for posterior upper body adjustment
     overall_changed_frames = []
@@ -3069,8 +3443,8 @@ def apply_foot_locking(
         if foot not in target_foot:
             continue
 
-        # Variable to save the changed frames for later ankle adjustment
-        changed_frames = []
+        # Variable to save the changed frame indices for later ankle adjustment
+        changed_frames_mask = np.zeros(last_frame, dtype=bool)
         # Update the correspondent virtual bones info
         update_virtual_bones_info(
             target_bone=foot_locking_markers[foot]['bones'][0])
@@ -3083,207 +3457,163 @@ def apply_foot_locking(
                                    for marker in target_base_markers]:
                 continue
 
-            # Set the initial variables
-            frame = 0
-            window = 0
-            final_attenuation_aux = final_attenuation_count
-
-            # Iterate through the animation frames
-            while frame < last_frame:
-                if empty_positions[base_marker]['z'][frame] < z_threshold:
-                    # Marker is under threshold the next frames are checked to conform the window
-                    window += 1
-
-                    for following_frame in range(frame + 1, last_frame):
-                        if empty_positions[base_marker]['z'][following_frame] < z_threshold:
-                            # Following marker is under threshold, the window is increased
-                            window += 1
-                        if following_frame == last_frame - 1 or empty_positions[base_marker]['z'][following_frame] >= z_threshold:
-                            # Following marker is the last one or is not under threshold, the window size is checked
-                            if window < frame_window_min_size:
-                                # Window is not big enough. Break the cycle and continue from the frame that was over threshold
-                                # Before continuing, make sure that no marker is below the ground level
-                                for window_frame in range(frame, frame + window):
-                                    if empty_positions[base_marker]['z'][window_frame] < ground_level:
-                                        # Marker's z position is forced to the ground level
-                                        # Get the delta vector on the global z axis
-                                        delta_vector = mathutils.Vector([0, 0, ground_level - empty_positions[base_marker]['z'][window_frame]])
-                                        # Adjust the delta vector to the empty parent axis
-                                        delta_vector_adjusted = delta_vector @ empty_parent_matrix
-                                        try:
-                                            # Change the marker's local position with the adjusted delta vector
-                                            bpy.data.objects[base_marker].animation_data.action.fcurves[0].keyframe_points[start_frame + window_frame].co[1] += delta_vector_adjusted[0]
-                                            bpy.data.objects[base_marker].animation_data.action.fcurves[1].keyframe_points[start_frame + window_frame].co[1] += delta_vector_adjusted[1]
-                                            bpy.data.objects[base_marker].animation_data.action.fcurves[2].keyframe_points[start_frame + window_frame].co[1] += delta_vector_adjusted[2]
-                                            changed_frames.append(start_frame + window_frame)
-                                        except AttributeError as e:
-                                            print('error:' + str(e))
-
-                                frame = following_frame
-                                window = 0
-                                break
-                            else:
-                                # Window is big enough so the locking logic is applied
-                                # Initial attenuation is applied
-                                for locking_frame in range(frame, frame + initial_attenuation_count):
-                                    # Get the z position from the initial attenuation function
-                                    new_z_position = round(initial_attenuation(locking_frame - frame), 5)
-                                    # Get the delta vector on the global z axis
-                                    delta_vector = mathutils.Vector([0, 0, new_z_position - empty_positions[base_marker]['z'][locking_frame]])
-                                    # Adjust the delta vector to the empty parent axis
-                                    delta_vector_adjusted = delta_vector @ empty_parent_matrix
-                                    try:
-                                        # Change the marker's local position with the adjusted delta vector
-                                        bpy.data.objects[base_marker].animation_data.action.fcurves[0].keyframe_points[start_frame + locking_frame].co[1] += delta_vector_adjusted[0]
-                                        bpy.data.objects[base_marker].animation_data.action.fcurves[1].keyframe_points[start_frame + locking_frame].co[1] += delta_vector_adjusted[1]
-                                        bpy.data.objects[base_marker].animation_data.action.fcurves[2].keyframe_points[start_frame + locking_frame].co[1] += delta_vector_adjusted[2]
-                                        changed_frames.append(start_frame + locking_frame)
-                                    except Exception as e:
-                                        # Empty does not exist or does not have animation data
-                                        print('error:' + str(e))
-
-                                # Check if the window ends at the last frame. If so the final attenuation aux variable is set to zero
-                                if following_frame == last_frame - 1:
-                                    final_attenuation_aux = 0
-
-                                # If the lock_xy_at_ground_level is True, save the x and y position of the first frame of the next loop
-                                if lock_xy_at_ground_level:
-                                    ground_level_x = bpy.data.objects[base_marker].animation_data.action.fcurves[0].keyframe_points[start_frame + frame + initial_attenuation_count].co[1]
-                                    ground_level_y = bpy.data.objects[base_marker].animation_data.action.fcurves[1].keyframe_points[start_frame + frame + initial_attenuation_count].co[1]
-                                
-                                # For the frames between the initial attenuation and the final attenuation the z position is set to the ground level
-                                for locking_frame in range(frame + initial_attenuation_count, frame + (window - final_attenuation_aux)):
-                                    # Get the delta vector on the global z axis consider x and y position if lock_xy_at_ground_level is True
-                                    if lock_xy_at_ground_level:
-                                        delta_vector = mathutils.Vector([ground_level_x - empty_positions[base_marker]['x'][locking_frame],
-                                                                        ground_level_y - empty_positions[base_marker]['y'][locking_frame],
-                                                                        ground_level - empty_positions[base_marker]['z'][locking_frame]])
-                                    else:
-                                        delta_vector = mathutils.Vector([0, 0, ground_level - empty_positions[base_marker]['z'][locking_frame]])
-
-                                    # Adjust the delta vector to the empty parent axis
-                                    delta_vector_adjusted = delta_vector @ empty_parent_matrix
-
-                                    try:
-                                    # Change the marker's local position with the adjusted delta vector
-                                        bpy.data.objects[base_marker].animation_data.action.fcurves[0].keyframe_points[start_frame + locking_frame].co[1] += delta_vector_adjusted[0]
-                                        bpy.data.objects[base_marker].animation_data.action.fcurves[1].keyframe_points[start_frame + locking_frame].co[1] += delta_vector_adjusted[1]
-                                        bpy.data.objects[base_marker].animation_data.action.fcurves[2].keyframe_points[start_frame + locking_frame].co[1] += delta_vector_adjusted[2]
-                                        changed_frames.append(start_frame + locking_frame)
-                                    except AttributeError as e:
-                                        # Empty does not exist or does not have animation data
-                                        print('error:' + str(e))
-
-                                # Final attenuation is applied if final_attenuation_count is greater than zero
-                                for locking_frame in range(frame + (window - final_attenuation_aux), frame + window):
-                                    # Get the z position from the final attenuation function
-                                    new_z_position = round(final_attenuation(locking_frame - (frame + window - final_attenuation_aux)), 5)
-                                    # Get the delta vector on the global z axis
-                                    delta_vector = mathutils.Vector([0, 0, new_z_position - empty_positions[base_marker]['z'][locking_frame]])
-                                    # Adjust the delta vector to the empty parent axis
-                                    delta_vector_adjusted = delta_vector @ empty_parent_matrix
-
-                                    try:
-                                        # Change the marker's local position with the adjusted delta vector
-                                        bpy.data.objects[base_marker].animation_data.action.fcurves[0].keyframe_points[start_frame + locking_frame].co[1] += delta_vector_adjusted[0]
-                                        bpy.data.objects[base_marker].animation_data.action.fcurves[1].keyframe_points[start_frame + locking_frame].co[1] += delta_vector_adjusted[1]
-                                        bpy.data.objects[base_marker].animation_data.action.fcurves[2].keyframe_points[start_frame + locking_frame].co[1] += delta_vector_adjusted[2]
-                                        changed_frames.append(start_frame + locking_frame)
-                                    except Exception as e:
-                                        # Empty does not exist or does not have animation data
-                                        print('error:' + str(e))
-                                    
-                                frame = following_frame
-                                window = 0
-                                break
-
-                frame += 1
+            base_marker_positions = empty_positions.positions(base_marker)
+            base_marker_z = base_marker_positions[:, 2]
+
+            # Array to accumulate the global position deltas of the marker
+            # and mask of the frames changed by them
+            position_deltas = np.zeros((last_frame, 3))
+            marker_changed_frames = np.zeros(last_frame, dtype=bool)
+
+            # Get the windows of consecutive frames with the marker under the threshold
+            with np.errstate(invalid='ignore'):
+                under_threshold = base_marker_z < z_threshold
+            window_starts, window_ends = get_true_runs(under_threshold)
+
+            # A window that starts at the last frame is not checked
+            checked_windows = window_starts < last_frame - 1
+            window_starts = window_starts[checked_windows]
+            window_ends = window_ends[checked_windows]
+            window_sizes = window_ends - window_starts
+
+            # Windows that are not big enough. Make sure that no marker is below the ground level
+            short_windows = window_sizes < frame_window_min_size
+            window_frames, _, _ = get_range_indices(window_starts[short_windows], window_ends[short_windows])
+            with np.errstate(invalid='ignore'):
+                below_ground_frames = window_frames[base_marker_z[window_frames] < ground_level]
+            # Marker's z position is forced to the ground level
+            position_deltas[below_ground_frames, 2] += ground_level - base_marker_z[below_ground_frames]
+            marker_changed_frames[below_ground_frames] = True
+
+            # Windows that are big enough so the locking logic is applied
+            window_starts = window_starts[~short_windows]
+            window_ends = window_ends[~short_windows]
+            window_sizes = window_sizes[~short_windows]
+
+            # Windows that end at the last frame have no final attenuation
+            final_attenuation_counts = np.where(window_ends >= last_frame - 1, 0, final_attenuation_count)
+
+            # Initial attenuation frames get the z position from the initial attenuation function
+            locking_frames, _, offsets = get_range_indices(window_starts, window_starts + initial_attenuation_count)
+            new_z_positions = np.round(initial_attenuation(offsets), 5)
+            valid_frames = locking_frames < last_frame
+            locking_frames = locking_frames[valid_frames]
+            np.add.at(position_deltas[:, 2], locking_frames, new_z_positions[valid_frames] - base_marker_z[locking_frames])
+            marker_changed_frames[locking_frames] = True
+
+            # For the frames between the initial attenuation and the final attenuation the z position is set to the ground level
+            locking_frames, window_index, _ = get_range_indices(window_starts + initial_attenuation_count,
+                                                                window_starts + window_sizes - final_attenuation_counts)
+            np.add.at(position_deltas[:, 2], locking_frames, ground_level - base_marker_z[locking_frames])
+            # If lock_xy_at_ground_level is True, the x and y positions are
+            # locked to the ones of the first frame after the initial attenuation
+            if lock_xy_at_ground_level and len(locking_frames) != 0:
+                base_marker_local_positions = read_local_positions(bpy.data.objects[base_marker],
+                                                                   np.arange(start_frame, end_frame))
+                if base_marker_local_positions is None:
+                    base_marker_local_positions = base_marker_positions
+                ground_level_frames = np.minimum(window_starts + initial_attenuation_count, last_frame - 1)[window_index]
+                ground_level_xy = base_marker_local_positions[ground_level_frames, :2]
+                np.add.at(position_deltas[:, :2], locking_frames, ground_level_xy - base_marker_positions[locking_frames, :2])
+            marker_changed_frames[locking_frames] = True
+
+            # Final attenuation frames get the z position from the final attenuation function
+            locking_frames, _, offsets = get_range_indices(window_starts + window_sizes - final_attenuation_counts,
+                                                           window_starts + window_sizes)
+            new_z_positions = np.round(final_attenuation(offsets), 5)
+            valid_frames = locking_frames >= 0
+            locking_frames = locking_frames[valid_frames]
+            np.add.at(position_deltas[:, 2], locking_frames, new_z_positions[valid_frames] - base_marker_z[locking_frames])
+            marker_changed_frames[locking_frames] = True
+
+            if not np.any(marker_changed_frames):
+                continue
+
+            # Adjust the delta vectors to the empty parent axis
+            position_deltas_adjusted = position_deltas @ np.array(empty_parent_matrix)[:3, :3]
+
+            # Change the marker's local positions with the adjusted delta vectors
+            if translate_local_positions(bpy.data.objects[base_marker],
+                                         start_frame + np.flatnonzero(marker_changed_frames),
+                                         position_deltas_adjusted[marker_changed_frames],
+                                         empties_hierarchy.fcurves(base_marker)):
+                changed_frames_mask |= marker_changed_frames
+            else:
+                # Empty does not exist or does not have animation data
+                print('error: ' + base_marker + ' does not have animation data')
+
+        # Get the changed frames
+        changed_frames = list(start_frame + np.flatnonzero(changed_frames_mask))
+
+        # Record the changes of the base markers
+        if len(changed_frames) != 0:
+            for base_marker in foot_locking_markers[foot]['base']:
+                empty_positions.mark_changed(base_marker, min(changed_frames), max(changed_frames))
 
         # Update the empties position dictionary with the global positions
-        # for the two base markers
-        update_empty_positions(
-            target_empty=[foot_locking_markers[foot]['base'][0], foot_locking_markers[foot]['base'][1]],
-            position_reference='global'
-        )
+        # of the changed base markers
+        refresh_empty_positions(position_reference='global')
 
         # Adjust the ankle marker position in the previous modified frames so the median
         # ankle-foot_index and ankle-heel distances are equal to the median lengths before the change
-        for changed_frame in list(set(changed_frames)):
-            # Get the initial position variables of the ankle z position's optimization problem
-            base_marker_0_x = empty_positions[foot_locking_markers[foot]['base'][0]]['x'][changed_frame - start_frame]
-            base_marker_0_y = empty_positions[foot_locking_markers[foot]['base'][0]]['y'][changed_frame - start_frame]
-            base_marker_0_z = empty_positions[foot_locking_markers[foot]['base'][0]]['z'][changed_frame - start_frame]
-            base_marker_1_x = empty_positions[foot_locking_markers[foot]['base'][1]]['x'][changed_frame - start_frame]
-            base_marker_1_y = empty_positions[foot_locking_markers[foot]['base'][1]]['y'][changed_frame - start_frame]
-            base_marker_1_z = empty_positions[foot_locking_markers[foot]['base'][1]]['z'][changed_frame - start_frame]
-
-            ankle_marker_x = empty_positions[foot_locking_markers[foot]['ankle'][0]]['x'][changed_frame - start_frame]
-            ankle_marker_y = empty_positions[foot_locking_markers[foot]['ankle'][0]]['y'][changed_frame - start_frame]
-
-            base_bone_0_distance = virtual_bones[foot_locking_markers[foot]['bones'][0]]['median']
-            base_bone_1_distance = virtual_bones[foot_locking_markers[foot]['bones'][1]]['median']
-
-            #  Get the current ankle z position
-            current_ankle_pos = empty_positions[foot_locking_markers[foot]['ankle'][0]]['z'][changed_frame - start_frame]
-
-            # Set the initial ankle z guess as the actual ankle z
-            # position. If the initial ankle z guess is not higher than
-            # both of the base markers z positions then set the initial
-            # ankle z guess to the highest base marker z position plus
-            # a margin
-            initial_ankle_z_guess = max(current_ankle_pos,
-                                        max([base_marker_0_z,
-                                             base_marker_1_z]) + 0.1)
-                
-            # Use scipy.optimize.minimize to minimize the error function
-            # and find the optimal z coordinate of C
-            result = minimize(error_function,
-                              initial_ankle_z_guess,
-                              args=(ankle_marker_x,
-                                    ankle_marker_y,
-                                    base_marker_0_x,
-                                    base_marker_0_y,
-                                    base_marker_0_z,
-                                    base_marker_1_x,
-                                    base_marker_1_y,
-                                    base_marker_1_z,
-                                    base_bone_0_distance,
-                                    base_bone_1_distance)
-            )
-
-            # Set the new ankle z position
-            # Get the delta vector on the global z axis
-            delta_vector = mathutils.Vector([0, 0, result.x[0] - empty_positions[foot_locking_markers[foot]['ankle'][0]]['z'][changed_frame - start_frame]])
-            # Adjust the delta vector to the empty parent axis
-            delta_vector_adjusted = delta_vector @ empty_parent_matrix
-            try:
-                # Change the marker's local position with the adjusted delta vector
-                bpy.data.objects[foot_locking_markers[foot]['ankle'][0]].animation_data.action.fcurves[0].keyframe_points[changed_frame].co[1] += delta_vector_adjusted[0]
-                bpy.data.objects[foot_locking_markers[foot]['ankle'][0]].animation_data.action.fcurves[1].keyframe_points[changed_frame].co[1] += delta_vector_adjusted[1]
-                bpy.data.objects[foot_locking_markers[foot]['ankle'][0]].animation_data.action.fcurves[2].keyframe_points[changed_frame].co[1] += delta_vector_adjusted[2]
-            except AttributeError as e:
+        # Get the positions of the ankle z position's problem in the changed frames
+        changed_frame_indices = np.array(sorted(set(changed_frames)), dtype=np.intp) - start_frame
+        base_marker_0_positions = empty_positions.positions(foot_locking_markers[foot]['base'][0])[changed_frame_indices]
+        base_marker_1_positions = empty_positions.positions(foot_locking_markers[foot]['base'][1])[changed_frame_indices]
+        ankle_marker_positions = empty_positions.positions(foot_locking_markers[foot]['ankle'][0])[changed_frame_indices]
+
+        base_bone_0_distance = virtual_bones[foot_locking_markers[foot]['bones'][0]]['median']
+        base_bone_1_distance = virtual_bones[foot_locking_markers[foot]['bones'][1]]['median']
+
+        # Set the initial ankle z guess as the actual ankle z
+        # position. If the initial ankle z guess is not higher than
+        # both of the base markers z positions then set the initial
+        # ankle z guess to the highest base marker z position plus
+        # a margin
+        initial_ankle_z_guesses = np.maximum(ankle_marker_positions[:, 2],
+                                             np.maximum(base_marker_0_positions[:, 2],
+                                                        base_marker_1_positions[:, 2]) + 0.1)
+
+        # Find the optimal ankle z coordinates of all the changed frames
+        # with one batched solve of the two bone length constraints
+        new_ankle_z_positions = solve_two_sphere_heights(ankle_marker_positions[:, :2],
+                                                         base_marker_0_positions,
+                                                         base_marker_1_positions,
+                                                         base_bone_0_distance,
+                                                         base_bone_1_distance,
+                                                         initial_ankle_z_guesses)
+
+        # Skip the frames without a solution (NaN marker positions)
+        solved_frames = ~np.isnan(new_ankle_z_positions)
+        solved_frame_numbers = start_frame + changed_frame_indices[solved_frames]
+
+        # Get the ankle delta vectors on the global z axis adjusted to the
+        # empty parent axis
+        ankle_z_deltas = new_ankle_z_positions[solved_frames] - ankle_marker_positions[solved_frames, 2]
+        ankle_deltas_adjusted = ankle_z_deltas[:, np.newaxis] * np.array(empty_parent_matrix)[2, :3]
+
+        # Change the ankle marker's local positions with the adjusted delta vectors
+        # and compensate the knee and the hip markers if knee_hip_compensation_coefficient is not zero
+        translated_markers = [(foot_locking_markers[foot]['ankle'][0], 1)]
+        if knee_hip_compensation_coefficient != 0:
+            translated_markers += [(compensation_marker, knee_hip_compensation_coefficient)
+                                   for compensation_marker in foot_locking_markers[foot]['compensation_markers']]
+
+        for translated_marker, delta_coefficient in translated_markers:
+            fcurves = empties_hierarchy.fcurves(translated_marker)
+            if fcurves is None:
                 # Empty does not exist or does not have animation data
-                print('error:' + str(e))
-
-            # Compensate the knee and the hip markers if knee_hip_compensation_coefficient is not zero
-            if knee_hip_compensation_coefficient != 0:
-                # Get the delta vector on the global z axis
-                ankle_z_delta = mathutils.Vector([0, 0, result.x[0] - current_ankle_pos])
-                # Adjust the ankle z delta to the empty parent axis
-                ankle_z_delta_adjusted = ankle_z_delta @ empty_parent_matrix
-                # Change the compensation markers' z position
-                for compensation_marker in foot_locking_markers[foot]['compensation_markers']:
-                    try:
-                        marker_x_position = bpy.data.objects[compensation_marker].animation_data.action.fcurves[0].keyframe_points[changed_frame].co[1]
-                        marker_y_position = bpy.data.objects[compensation_marker].animation_data.action.fcurves[1].keyframe_points[changed_frame].co[1]
-                        marker_z_position = bpy.data.objects[compensation_marker].animation_data.action.fcurves[2].keyframe_points[changed_frame].co[1]
-
-                        bpy.data.objects[compensation_marker].animation_data.action.fcurves[0].keyframe_points[changed_frame].co[1] = marker_x_position + ankle_z_delta_adjusted[0] * knee_hip_compensation_coefficient
-                        bpy.data.objects[compensation_marker].animation_data.action.fcurves[1].keyframe_points[changed_frame].co[1] = marker_y_position + ankle_z_delta_adjusted[1] * knee_hip_compensation_coefficient
-                        bpy.data.objects[compensation_marker].animation_data.action.fcurves[2].keyframe_points[changed_frame].co[1] = marker_z_position + ankle_z_delta_adjusted[2] * knee_hip_compensation_coefficient
-                    except Exception as e:
-                        # Empty does not exist or does not have animation data
-                        print('error:' + str(e))
+                print('error: ' + translated_marker + ' does not have animation data')
+                continue
+            translate_local_positions(bpy.data.objects[translated_marker],
+                                      solved_frame_numbers,
+                                      ankle_deltas_adjusted * delta_coefficient,
+                                      fcurves)
+
+        # Record the changes of the ankle and compensation markers
+        if len(changed_frames) != 0:
+            for changed_marker in foot_locking_markers[foot]['ankle'] + foot_locking_markers[foot]['compensation_markers']:
+                empty_positions.mark_changed(changed_marker, min(changed_frames), max(changed_frames))
 
         # Update the overall_changed_frames list
         overall_changed_frames += list(set(changed_frames))
@@ -3292,39 +3622,37 @@ def apply_foot_locking(
         # Compensate the upper body markers starting from the hips_center
                     
         # Update the empties position dictionary with the global positions
-        # for the two hip markers
-        update_empty_positions(
-            target_empty=['left_hip', 'right_hip'],
-            position_reference='global'
-        )
-
-        # Iterate through the overall_changed_frames list
-        for changed_frame in list(set(overall_changed_frames)):
-            # Get the new hips_center z coordinate as the average of the
-            # left and right hip z coordinates
-            new_hips_center_z = (empty_positions['left_hip']['z'][changed_frame - start_frame] + empty_positions['right_hip']['z'][changed_frame - start_frame]) / 2
-            # Get the delta vector on the global z axis
-            hips_center_z_delta = mathutils.Vector([0, 0, new_hips_center_z - empty_positions['hips_center']['z'][changed_frame - start_frame]])
-            # Adjust the delta vector to the empty parent axis
-            hips_center_z_delta_adjusted = hips_center_z_delta @ empty_parent_matrix
-
-            try:
-                # Change the marker's local position with the adjusted delta vector
-                bpy.data.objects['hips_center'].animation_data.action.fcurves[0].keyframe_points[changed_frame].co[1] += hips_center_z_delta_adjusted[0]
-                bpy.data.objects['hips_center'].animation_data.action.fcurves[1].keyframe_points[changed_frame].co[1] += hips_center_z_delta_adjusted[1]
-                bpy.data.objects['hips_center'].animation_data.action.fcurves[2].keyframe_points[changed_frame].co[1] += hips_center_z_delta_adjusted[2]
-            except Exception as e:
-                # Empty does not exist or does not have animation data
-                print('error:' + str(e))
-
-            # Recursevely translate the empties from trunk_center
-            translate_empty(
-                empties_dict=empties_dict,
-                empty='trunk_center',
-                frame_index=changed_frame,
-                delta=hips_center_z_delta_adjusted,
-                recursivity=True)
-
+        # of the changed markers (including the two hip markers)
+        refresh_empty_positions(position_reference='global')
+
+        # Get the changed frame indices of both feet
+        upper_body_frame_indices = np.array(sorted(set(overall_changed_frames)), dtype=np.intp) - start_frame
+
+        # Get the new hips_center z coordinates as the average of the
+        # left and right hip z coordinates
+        new_hips_center_z = (empty_positions['left_hip']['z'][upper_body_frame_indices] + empty_positions['right_hip']['z'][upper_body_frame_indices]) / 2
+        # Get the delta vectors on the global z axis
+        hips_center_z_deltas = new_hips_center_z - empty_positions['hips_center']['z'][upper_body_frame_indices]
+        # Skip the frames with NaN positions
+        valid_frames = ~np.isnan(hips_center_z_deltas)
+        upper_body_frame_numbers = start_frame + upper_body_frame_indices[valid_frames]
+        # Adjust the delta vectors to the empty parent axis
+        hips_center_deltas_adjusted = hips_center_z_deltas[valid_frames, np.newaxis] * np.array(empty_parent_matrix)[2, :3]
+
+        if len(upper_body_frame_numbers) != 0:
+            # Translate the hips_center and, recursively, the empties from trunk_center
+            for upper_body_marker in ['hips_center'] + empties_hierarchy.subtree('trunk_center'):
+                fcurves = empties_hierarchy.fcurves(upper_body_marker)
+                if fcurves is None:
+                    # Empty does not exist or does not have animation data
+                    continue
+                translate_local_positions(bpy.data.objects[upper_body_marker],
+                                          upper_body_frame_numbers,
+                                          hips_center_deltas_adjusted,
+                                          fcurves)
+                empty_positions.mark_changed(upper_body_marker,
+                                             int(upper_body_frame_numbers[0]),
+                                             int(upper_body_frame_numbers[-1]))
 
     # Restore the current frame
     scene.frame_current = current_frame
@@ -3340,46 +3668,31 @@ def retarget_animation(
     # Get the scene context
     scene = bpy.context.scene
 
-    # Get a list with the target armature pose bones
-    target_armature_pose_bones = [bone.name for bone in bpy.data.objects[target_armature].pose.bones]
-
-    max_bone_count = 0
-    target_map_armature = ''
-
-    # Loop through the bone_name_map and check which armature has the most bones
-    # of the target armature.
-    for armature in bone_name_map:
-        count = sum(bone in bone_name_map[armature].values() for bone in target_armature_pose_bones)
-        if count > max_bone_count:
-            max_bone_count = count
-            target_map_armature = armature
-        print('armature: ' + armature + ' count: ' + str(count))
+    # Get the bone_name_map armature that matches the target armature, its
+    # inverse bone map and the target bone rolls. They are cached by armature
+    # so retargeting several clips to the same armature resolves them once
+    target_resolution = bone_map_resolver.resolve(bpy.data.objects[target_armature])
+    target_map_armature = target_resolution['map_name']
 
     # Print the name of the selected target armature
     print('Selected target armature: ' + target_map_armature)
 
     # Get the inverse bone_map_dict
-    inv_bone_name_map = {value: key for key, value in bone_name_map[target_map_armature].items()}
-
-    # Create a dictionary to store the target bone rolls
-    target_bone_rolls = {}
-
-    # Deselect all objects
-    for scene_object in bpy.data.objects:
-        scene_object.select_set(False)
-
-    # Select the target armature
-    bpy.data.objects[target_armature].select_set(True)
-
-    # Change to edit mode
-    bpy.ops.object.mode_set(mode='EDIT')
-
-    # Loop through the target armature edit bones and save the bone roll
-    for bone in bpy.data.objects[target_armature].data.edit_bones:
-        target_bone_rolls[bone.name] = bone.roll
+    inv_bone_name_map = target_resolution['inv_bone_name_map']
+
+    # If the constraints would be baked and cleared, retarget the animation
+    # directly from the source bones animation. Use the constraints if the
+    # armatures can't be retargeted directly
+    if bake_animation and clear_constraints and retarget_rig(bpy.data.objects[source_armature],
+                                                             bpy.data.objects[target_armature],
+                                                             inv_bone_name_map,
+                                                             scene.frame_start,
+                                                             scene.frame_end,
+                                                             resolver=bone_map_resolver):
+        return
 
-    # Change to object mode
-    bpy.ops.object.mode_set(mode='OBJECT')
+    # Get the target bone rolls
+    target_bone_rolls = target_resolution['bone_rolls']
 
     # Loop through the target armature pose bones and add bone constraints
     # based on the inv_bone_name_map
@@ -3433,7 +3746,10 @@ def retarget_animation(
     bpy.ops.object.mode_set(mode='POSE')
 
     # Bake the animation on the target armature
-    if bake_animation:
+    if bake_animation and not bake_rig(bpy.data.objects[target_armature],
+                                       scene.frame_start,
+                                       scene.frame_end,
+                                       clear_constraints=clear_constraints):
         bpy.ops.nla.bake(
             frame_start=scene.frame_start,
             frame_end=scene.frame_end,
@@ -1,6 +1,9 @@
 """
 Dictionary containing empty children for each of the capture empties.
 Also has categories for implementing butterworth filters.
+Virtual marker empties (not part of the capture) have a 'virtual_marker'
+dictionary with the weight of each reference marker used to calculate
+their position as the weighted sum of the reference markers positions.
 """
 empties_dict = {
     'hips_center': {
@@ -69,11 +72,17 @@ empties_dict = {
     'right_hand_middle': {
         'children'      : [],
         'category'      : 'hands',
-        'tail_of_bone'  : 'hand.R'},
+        'tail_of_bone'  : 'hand.R',
+        'virtual_marker': {
+            'right_hand_middle_finger_mcp' : 0.5,
+            'right_hand_ring_finger_mcp'   : 0.5}},
     'left_hand_middle': {
         'children'      : [],
         'category'      : 'hands',
-        'tail_of_bone'  : 'hand.L'},
+        'tail_of_bone'  : 'hand.L',
+        'virtual_marker': {
+            'left_hand_middle_finger_mcp' : 0.5,
+            'left_hand_ring_finger_mcp'   : 0.5}},
     'right_hand_wrist': {
         'children'      : [
             'right_hand_thumb_cmc',
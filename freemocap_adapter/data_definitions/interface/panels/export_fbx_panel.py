@@ -28,7 +28,44 @@ def draw_export_fbx_panel(context, layout):
             'fbx_type'
         )
 
+        split = box.column().row().split(factor=0.6)
+        split.column().label(text='Takes')
+        split.split().column().prop(
+            fmc_adapter_tool.export_fbx_properties,
+            'takes_source'
+        )
+
+        if fmc_adapter_tool.export_fbx_properties.takes_source == 'frame_ranges':
+            split = box.column().row().split(factor=0.6)
+            split.column().label(text='Frame Ranges')
+            split.split().column().prop(
+                fmc_adapter_tool.export_fbx_properties,
+                'frame_ranges'
+            )
+
+        if fmc_adapter_tool.export_fbx_properties.takes_source != 'current':
+            split = box.column().row().split(factor=0.6)
+            split.column().label(text='Takes Output')
+            split.split().column().prop(
+                fmc_adapter_tool.export_fbx_properties,
+                'takes_output'
+            )
+
         box.operator(
             'fmc_adapter.export_fbx',
             text='8. Export FBX'
         )
+
+        # Animation Columns Export
+        box = layout.box()
+        split = box.column().row().split(factor=0.6)
+        split.column().label(text='Compress Arrays')
+        split.split().column().prop(
+            fmc_adapter_tool.export_fbx_properties,
+            'compress_animation_columns'
+        )
+
+        box.operator(
+            'fmc_adapter.export_animation_columns',
+            text='Export Animation Columns'
+        )
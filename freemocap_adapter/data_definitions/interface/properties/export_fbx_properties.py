@@ -11,3 +11,31 @@ class ExportFBXProperties(bpy.types.PropertyGroup):
                  ('unreal_engine', 'Unreal Engine', '')
                 ]
     ) # type: ignore
+    takes_source: PropertyTypes.Enum(
+        description = 'Animation exported to the FBX file. Current Action '
+                      'exports the current action of the rig, Rig Actions '
+                      'exports the current action and the NLA strip actions '
+                      'of the rig as takes and Frame '
+                      'Ranges exports each frame range of the current '
+                      'action as a take',
+        items = [('current', 'Current Action', ''),
+                 ('actions', 'Rig Actions', ''),
+                 ('frame_ranges', 'Frame Ranges', '')
+                ]
+    ) # type: ignore
+    frame_ranges: PropertyTypes.String(
+        description = 'Comma separated frame ranges of the takes, '
+                      'for example 0-250, 300-600'
+    ) # type: ignore
+    takes_output: PropertyTypes.Enum(
+        description = 'Write the takes as animation stacks of one FBX file '
+                      'or as separate FBX files',
+        items = [('single_file', 'Single File', ''),
+                 ('separate_files', 'Separate Files', '')
+                ]
+    ) # type: ignore
+    compress_animation_columns: PropertyTypes.Bool(
+        description = 'Compress the arrays of the animation columns file. '
+                      'Compressed files are smaller but they are not '
+                      'memory-mapped when loaded'
+    ) # type: ignore
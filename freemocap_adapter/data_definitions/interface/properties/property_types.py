@@ -22,4 +22,9 @@ class PropertyTypes:
                 default=kwargs.get('default', 0),
                 description=kwargs.get('description', '')
             )
-    
\ No newline at end of file
+    
+    String = lambda **kwargs: bpy.props.StringProperty(
+                name=kwargs.get('name', ''),
+                default=kwargs.get('default', ''),
+                description=kwargs.get('description', '')
+            )
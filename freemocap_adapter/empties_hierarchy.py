@@ -0,0 +1,85 @@
+"""
+Flattened index of the empties hierarchy defined in empties_dict.
+For each empty it saves the list of the empty and all its descendants and
+their row indices in the marker positions store, so the recursive
+translations and rotations of a subtree are done as gather/scatter
+operations over index arrays instead of recursive calls with string
+lookups on every frame.
+"""
+import bpy
+import numpy as np
+
+from .fcurve_functions import get_location_fcurves
+
+
+class EmptiesHierarchy:
+    """
+    Hierarchy index built once per scene. The subtrees only depend on the
+    empties dictionary, while the marker rows are rebuilt after
+    invalidate() or when the positions store changes. The fcurves are not
+    cached, as their handles are freed by an undo or a file load.
+    """
+
+    def __init__(self, empties_dict: dict, positions_store):
+        self.empties_dict = empties_dict
+        self.positions_store = positions_store
+        # Empty and descendants names of each subtree root (depth first order)
+        self._subtrees = {}
+        # Row indices of each subtree in the positions store
+        self._rows = {}
+        # Generation of the positions store the cached rows refer to
+        self._rows_generation = None
+
+    def subtree(self, empty: str, recursivity: bool=True) -> list:
+        # Get the empty and, if recursivity is True, all its descendants
+        if not recursivity:
+            return [empty]
+
+        if empty not in self._subtrees:
+            subtree = [empty]
+            # Iterative depth first traversal of the children
+            pending = list(reversed(self.empties_dict.get(empty, {}).get('children', [])))
+            while pending:
+                child = pending.pop()
+                if child in subtree:
+                    continue
+                subtree.append(child)
+                pending.extend(reversed(self.empties_dict.get(child, {}).get('children', [])))
+
+            self._subtrees[empty] = subtree
+
+        return self._subtrees[empty]
+
+    def descendants(self, empty: str) -> list:
+        # Get all the descendants of the empty without the empty itself
+        return self.subtree(empty)[1:]
+
+    def fcurves(self, empty: str) -> list:
+        # Get the x, y, z location fcurves of an empty (None if it has no
+        # animation)
+        scene_object = bpy.data.objects.get(empty)
+        return None if scene_object is None else get_location_fcurves(scene_object)
+
+    def subtree_names(self, empty: str, recursivity: bool=True) -> list:
+        # Get the subtree empties that are saved in the positions store
+        return [name for name in self.subtree(empty, recursivity) if name in self.positions_store]
+
+    def subtree_rows(self, empty: str, recursivity: bool=True) -> np.ndarray:
+        # Get the positions store row indices of the subtree empties
+        store = self.positions_store
+        # The rows are stale if the store was reset or new markers were added
+        if store.generation != self._rows_generation:
+            self._rows = {}
+            self._rows_generation = store.generation
+
+        key = (empty, recursivity)
+        if key not in self._rows:
+            self._rows[key] = store.rows(self.subtree_names(empty, recursivity))
+
+        return self._rows[key]
+
+    def invalidate(self) -> None:
+        # Clear the cached rows. Used when the scene objects or their
+        # animation could have been changed
+        self._rows = {}
+        self._rows_generation = None
@@ -0,0 +1,89 @@
+"""
+Sampling of the objects transforms of the FBX animation export without
+stepping through the scene frames. The patched fbx_animations_do functions
+call scene.frame_set and fbx_object_tx for every object on every frame. For
+the bones of baked armatures and for static objects, the same FBX local
+location, euler rotation and scale values are computed here for all the
+frames at once from the bone fcurves.
+"""
+import numpy as np
+
+from .fcurve_functions import is_static
+from .retargeting import get_corrected_source_pose, read_source_pose
+from .rig_baking import matrices_to_euler_sequence, split_rotation_scale
+
+
+# Function to get the (n_frames, 4, 4) FBX local matrices of a bone object
+# wrapper from the pose matrices of its armature
+def get_bone_local_matrices(ob_obj, scene_data, pose_matrices: dict) -> np.ndarray:
+    bone = ob_obj.bdata
+
+    # The pose bone matrix relative to its parent pose bone matrix
+    matrices = pose_matrices[bone.name]
+    if bone.parent is not None:
+        matrices = np.linalg.inv(pose_matrices[bone.parent.name]) @ matrices
+
+    # Apply the bone correction, undoing the one of the parent bone
+    bone_correction_matrix = scene_data.settings.bone_correction_matrix
+    if bone_correction_matrix is not None:
+        if bone.parent is not None:
+            matrices = np.array(scene_data.settings.bone_correction_matrix_inv) @ matrices
+        matrices = matrices @ np.array(bone_correction_matrix)
+
+    return matrices
+
+# Function to sample the FBX local location, rotation (euler XYZ radians)
+# and scale of the animated objects on the frames. Returns a
+# (n_frames, n_objects * 9) array with the values of each frame in the
+# order of the animdata_ob objects, or None if any object needs the scene
+# frames evaluation (constrained, driven or non baked objects, duplis or
+# subframes)
+def sample_objects_transforms(scene_data,
+                              animdata_ob: dict,
+                              p_rots: dict,
+                              frames: np.ndarray) -> np.ndarray:
+
+    if len(animdata_ob) == 0 or not np.array_equal(frames, np.round(frames)):
+        return None
+    frames = frames.astype(int)
+
+    # Pose matrices of each armature, read once from its bone fcurves
+    armatures_pose_matrices = {}
+
+    local_matrices = []
+    for ob_obj in animdata_ob:
+        if ob_obj.is_bone:
+            # The armature object of the bone wrapper
+            armature = ob_obj._ref
+            if armature.name not in armatures_pose_matrices:
+                source_pose = read_source_pose(armature, frames)
+                if source_pose is None:
+                    return None
+                armatures_pose_matrices[armature.name] = get_corrected_source_pose(source_pose, {})
+            local_matrices.append(get_bone_local_matrices(ob_obj, scene_data, armatures_pose_matrices[armature.name]))
+
+        elif ob_obj.is_object and not ob_obj.is_dupli and is_static(ob_obj.bdata) \
+                and (ob_obj.bdata.parent is None or ob_obj.bdata.parent_type == 'OBJECT'):
+            # Static objects have the same transform on every frame
+            local_matrices.append(np.broadcast_to(np.array(ob_obj.fbx_object_matrix(scene_data)),
+                                                  (len(frames), 4, 4)))
+
+        else:
+            return None
+
+    local_matrices = np.stack(local_matrices)
+    object_count, frame_count = local_matrices.shape[:2]
+
+    # Decompose the matrices as Matrix.decompose does
+    rotations, scales = split_rotation_scale(local_matrices.reshape(-1, 4, 4))
+    locations = local_matrices[:, :, :3, 3]
+    rotations = rotations.reshape(object_count, frame_count, 3, 3)
+    scales = scales.reshape(object_count, frame_count, 3)
+
+    initial_eulers = np.array([tuple(p_rots[ob_obj]) for ob_obj in animdata_ob], dtype=np.float64)
+    eulers = matrices_to_euler_sequence(rotations, initial_eulers)
+
+    # Location, rotation and scale of each object on each frame
+    values = np.concatenate((locations, eulers, scales), axis=2)
+
+    return values.transpose(1, 0, 2).reshape(frame_count, object_count * 9)
@@ -0,0 +1,244 @@
+"""
+Export of several takes of the rig animation with the io_scene_fbx
+export_fbx_bin module. A take is an action or a frame range of the rig.
+The takes are written as the animation stacks of one FBX file, or as
+separate FBX files that reuse the geometry, skin and bind pose elements
+built for the first file instead of rebuilding them for every take.
+"""
+import re
+from pathlib import Path
+import bpy
+
+
+# Class with the action and the frame range of a take. The take is passed
+# as the reference ID of its animation stack, so it has the name, rna_type
+# and library attributes the exporter uses to build the stack keys and name
+class FBXTake:
+    library = None
+
+    def __init__(self,
+                 name: str,
+                 action: bpy.types.Action,
+                 frame_start: int,
+                 frame_end: int):
+        self.name = name
+        self.action = action
+        self.frame_start = frame_start
+        self.frame_end = frame_end
+
+    @property
+    def rna_type(self):
+        return bpy.types.Action.bl_rna
+
+# Class to cache the FBX elements written for the objects of the scene so
+# the next exports of the takes append the same elements to their root
+# instead of building them again. The cached elements don't depend on the
+# animation: meshes are exported without their armature deformation and
+# the skin clusters and bind poses use the rest pose of the bones
+class FBXElementCache:
+    def __init__(self):
+        self.elements = {}
+
+    # Function to call an element function once per object, storing the
+    # elements it appends to the root, and append the stored elements in
+    # the next calls
+    def get_elements(self, element_function, root, ob_obj, *args) -> None:
+        key = (element_function.__name__, ob_obj.key)
+
+        if key in self.elements:
+            root.elems.extend(self.elements[key])
+            return
+
+        element_count = len(root.elems)
+        element_function(root, ob_obj, *args)
+        self.elements[key] = root.elems[element_count:]
+
+    # Function to wrap the fbx_data_mesh_elements function
+    def wrap_mesh_elements(self, element_function):
+        def fbx_data_mesh_elements(root, me_obj, scene_data, done_meshes):
+            # Meshes shared by several objects are written only once
+            me_key = scene_data.data_meshes[me_obj][0]
+            if me_key in done_meshes:
+                return
+
+            self.get_elements(element_function, root, me_obj, scene_data, done_meshes)
+            done_meshes.add(me_key)
+
+        return fbx_data_mesh_elements
+
+    # Function to wrap the fbx_data_armature_elements function
+    def wrap_armature_elements(self, element_function):
+        def fbx_data_armature_elements(root, arm_obj, scene_data):
+            self.get_elements(element_function, root, arm_obj, scene_data)
+
+        return fbx_data_armature_elements
+
+# Function to get the actions assigned to an armature that animate its
+# pose bones: its current action and the actions of its NLA strips, like
+# the actions stashed when another action is assigned in the Action Editor.
+# Actions of other armatures with the same bone names are not included
+def get_armature_actions(armature: bpy.types.Object) -> list:
+    animation_data = armature.animation_data
+    if animation_data is None:
+        return []
+
+    assigned_actions = [animation_data.action]
+    for nla_track in animation_data.nla_tracks:
+        assigned_actions += [strip.action for strip in nla_track.strips]
+
+    bone_names = {bone.name for bone in armature.data.bones}
+
+    actions = []
+    for action in assigned_actions:
+        if action is None or action in actions or action.id_root != 'OBJECT':
+            continue
+        for fcurve in action.fcurves:
+            match = re.match(r'pose\.bones\["(.+?)"\]', fcurve.data_path)
+            if match is not None and match.group(1) in bone_names:
+                actions.append(action)
+                break
+
+    return actions
+
+# Function to parse frame ranges like "0-250, 300-600" into a list of
+# (frame_start, frame_end) tuples
+def parse_frame_ranges(frame_ranges: str) -> list:
+    ranges = []
+    for frame_range in frame_ranges.split(','):
+        frame_range = frame_range.strip()
+        if frame_range == '':
+            continue
+
+        match = re.fullmatch(r'(-?\d+)\s*-\s*(-?\d+)', frame_range)
+        if match is None:
+            raise ValueError('Invalid frame range: ' + frame_range)
+
+        frame_start, frame_end = int(match.group(1)), int(match.group(2))
+        if frame_end < frame_start:
+            raise ValueError('Invalid frame range: ' + frame_range)
+
+        ranges.append((frame_start, frame_end))
+
+    return ranges
+
+# Function to get the takes of the rig to export. The takes are the actions
+# of the rig or the frame ranges of its current action
+def get_rig_takes(rig: bpy.types.Object,
+                  takes_source: str,
+                  frame_ranges: str='') -> list:
+
+    if takes_source == 'actions':
+        takes = []
+        for action in get_armature_actions(rig):
+            frame_start, frame_end = (int(round(frame)) for frame in action.frame_range)
+            takes.append(FBXTake(action.name, action, frame_start, frame_end))
+
+        return takes
+
+    action = rig.animation_data.action if rig.animation_data is not None else None
+    action_name = action.name if action is not None else rig.name
+
+    return [FBXTake(action_name + '_' + str(frame_start) + '_' + str(frame_end),
+                    action,
+                    frame_start,
+                    frame_end)
+            for frame_start, frame_end in parse_frame_ranges(frame_ranges)]
+
+# Function to get a replacement of the fbx_animations function of the
+# export_fbx_bin module that writes one animation stack per take, assigning
+# the take action to the rig while its animation is sampled
+def get_takes_animations_function(export_fbx_bin, rig: bpy.types.Object, takes: list):
+    def fbx_animations(scene_data):
+        scene = scene_data.scene
+        animations = []
+        animated = set()
+        frame_start = 1e100
+        frame_end = -1e100
+
+        original_action = rig.animation_data.action if rig.animation_data is not None else None
+
+        # Evaluate only the take action, without the NLA strips of the rig
+        original_use_nla = rig.animation_data.use_nla if rig.animation_data is not None else None
+        if rig.animation_data is not None:
+            rig.animation_data.use_nla = False
+
+        for take in takes:
+            # Takes without action use the original action of the rig
+            if take.action is not None:
+                rig.animation_data_create().action = take.action
+            elif rig.animation_data is not None:
+                rig.animation_data.action = original_action
+
+            # Keep the static curves when there are several stacks so each
+            # take defines all the animated properties, as Blender does
+            # when exporting all the actions
+            anim = export_fbx_bin.fbx_animations_do(scene_data,
+                                                    take,
+                                                    take.frame_start,
+                                                    take.frame_end,
+                                                    True,
+                                                    force_keep=len(takes) > 1)
+            if anim is None:
+                continue
+
+            animations.append(anim)
+            frame_start = min(frame_start, anim[4])
+            frame_end = max(frame_end, anim[5])
+
+            for elem_key, (alayer_key, acurvenodes) in anim[1].items():
+                for fbx_prop in acurvenodes:
+                    animated.add((elem_key, fbx_prop))
+
+        # Restore the original action and the matrices of the current frame
+        if rig.animation_data is not None:
+            rig.animation_data.action = original_action
+            if original_use_nla is not None:
+                rig.animation_data.use_nla = original_use_nla
+        scene.frame_set(scene.frame_current)
+
+        return animations, animated, frame_start, frame_end
+
+    return fbx_animations
+
+# Function to export the takes of the rig with the export_fbx_bin module.
+# The takes are written as the animation stacks of the export parameters
+# filepath, or as one file per take with the take name as suffix
+def export_fbx_takes(export_fbx_bin,
+                     operator,
+                     export_parameters: dict,
+                     rig: bpy.types.Object,
+                     takes: list,
+                     separate_files: bool=False) -> None:
+
+    # Backup the export_fbx_bin functions replaced during the export
+    backup_fbx_animations               = export_fbx_bin.fbx_animations
+    backup_fbx_data_mesh_elements       = export_fbx_bin.fbx_data_mesh_elements
+    backup_fbx_data_armature_elements   = export_fbx_bin.fbx_data_armature_elements
+
+    try:
+        if not separate_files:
+            export_fbx_bin.fbx_animations = get_takes_animations_function(export_fbx_bin, rig, takes)
+            export_fbx_bin.save(operator, bpy.context, **export_parameters)
+            return
+
+        # Build the geometry, skin and bind pose elements only once
+        element_cache = FBXElementCache()
+        export_fbx_bin.fbx_data_mesh_elements = element_cache.wrap_mesh_elements(backup_fbx_data_mesh_elements)
+        export_fbx_bin.fbx_data_armature_elements = element_cache.wrap_armature_elements(backup_fbx_data_armature_elements)
+
+        filepath = Path(export_parameters['filepath'])
+        for take in takes:
+            print('Exporting take ' + take.name)
+            export_fbx_bin.fbx_animations = get_takes_animations_function(export_fbx_bin, rig, [take])
+
+            take_parameters = dict(export_parameters)
+            take_parameters['filepath'] = filepath.with_name(filepath.stem
+                                                             + '_'
+                                                             + bpy.path.clean_name(take.name)
+                                                             + filepath.suffix)
+            export_fbx_bin.save(operator, bpy.context, **take_parameters)
+
+    finally:
+        export_fbx_bin.fbx_animations               = backup_fbx_animations
+        export_fbx_bin.fbx_data_mesh_elements       = backup_fbx_data_mesh_elements
+        export_fbx_bin.fbx_data_armature_elements   = backup_fbx_data_armature_elements
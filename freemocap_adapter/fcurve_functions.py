@@ -0,0 +1,288 @@
+"""
+Functions to read and write the animation curves of the marker empties in
+bulk with foreach_get/foreach_set instead of stepping through the scene
+frames and poking one keyframe at a time.
+"""
+import bpy
+import numpy as np
+
+
+# Function to get the x, y, z location fcurves of an object
+def get_location_fcurves(scene_object: bpy.types.Object) -> list:
+    animation_data = scene_object.animation_data
+    if animation_data is None or animation_data.action is None:
+        return None
+
+    fcurves = animation_data.action.fcurves
+    if len(fcurves) < 3:
+        return None
+
+    return [fcurves[0], fcurves[1], fcurves[2]]
+
+# Function to get the keyframe points of a fcurve as a (n_keyframes, 2) array
+# with the frame in the first column and the value in the second one
+def read_keyframe_points(fcurve: bpy.types.FCurve) -> np.ndarray:
+    keyframe_count = len(fcurve.keyframe_points)
+    co = np.empty(keyframe_count * 2, dtype=np.float32)
+    fcurve.keyframe_points.foreach_get('co', co)
+
+    return co.reshape(keyframe_count, 2).astype(np.float64)
+
+# Function to check if the location of an object is fully defined by its
+# action, so it can be read without evaluating the depsgraph
+def is_action_driven(scene_object: bpy.types.Object) -> bool:
+    if len(scene_object.constraints) != 0:
+        return False
+
+    animation_data = scene_object.animation_data
+    if animation_data is None or animation_data.action is None:
+        return False
+
+    # Drivers and NLA strips would change the evaluated location
+    if len(animation_data.drivers) != 0 or len(animation_data.nla_tracks) != 0:
+        return False
+
+    return True
+
+# Function to check if a fcurve has one keyframe per frame
+# in the frames interval (as the baked capture empties do)
+def is_baked(fcurve: bpy.types.FCurve,
+             keyframe_points: np.ndarray,
+             frames: np.ndarray) -> bool:
+
+    if len(keyframe_points) == 0 or len(fcurve.modifiers) != 0:
+        return False
+
+    keyframe_frames = keyframe_points[:, 0]
+    first_frame = keyframe_frames[0]
+
+    # The keyframes must be on consecutive integer frames
+    if not np.array_equal(keyframe_frames,
+                          np.arange(first_frame, first_frame + len(keyframe_frames))):
+        return False
+
+    # Frames outside the keyframes are only valid with constant extrapolation
+    if (frames[0] < first_frame or frames[-1] > keyframe_frames[-1]) \
+            and fcurve.extrapolation != 'CONSTANT':
+        return False
+
+    return True
+
+# Function to read the (n_frames, 3) local location of an object from its
+# location fcurves. Returns None if the location needs the depsgraph
+# evaluation (constraints, drivers or NLA strips)
+def read_local_positions(scene_object: bpy.types.Object,
+                         frames: np.ndarray) -> np.ndarray:
+
+    if not is_action_driven(scene_object):
+        return None
+
+    fcurves = get_location_fcurves(scene_object)
+    if fcurves is None:
+        return None
+
+    positions = np.empty((len(frames), 3), dtype=np.float64)
+    if len(frames) == 0:
+        return positions
+
+    for axis, fcurve in enumerate(fcurves):
+        positions[:, axis] = read_fcurve_values(fcurve, frames)
+
+    return positions
+
+# Function to get the (n_frames,) values of a fcurve on the frames
+def read_fcurve_values(fcurve: bpy.types.FCurve, frames: np.ndarray) -> np.ndarray:
+    keyframe_points = read_keyframe_points(fcurve)
+
+    if is_baked(fcurve, keyframe_points, frames):
+        # Gather the values by the keyframe index of each frame
+        keyframe_indices = np.clip(frames - int(keyframe_points[0, 0]),
+                                   0,
+                                   len(keyframe_points) - 1).astype(np.intp)
+        return keyframe_points[keyframe_indices, 1]
+
+    # Evaluate the curve itself, without updating the scene
+    return np.array([fcurve.evaluate(frame) for frame in frames], dtype=np.float64)
+
+# Function to check if the world matrix of an object is the same in every
+# frame (no animation, constraints or drivers in it or its parents)
+def is_static(scene_object: bpy.types.Object) -> bool:
+    while scene_object is not None:
+        if len(scene_object.constraints) != 0:
+            return False
+
+        animation_data = scene_object.animation_data
+        if animation_data is not None and (
+                (animation_data.action is not None and len(animation_data.action.fcurves) != 0)
+                or len(animation_data.drivers) != 0
+                or len(animation_data.nla_tracks) != 0):
+            return False
+
+        scene_object = scene_object.parent
+
+    return True
+
+# Function to get the matrix that converts the local location of an object
+# into its world position. Returns None if the parent chain is animated
+def get_local_to_world_matrix(scene_object: bpy.types.Object) -> np.ndarray:
+    matrix = np.identity(4)
+
+    parent = scene_object.parent
+    if parent is not None:
+        if scene_object.parent_type != 'OBJECT' or not is_static(parent):
+            return None
+
+        matrix = np.array(parent.matrix_world) @ np.array(scene_object.matrix_parent_inverse)
+
+    # The delta location is added to the animated location
+    matrix = matrix.copy()
+    matrix[:3, 3] += matrix[:3, :3] @ np.array(scene_object.delta_location)
+
+    return matrix
+
+# Function to convert (n_markers, n_frames, 3) local locations into world
+# positions with one batched matrix product of the (n_markers, 4, 4)
+# local to world matrices
+def local_to_world_positions(local_positions: np.ndarray,
+                             matrices: np.ndarray) -> np.ndarray:
+    return np.einsum('mij,mfj->mfi', matrices[:, :3, :3], local_positions) \
+        + matrices[:, np.newaxis, :3, 3]
+
+# Function to read the (n_objects, n_frames, 3) world positions of a list of
+# objects on the frames from their location fcurves. Returns None if the
+# position of any object needs the depsgraph evaluation
+def read_world_positions(scene_objects: list, frames: np.ndarray) -> np.ndarray:
+    local_positions = np.empty((len(scene_objects), len(frames), 3), dtype=np.float64)
+    matrices = np.empty((len(scene_objects), 4, 4), dtype=np.float64)
+
+    for object_index, scene_object in enumerate(scene_objects):
+        object_local_positions = read_local_positions(scene_object, frames)
+        local_to_world_matrix = get_local_to_world_matrix(scene_object)
+        if object_local_positions is None or local_to_world_matrix is None:
+            return None
+
+        local_positions[object_index] = object_local_positions
+        matrices[object_index] = local_to_world_matrix
+
+    return local_to_world_positions(local_positions, matrices)
+
+# Function to get the keyframe indices of the frames in a fcurve keyframe
+# points array, and a mask of the frames that have a keyframe
+def get_keyframe_indices(keyframe_points: np.ndarray,
+                         frames: np.ndarray) -> tuple:
+    keyframe_frames = keyframe_points[:, 0]
+    keyframe_indices = np.searchsorted(keyframe_frames, frames)
+    keyframe_indices = np.minimum(keyframe_indices, max(len(keyframe_frames) - 1, 0))
+    has_keyframe = np.zeros(len(frames), dtype=bool)
+    if len(keyframe_frames) != 0:
+        has_keyframe = keyframe_frames[keyframe_indices] == frames
+
+    return keyframe_indices[has_keyframe], has_keyframe
+
+# Function to add deltas to the values of a fcurve keyframes on the frames in
+# bulk. The keyframe handles are moved by the same delta
+def add_keyframe_deltas(fcurve: bpy.types.FCurve,
+                        frames: np.ndarray,
+                        deltas: np.ndarray) -> None:
+
+    keyframe_points = read_keyframe_points(fcurve)
+    keyframe_indices, has_keyframe = get_keyframe_indices(keyframe_points, frames)
+    if len(keyframe_indices) == 0:
+        return
+
+    keyframe_deltas = np.asarray(deltas, dtype=np.float64)[has_keyframe]
+
+    offset_keyframe_points(fcurve, keyframe_points, keyframe_indices, keyframe_deltas)
+
+# Function to set the values of all the keyframes of a fcurve in bulk. The
+# keyframe_points array is the one read with read_keyframe_points
+def write_keyframe_values(fcurve: bpy.types.FCurve,
+                          keyframe_points: np.ndarray,
+                          values: np.ndarray) -> None:
+
+    keyframe_deltas = np.asarray(values, dtype=np.float64) - keyframe_points[:, 1]
+    offset_keyframe_points(fcurve,
+                           keyframe_points.copy(),
+                           np.arange(len(keyframe_points)),
+                           keyframe_deltas)
+
+# Function to add the deltas to the values of the keyframes in the indices
+# and write the fcurve keyframes once. The keyframe handles are moved by the
+# same delta so the curve keeps its shape around each keyframe
+def offset_keyframe_points(fcurve: bpy.types.FCurve,
+                           keyframe_points: np.ndarray,
+                           keyframe_indices: np.ndarray,
+                           keyframe_deltas: np.ndarray) -> None:
+
+    keyframe_points[keyframe_indices, 1] += keyframe_deltas
+    fcurve.keyframe_points.foreach_set('co', keyframe_points.astype(np.float32).ravel())
+
+    for handle in ('handle_left', 'handle_right'):
+        handle_points = np.empty(len(keyframe_points) * 2, dtype=np.float32)
+        fcurve.keyframe_points.foreach_get(handle, handle_points)
+        handle_points = handle_points.reshape(-1, 2).astype(np.float64)
+        handle_points[keyframe_indices, 1] += keyframe_deltas
+        fcurve.keyframe_points.foreach_set(handle, handle_points.astype(np.float32).ravel())
+
+    fcurve.update()
+
+# Function to set the (n_frames, 3) local location of an object on the
+# frames, writing each location fcurve once. Keyframes on other frames are
+# not changed
+def write_local_positions(fcurves: list,
+                          frames: np.ndarray,
+                          positions: np.ndarray) -> None:
+
+    for axis, fcurve in enumerate(fcurves):
+        keyframe_points = read_keyframe_points(fcurve)
+        keyframe_indices, has_keyframe = get_keyframe_indices(keyframe_points, frames)
+        if len(keyframe_indices) == 0:
+            continue
+
+        values = keyframe_points[:, 1].copy()
+        values[keyframe_indices] = positions[has_keyframe, axis]
+        write_keyframe_values(fcurve, keyframe_points, values)
+
+# Function to translate the local location of an object on the frames by
+# the (n_frames, 3) deltas, writing each location fcurve once. The location
+# fcurves can be passed if they are already cached
+def translate_local_positions(scene_object: bpy.types.Object,
+                              frames: np.ndarray,
+                              deltas: np.ndarray,
+                              fcurves: list=None) -> bool:
+
+    if fcurves is None:
+        fcurves = get_location_fcurves(scene_object)
+    if fcurves is None:
+        return False
+
+    for axis, fcurve in enumerate(fcurves):
+        add_keyframe_deltas(fcurve, frames, deltas[:, axis])
+
+    return True
+
+# Function to write the keyframes of an action fcurve in bulk with one
+# keyframe per frame. An existing fcurve with the same data path and index
+# is replaced
+def write_fcurve_keyframes(action: bpy.types.Action,
+                           data_path: str,
+                           index: int,
+                           frames: np.ndarray,
+                           values: np.ndarray,
+                           group: str=None) -> bpy.types.FCurve:
+
+    fcurve = action.fcurves.find(data_path, index=index)
+    if fcurve is not None:
+        action.fcurves.remove(fcurve)
+
+    if group is None:
+        fcurve = action.fcurves.new(data_path, index=index)
+    else:
+        fcurve = action.fcurves.new(data_path, index=index, action_group=group)
+
+    fcurve.keyframe_points.add(len(frames))
+    keyframe_points = np.column_stack((frames, values)).astype(np.float32)
+    fcurve.keyframe_points.foreach_set('co', keyframe_points.ravel())
+    fcurve.update()
+
+    return fcurve
@@ -0,0 +1,181 @@
+"""
+Functions to apply Butterworth filters to the marker empties animation
+curves in process. The keyframe values are read in bulk into a
+(channels, frames) matrix, filtered forward and backward with second order
+sections and written back in bulk, so no Graph Editor area or operator is
+needed and the filters also work in background mode.
+
+The global filters reproduce Blender's graph.butterworth_smooth operator
+(filter_order biquads, constant edge samples, start offsets and the
+blend in/out of the segment ends) with NumPy only, so they keep filtering
+as the operator did and don't need SciPy. The local filters are SciPy
+filtfilt filters of order 4.
+"""
+from functools import lru_cache
+import numpy as np
+
+scipy_available = True
+try:
+    from scipy.signal import butter, sosfiltfilt
+except ImportError:
+    scipy_available = False
+
+from .fcurve_functions import read_keyframe_points, write_keyframe_values
+
+
+# Maximum number of filter designs kept in the cache
+FILTER_DESIGN_CACHE_SIZE = 64
+
+# Function to get the second order sections of a Butterworth filter.
+# The designs are cached by (order, cutoff, fs, btype) so repeated calls
+# with the same parameters (e.g. the same cutoff for several categories or
+# runs of the filters operator) skip the filter redesign. Each caller gets
+# a copy of the cached design
+def get_butterworth_sos(order: int,
+                        cutoff: float,
+                        fs: float,
+                        btype: str='low') -> np.ndarray:
+    return _design_butterworth_sos(int(order), float(cutoff), float(fs), btype).copy()
+
+@lru_cache(maxsize=FILTER_DESIGN_CACHE_SIZE)
+def _design_butterworth_sos(order: int,
+                            cutoff: float,
+                            fs: float,
+                            btype: str) -> np.ndarray:
+    sos = butter(order, cutoff, btype=btype, analog=False, output='sos', fs=fs)
+    # The cached array must not be changed in place
+    sos.setflags(write=False)
+
+    return sos
+
+# Function to clear the filter designs cache
+def clear_filter_design_cache() -> None:
+    _design_butterworth_sos.cache_clear()
+
+# Function to filter forward and backward each row of a (channels, frames)
+# matrix. Rows with NaN values are returned unchanged
+def filter_channels(channels: np.ndarray, sos: np.ndarray) -> np.ndarray:
+    channels = np.asarray(channels, dtype=np.float64)
+    filtered = channels.copy()
+
+    frame_count = channels.shape[-1]
+    if frame_count < 2:
+        return filtered
+
+    valid = ~np.any(np.isnan(channels), axis=-1)
+    if not np.any(valid):
+        return filtered
+
+    # Reduce the default edge padding for captures shorter than it
+    default_padlen = 3 * (2 * len(sos) + 1 - min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum()))
+    padlen = min(default_padlen, frame_count - 1)
+
+    filtered[valid] = sosfiltfilt(sos, channels[valid], axis=-1, padlen=padlen)
+
+    return filtered
+
+# Function to get the (filter_order, 6) second order sections of the low
+# pass Butterworth filter of Blender's graph.butterworth_smooth operator.
+# Its filter_order is the number of cascaded biquads, so the filter order
+# is twice the filter_order
+def get_blender_butterworth_sos(filter_order: int,
+                                cutoff: float,
+                                fs: float) -> np.ndarray:
+    a = np.tan(np.pi * cutoff / fs)
+    a2 = a * a
+    r = np.sin(np.pi * (2.0 * np.arange(filter_order) + 1.0) / (4.0 * filter_order))
+    s = a2 + 2.0 * a * r + 1.0
+
+    gains = a2 / s
+    d1 = 2.0 * (1 - a2) / s
+    d2 = -(a2 - 2.0 * a * r + 1.0) / s
+
+    return np.column_stack((gains, 2 * gains, gains, np.ones(filter_order), -d1, -d2))
+
+# Function to run the biquads of a Blender Butterworth filter once over the
+# columns of a (channels, samples) matrix, with the state starting at zero.
+# The samples loop is run for all the channels at once
+def run_blender_biquads(samples: np.ndarray, sos: np.ndarray) -> np.ndarray:
+    filtered = np.empty_like(samples)
+    w1 = np.zeros((len(sos), samples.shape[0]))
+    w2 = np.zeros((len(sos), samples.shape[0]))
+
+    for sample_index in range(samples.shape[1]):
+        x = samples[:, sample_index]
+        for section, (gain, _b1, _b2, _a0, a1, a2) in enumerate(sos):
+            w0 = -a1 * w1[section] - a2 * w2[section] + x
+            x = gain * (w0 + 2.0 * w1[section] + w2[section])
+            w2[section] = w1[section]
+            w1[section] = w0
+        filtered[:, sample_index] = x
+
+    return filtered
+
+# Function to smooth each row of a (channels, frames) matrix of keyframe
+# values, one keyframe per frame, as graph.butterworth_smooth does with one
+# sample per frame: the curve is extended filter_order frames at each end
+# with its end values, filtered forward and backward from the first and
+# last sample offsets and blended with the original values with the
+# blend_in_out keyframes at each end and the blend factor
+def smooth_channels_blender(channels: np.ndarray,
+                            sos: np.ndarray,
+                            blend_in_out: int=1,
+                            blend: float=1.0) -> np.ndarray:
+    channels = np.asarray(channels, dtype=np.float64)
+    filter_order = len(sos)
+    frame_count = channels.shape[-1]
+
+    samples = np.pad(channels, ((0, 0), (filter_order, filter_order)), mode='edge')
+
+    fwd_offset = samples[:, :1]
+    filtered = run_blender_biquads(samples - fwd_offset, sos) + fwd_offset
+
+    bwd_offset = filtered[:, -1:]
+    filtered = run_blender_biquads((filtered - bwd_offset)[:, ::-1], sos)[:, ::-1] + bwd_offset
+
+    filtered = filtered[:, filter_order:filter_order + frame_count]
+
+    # Blend the filtered values in and out at the ends of the curve
+    blend_in_out = min(blend_in_out, (frame_count - 1) // 2)
+    if blend_in_out == 0:
+        blend_factors = np.ones(frame_count)
+    else:
+        indices = np.arange(frame_count)
+        blend_factors = np.where(indices < frame_count // 2,
+                                 np.minimum(indices / blend_in_out, 1.0),
+                                 np.minimum((frame_count - indices - 1) / blend_in_out, 1.0))
+    blended = blend_factors * filtered + (1 - blend_factors) * channels
+
+    return blend * blended + (1 - blend) * channels
+
+# Function to apply the low pass Butterworth filter of Blender's
+# graph.butterworth_smooth operator to a list of fcurves with one keyframe
+# per frame. The filter_order is the operator one (number of biquads).
+# The fcurves with the same number of keyframes are filtered together with
+# one call on their stacked keyframe values
+def apply_butterworth_to_fcurves(fcurves: list,
+                                 cutoff: float,
+                                 fs: float,
+                                 filter_order: int=4,
+                                 blend_in_out: int=1,
+                                 blend: float=1.0) -> None:
+
+    # Group the fcurves by their number of keyframes
+    fcurve_groups = {}
+    for fcurve in fcurves:
+        keyframe_points = read_keyframe_points(fcurve)
+        if len(keyframe_points) == 0:
+            continue
+        fcurve_groups.setdefault(len(keyframe_points), []).append((fcurve, keyframe_points))
+
+    sos = get_blender_butterworth_sos(filter_order, cutoff, fs)
+
+    for fcurve_group in fcurve_groups.values():
+        # Stack the keyframe values in a (channels, frames) matrix
+        channels = np.stack([keyframe_points[:, 1] for _, keyframe_points in fcurve_group])
+
+        filtered_channels = smooth_channels_blender(channels, sos, blend_in_out, blend)
+
+        # Write back the filtered values
+        for (fcurve, keyframe_points), filtered_values in zip(fcurve_group, filtered_channels):
+            write_keyframe_values(fcurve, keyframe_points, filtered_values)
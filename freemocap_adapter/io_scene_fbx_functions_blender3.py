@@ -1,6 +1,7 @@
 import bpy
 import os
 import addon_utils
+import numpy as np
 from importlib.machinery import SourceFileLoader
 
 # Load the io_scene_fbx addon
@@ -52,6 +53,8 @@ convert_rad_to_deg_iter = units_convertor_iter("radian", "degree")
 
 from io_scene_fbx.export_fbx_bin import fbx_data_element_custom_properties
 
+from .fbx_animation_sampling import sample_objects_transforms
+
 SCALE_FACTOR = 100
 
 def fbx_animations_do_blender3(scene_data, ref_id, f_start, f_end, start_zero, objects=None, force_keep=False):
@@ -114,8 +117,37 @@ def fbx_animations_do_blender3(scene_data, ref_id, f_start, f_end, start_zero, o
         acnode = AnimationCurveNodeWrapper(cam_key, 'CAMERA_FOCAL', force_key, force_sek, (cam.lens,))
         animdata_cameras[cam_key] = (acnode, cam)
 
+    # Read the objects values of all the frames from their fcurves if none of
+    # them needs the scene frames evaluation
+    sampled_values = None
+    if not animdata_shapes and not animdata_cameras:
+        sampled_values = sample_objects_transforms(scene_data,
+                                                   animdata_ob,
+                                                   p_rots,
+                                                   np.arange(f_start, np.nextafter(f_end, np.inf), step=bake_step))
+
+    if sampled_values is not None:
+        for frame_index, frame_values in enumerate(sampled_values):
+            currframe = f_start + frame_index * bake_step
+            real_currframe = currframe - f_start if start_zero else currframe
+
+            for ob_index, (ob_obj, (anim_loc, anim_rot, anim_scale)) in enumerate(animdata_ob.items()):
+                location_multiple = 100
+                scale_factor = 1
+
+                # if this curve is the object root then keep its scale at 1
+                if len(str(ob_obj).split('|')) == 1:
+                    location_multiple = 1
+                    scale_factor = SCALE_FACTOR
+
+                loc, rot, scale = frame_values[ob_index * 9:(ob_index + 1) * 9].reshape(3, 3)
+
+                anim_loc.add_keyframe(real_currframe, (loc * location_multiple).tolist())
+                anim_rot.add_keyframe(real_currframe, np.rad2deg(rot).tolist())
+                anim_scale.add_keyframe(real_currframe, (scale / scale_factor).tolist())
+
     currframe = f_start
-    while currframe <= f_end:
+    while sampled_values is None and currframe <= f_end:
         real_currframe = currframe - f_start if start_zero else currframe
         scene.frame_set(int(currframe), subframe=currframe - int(currframe))
 
@@ -56,6 +56,8 @@ convert_rad_to_deg_iter = units_convertor_iter("radian", "degree")
 
 from io_scene_fbx.export_fbx_bin import fbx_data_element_custom_properties
 
+from .fbx_animation_sampling import sample_objects_transforms
+
 SCALE_FACTOR_Blender4 = 100
 
 def fbx_animations_do_blender4(scene_data, ref_id, f_start, f_end, start_zero, objects=None, force_keep=False):
@@ -182,7 +184,17 @@ def fbx_animations_do_blender4(scene_data, ref_id, f_start, f_end, start_zero, o
     num_camera_values = len(animdata_cameras) * 2  # Focal length (`.lens`) and focus distance
     num_values_per_frame = num_ob_values + num_shape_values + num_camera_values
     num_frames = len(real_currframes)
-    all_values_flat = np.fromiter(frame_values_gen(), dtype=float, count=num_frames * num_values_per_frame)
+
+    # Read the objects values of all the frames from their fcurves if none of
+    # them needs the scene frames evaluation
+    all_values_flat = None
+    if not animdata_shapes and not animdata_cameras and not has_animated_duplis:
+        sampled_values = sample_objects_transforms(scene_data, animdata_ob, p_rots, currframes)
+        if sampled_values is not None:
+            all_values_flat = sampled_values.ravel()
+
+    if all_values_flat is None:
+        all_values_flat = np.fromiter(frame_values_gen(), dtype=float, count=num_frames * num_values_per_frame)
 
     # Restore the scene's current frame.
     scene.frame_set(back_currframe, subframe=0.0)
@@ -0,0 +1,181 @@
+"""
+Contiguous storage for the marker empties positions of every animation frame.
+The positions are saved in a single (n_markers, n_frames, 3) float64 array
+with a name to row index, so the adapter methods can work on whole arrays
+instead of per frame Python lists.
+"""
+import warnings
+import numpy as np
+
+# Axis letters used by the dictionary style access of the positions
+AXES = {'x': 0, 'y': 1, 'z': 2}
+
+
+class MarkerPositionsView:
+    """
+    Backward compatible view of one marker of the store. Indexing it with
+    'x', 'y' or 'z' returns the (n_frames,) array of that axis, so code
+    written as empty_positions[empty]['x'][frame] keeps working.
+    """
+
+    def __init__(self, store, name: str):
+        self._store = store
+        self._name = name
+
+    def __getitem__(self, axis: str) -> np.ndarray:
+        return self._store.data[self._store.index[self._name], :, AXES[axis]]
+
+    def __setitem__(self, axis: str, values) -> None:
+        self._store.data[self._store.index[self._name], :, AXES[axis]] = values
+
+    def __iter__(self):
+        return iter(AXES)
+
+    def __len__(self) -> int:
+        return len(AXES)
+
+    def keys(self):
+        return AXES.keys()
+
+    def items(self):
+        return [(axis, self[axis]) for axis in AXES]
+
+
+class MarkerPositions:
+    """
+    Array backed replacement of the empty_positions dictionary of lists.
+    """
+
+    def __init__(self):
+        # Names of the markers in row order and the name to row index
+        self.names = []
+        self.index = {}
+        # Positions array with shape (n_markers, n_frames, 3)
+        self.data = np.empty((0, 0, 3), dtype=np.float64)
+        # Position reference ('local' or 'global') of the stored positions.
+        # An empty string means the store has to be completely updated
+        self.reference = ''
+        # Counter increased every time the markers rows change, so the
+        # cached row indices of the store can be checked
+        self.generation = 0
+        # Markers changed since the last update, with the first and last
+        # changed scene frame numbers
+        self.changed = {}
+
+    @property
+    def n_frames(self) -> int:
+        return self.data.shape[1]
+
+    def reset(self, names: list, n_frames: int) -> None:
+        # Allocate a new store for the markers filled with NaN
+        self.names = list(names)
+        self.index = {name: row for row, name in enumerate(self.names)}
+        self.generation += 1
+        self.data = np.full((len(self.names), n_frames, 3), np.nan, dtype=np.float64)
+
+    def add_markers(self, names: list, n_frames: int) -> None:
+        # The markers of the store share the number of frames. An empty
+        # store takes the number of frames of the first markers
+        if n_frames != self.n_frames:
+            if len(self.names) != 0:
+                raise ValueError('The store has ' + str(self.n_frames) + ' frames, not ' + str(n_frames)
+                                 + '. Reset it to change the number of frames')
+            self.data = np.empty((0, n_frames, 3), dtype=np.float64)
+
+        new_names = [name for name in dict.fromkeys(names) if name not in self.index]
+        if not new_names:
+            return
+
+        # Grow the store with NaN rows for the new markers
+        for name in new_names:
+            self.index[name] = len(self.names)
+            self.names.append(name)
+        self.generation += 1
+        self.data = np.concatenate(
+            (self.data,
+             np.full((len(new_names), n_frames, 3), np.nan, dtype=np.float64)),
+            axis=0)
+
+    def rows(self, names: list) -> np.ndarray:
+        # Get the row indices of a list of markers
+        return np.array([self.index[name] for name in names], dtype=np.intp)
+
+    def positions(self, name: str) -> np.ndarray:
+        # Get the (n_frames, 3) positions view of a marker
+        return self.data[self.index[name]]
+
+    def gather(self, names: list) -> np.ndarray:
+        # Get a (len(names), n_frames, 3) copy of the markers positions
+        return self.data[self.rows(names)]
+
+    def set_positions(self, name: str, positions: np.ndarray) -> None:
+        # Save the (n_frames, 3) positions of a marker, adding it if needed.
+        # Raises ValueError if the store has another number of frames
+        positions = np.asarray(positions, dtype=np.float64)
+        self.add_markers([name], positions.shape[0])
+        self.data[self.index[name]] = positions
+
+    def mark_changed(self, name: str, first_frame: int, last_frame: int=None) -> None:
+        # Save the interval of scene frame numbers (not store indices)
+        # changed on the marker animation. The refresh of the positions
+        # converts them to store indices subtracting the scene frame_start
+        if last_frame is None:
+            last_frame = first_frame
+        if name in self.changed:
+            first_frame = min(first_frame, self.changed[name][0])
+            last_frame = max(last_frame, self.changed[name][1])
+        self.changed[name] = (first_frame, last_frame)
+
+    def pop_changed(self) -> dict:
+        # Get the changed markers and reset the changes record
+        changed = self.changed
+        self.changed = {}
+        return changed
+
+    def invalidate(self) -> None:
+        # Force a complete update on the next refresh
+        self.reference = ''
+        self.changed = {}
+
+    def keys(self) -> list:
+        return list(self.names)
+
+    def clear(self) -> None:
+        self.reset([], 0)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index
+
+    def __iter__(self):
+        return iter(list(self.names))
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __getitem__(self, name: str) -> MarkerPositionsView:
+        if name not in self.index:
+            raise KeyError(name)
+        return MarkerPositionsView(self, name)
+
+    def __setitem__(self, name: str, value) -> None:
+        # Accept the legacy {'x': [...], 'y': [...], 'z': [...]} format
+        if isinstance(value, dict):
+            value = np.column_stack([np.asarray(value[axis], dtype=np.float64)
+                                     for axis in AXES])
+        self.set_positions(name, value)
+
+
+# Function to calculate the median and standard deviation of each row of a
+# (n_bones, n_frames) lengths array, excluding the NaN lengths (produced by
+# an empty with NaN values as position)
+def calculate_length_statistics(lengths: np.ndarray) -> tuple:
+    with warnings.catch_warnings():
+        # All NaN rows or rows with only one length result in NaN values
+        warnings.simplefilter('ignore', RuntimeWarning)
+        medians = np.nanmedian(lengths, axis=1)
+        stdevs = np.nanstd(lengths, axis=1, ddof=1)
+
+    # If the median is NaN the stdev is NaN too
+    stdevs[np.isnan(medians)] = np.nan
+
+    return medians, stdevs
@@ -0,0 +1,402 @@
+"""
+Analytic retargeting of a baked source armature animation to a target
+armature. Instead of adding COPY_ROTATION and COPY_LOCATION constraints to
+the target bones, matching the source bone rolls in edit mode and baking
+the constraints with bpy.ops.nla.bake, the source bone pose matrices are
+computed for all the frames from the source fcurves, converted with the
+precomputed rest pose and roll corrections of the bone mapping, and the
+target bone transforms are written as keyframes in bulk.
+"""
+import bpy
+import numpy as np
+
+from .fcurve_functions import is_static, read_fcurve_values
+from .rig_baking import (
+    get_euler_candidates,
+    get_offset_matrix,
+    get_ordered_pose_bones,
+    has_default_inheritance,
+    has_default_transform,
+    split_rotation_scale,
+    write_pose_keyframes,
+)
+
+
+# Source bone whose location is also copied to the target armature
+ROOT_SOURCE_BONE = 'pelvis'
+
+
+# Function to check if the pose of a source armature is fully defined by its
+# bone fcurves, so it can be read without evaluating the depsgraph
+def is_source_readable(rig: bpy.types.Object) -> bool:
+    if rig is None or rig.type != 'ARMATURE':
+        return False
+
+    if len(rig.constraints) != 0 or (rig.parent is not None and not is_static(rig.parent)):
+        return False
+
+    animation_data = rig.animation_data
+    if animation_data is None or animation_data.action is None:
+        return False
+
+    # Drivers, NLA strips and object fcurves would change the evaluated pose
+    if len(animation_data.drivers) != 0 or len(animation_data.nla_tracks) != 0:
+        return False
+    if any(not fcurve.data_path.startswith('pose.bones') for fcurve in animation_data.action.fcurves):
+        return False
+
+    for pose_bone in rig.pose.bones:
+        if not has_default_transform(pose_bone):
+            return False
+        if any(not constraint.mute for constraint in pose_bone.constraints):
+            return False
+
+    return True
+
+# Function to get the (n_frames, 10) location, rotation_quaternion and scale
+# channels of a pose bone from its fcurves. The channels without fcurves keep
+# the current pose bone value. The values are stored as float32 as the
+# keyframes and the pose bone properties are, so the conversion is exact
+def read_basis_channels(action: bpy.types.Action,
+                        pose_bone: bpy.types.PoseBone,
+                        frames: np.ndarray) -> np.ndarray:
+
+    channels = np.empty((len(frames), 10), dtype=np.float32)
+    channel_index = 0
+    for data_path, current_values in (('location', pose_bone.location),
+                                      ('rotation_quaternion', pose_bone.rotation_quaternion),
+                                      ('scale', pose_bone.scale)):
+        for index, current_value in enumerate(current_values):
+            fcurve = action.fcurves.find(pose_bone.path_from_id(data_path), index=index)
+            channels[:, channel_index] = current_value if fcurve is None else read_fcurve_values(fcurve, frames)
+            channel_index += 1
+
+    return channels
+
+# Function to get the (n_frames, 4, 4) basis matrices of a pose bone from its
+# (n_frames, 10) location, rotation_quaternion and scale channels
+def channels_to_basis_matrices(channels: np.ndarray) -> np.ndarray:
+    channels = channels.astype(np.float64)
+
+    # The quaternions are normalized before building the matrices
+    quaternions = channels[:, 3:7]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        quaternions = quaternions / np.linalg.norm(quaternions, axis=1)[:, np.newaxis]
+
+    matrices = np.zeros((len(channels), 4, 4), dtype=np.float64)
+    matrices[:, :3, :3] = quaternions_to_matrices(quaternions) * channels[:, np.newaxis, 7:10]
+    matrices[:, :3, 3] = channels[:, :3]
+    matrices[:, 3, 3] = 1
+
+    return matrices
+
+# Function to convert (n, 4) w, x, y, z unit quaternions to (n, 3, 3)
+# rotation matrices
+def quaternions_to_matrices(quaternions: np.ndarray) -> np.ndarray:
+    w, x, y, z = quaternions[:, 0], quaternions[:, 1], quaternions[:, 2], quaternions[:, 3]
+
+    return np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)], axis=-1),
+        np.stack([2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)], axis=-1),
+        np.stack([2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)], axis=-1),
+    ], axis=-2)
+
+# Function to read the animation of a source armature on the frames. Returns
+# a dictionary with the (n_frames, 10) basis channels and the rest data of
+# each pose bone, or None if the pose needs the depsgraph evaluation. The
+# result can be reused to retarget the same take to several target armatures
+def read_source_pose(source_rig: bpy.types.Object, frames: np.ndarray) -> dict:
+    if not is_source_readable(source_rig):
+        return None
+
+    action = source_rig.animation_data.action
+
+    # Name, parent name and rest offset matrix of the bones with the parents
+    # before their children
+    bones = []
+    basis_channels = {}
+    for pose_bone in get_ordered_pose_bones(source_rig):
+        bones.append((pose_bone.name,
+                      None if pose_bone.parent is None else pose_bone.parent.name,
+                      get_offset_matrix(pose_bone.bone)))
+        basis_channels[pose_bone.name] = read_basis_channels(action, pose_bone, frames)
+
+    return {'frames': frames,
+            'world_matrix': np.array(source_rig.matrix_world),
+            'bones': bones,
+            'channels': basis_channels}
+
+# Function to calculate the (n_frames, 4, 4) pose matrices of the source
+# bones as they are after giving them the rolls of their target bones. The
+# roll correction of a bone rotates its rest matrix around its Y axis, so
+# the rest offset of the bone gets the correction on the right and the
+# inverse correction of its parent on the left
+def get_corrected_source_pose(source_pose: dict, roll_corrections: dict) -> dict:
+    identity = np.identity(4)
+
+    pose_matrices = {}
+    for name, parent_name, offset_matrix in source_pose['bones']:
+        offset_matrix = offset_matrix @ roll_corrections.get(name, identity)
+        if parent_name is not None:
+            offset_matrix = np.linalg.inv(roll_corrections.get(parent_name, identity)) @ offset_matrix
+            offset_matrix = pose_matrices[parent_name] @ offset_matrix
+        pose_matrices[name] = offset_matrix @ channels_to_basis_matrices(source_pose['channels'][name])
+
+    return pose_matrices
+
+# Function to get the roll of a bone from its armature space rest matrix, as
+# the edit bone roll is defined: the rotation around the bone Y axis from the
+# zero roll orientation of the bone direction
+def get_bone_roll(bone: bpy.types.Bone) -> float:
+    rest_matrix = np.array(bone.matrix_local)[:3, :3]
+    direction = np.array(bone.tail_local) - np.array(bone.head_local)
+    direction = direction / np.linalg.norm(direction)
+    x, y, z = direction
+
+    # Zero roll matrix of the bone direction
+    theta = 1 + y
+    theta_alt = x * x + z * z
+    if theta > 6.1e-3 or theta_alt > 2.5e-4 ** 2:
+        if theta <= 6.1e-3:
+            theta = theta_alt * 0.5 + theta_alt * theta_alt * 0.125
+        zero_roll_matrix = np.array([[1 - x * x / theta, x, -x * z / theta],
+                                     [-x, y, -z],
+                                     [-x * z / theta, z, 1 - z * z / theta]])
+    else:
+        zero_roll_matrix = np.diag([-1.0, -1.0, 1.0])
+
+    roll_matrix = zero_roll_matrix.T @ rest_matrix
+
+    return float(np.arctan2(roll_matrix[0, 2], roll_matrix[2, 2]))
+
+# Function to get the 4x4 matrix of a rotation around the Y axis
+def get_y_rotation_matrix(angle: float) -> np.ndarray:
+    cos = np.cos(angle)
+    sin = np.sin(angle)
+
+    return np.array([[cos, 0, sin, 0],
+                     [0, 1, 0, 0],
+                     [-sin, 0, cos, 0],
+                     [0, 0, 0, 1]])
+
+# Function to get the roll of every bone of an armature
+def get_bone_rolls(rig: bpy.types.Object) -> dict:
+    return {bone.name: get_bone_roll(bone) for bone in rig.data.bones}
+
+# Function to get the retargeting mapping of the target armature bones: the
+# source bone of each mapped target bone and the roll correction matrix that
+# gives the source bone the roll of its target bone. Returns None if a mapped
+# bone can't be retargeted analytically
+def get_retarget_mapping(source_bone_rolls: dict,
+                         target_bone_rolls: dict,
+                         inv_bone_name_map: dict) -> dict:
+
+    # Roll corrections of the source bones. If several target bones map to
+    # the same source bone the last one sets the roll
+    roll_corrections = {}
+    for target_bone, source_bone in inv_bone_name_map.items():
+        if target_bone == 'null' or target_bone not in target_bone_rolls:
+            continue
+        if source_bone not in source_bone_rolls:
+            return None
+        roll_corrections[source_bone] = get_y_rotation_matrix(
+            target_bone_rolls[target_bone] - source_bone_rolls[source_bone])
+
+    return {'bones': {target_bone: source_bone
+                      for target_bone, source_bone in inv_bone_name_map.items()
+                      if target_bone in target_bone_rolls},
+            'roll_corrections': roll_corrections}
+
+
+class BoneMapResolver:
+    """
+    Cache of the bone_name_map armature detected for each armature datablock
+    and of its rest pose data, so retargeting many clips to the same
+    armature resolves the map once. The cached data of an armature is
+    rebuilt when its bone names or rest matrices change.
+    """
+
+    def __init__(self, bone_name_map: dict):
+        self.bone_name_map = bone_name_map
+        # Detected map name of each set of bone names
+        self._map_names = {}
+        # Fingerprint and resolution of each armature datablock
+        self._armatures = {}
+
+    def fingerprint(self, armature: bpy.types.Armature) -> tuple:
+        # Get the bone names and rest matrices of an armature datablock
+        bones = armature.bones
+        rest_data = np.empty(len(bones) * 22, dtype=np.float32)
+        bones.foreach_get('matrix_local', rest_data[:len(bones) * 16])
+        bones.foreach_get('head_local', rest_data[len(bones) * 16:len(bones) * 19])
+        bones.foreach_get('tail_local', rest_data[len(bones) * 19:])
+
+        return tuple(bone.name for bone in bones), rest_data.tobytes()
+
+    def map_name(self, bone_names: tuple) -> str:
+        # Get the bone_name_map armature with the most bones of the set of
+        # bone names. The first armature wins the ties
+        key = frozenset(bone_names)
+        if key not in self._map_names:
+            max_bone_count = 0
+            map_name = ''
+            for armature in self.bone_name_map:
+                count = sum(bone in key for bone in set(self.bone_name_map[armature].values()))
+                if count > max_bone_count:
+                    max_bone_count = count
+                    map_name = armature
+            self._map_names[key] = map_name
+
+        return self._map_names[key]
+
+    def resolve(self, rig: bpy.types.Object) -> dict:
+        # Get the detected map name, the bone name map and its inverse, and
+        # the bone rolls of an armature object
+        armature = rig.data
+        fingerprint = self.fingerprint(armature)
+        key = armature.as_pointer()
+
+        if key not in self._armatures or self._armatures[key][0] != fingerprint:
+            map_name = self.map_name(fingerprint[0])
+            bone_map = self.bone_name_map.get(map_name, {})
+            self._armatures[key] = (fingerprint, {
+                'map_name': map_name,
+                'bone_map': bone_map,
+                'inv_bone_name_map': {target_bone: source_bone for source_bone, target_bone in bone_map.items()},
+                'bone_rolls': get_bone_rolls(rig),
+            })
+
+        return self._armatures[key][1]
+
+    def invalidate(self) -> None:
+        # Clear all the cached armatures
+        self._map_names = {}
+        self._armatures = {}
+
+# Function to convert (n, 3, 3) normalized rotation matrices to XYZ eulers,
+# choosing the decomposition with the smallest angles
+def matrices_to_eulers(matrices: np.ndarray) -> np.ndarray:
+    eulers_1, eulers_2 = get_euler_candidates(matrices)
+    use_second = np.abs(eulers_1).sum(axis=1) > np.abs(eulers_2).sum(axis=1)
+
+    return np.where(use_second[:, np.newaxis], eulers_2, eulers_1)
+
+# Function to convert (n, 3, 3) normalized rotation matrices to XYZ eulers,
+# choosing the decomposition closest to the reference eulers
+def matrices_to_compatible_eulers(matrices: np.ndarray, reference_eulers: np.ndarray) -> np.ndarray:
+    eulers_1, eulers_2 = get_euler_candidates(matrices)
+
+    # Wrap each candidate to the turn closest to the reference
+    eulers_1 = eulers_1 - np.round((eulers_1 - reference_eulers) / (2 * np.pi)) * 2 * np.pi
+    eulers_2 = eulers_2 - np.round((eulers_2 - reference_eulers) / (2 * np.pi)) * 2 * np.pi
+
+    use_second = np.abs(eulers_1 - reference_eulers).sum(axis=1) > np.abs(eulers_2 - reference_eulers).sum(axis=1)
+
+    return np.where(use_second[:, np.newaxis], eulers_2, eulers_1)
+
+# Function to convert (n, 3) XYZ eulers to (n, 3, 3) rotation matrices
+def eulers_to_matrices(eulers: np.ndarray) -> np.ndarray:
+    cos = np.cos(eulers)
+    sin = np.sin(eulers)
+    cx, cy, cz = cos[:, 0], cos[:, 1], cos[:, 2]
+    sx, sy, sz = sin[:, 0], sin[:, 1], sin[:, 2]
+
+    return np.stack([
+        np.stack([cy * cz, sy * sx * cz - cx * sz, sy * cx * cz + sx * sz], axis=-1),
+        np.stack([cy * sz, sy * sx * sz + cx * cz, sy * cx * sz - sx * cz], axis=-1),
+        np.stack([-sy, cy * sx, cy * cx], axis=-1),
+    ], axis=-2)
+
+# Function to calculate the (n_frames, 4, 4) pose matrices of the target
+# armature bones. Each mapped bone gets the world rotation of its roll
+# corrected source bone (the COPY_ROTATION replace constraint), and the
+# bone mapped to the source root bone also adds the source root location
+# and euler rotation (the COPY_LOCATION offset and COPY_ROTATION add
+# constraints)
+def evaluate_target_pose(target_rig: bpy.types.Object,
+                         mapping: dict,
+                         source_pose: dict) -> dict:
+
+    frame_count = len(source_pose['frames'])
+    source_world_matrix = source_pose['world_matrix']
+    source_pose_matrices = get_corrected_source_pose(source_pose, mapping['roll_corrections'])
+    target_world_matrix = np.array(target_rig.matrix_world)
+    target_world_matrix_inverse = np.linalg.inv(target_world_matrix)
+
+    pose_matrices = {}
+    for pose_bone in get_ordered_pose_bones(target_rig):
+        basis_matrix = get_offset_matrix(pose_bone.bone) @ np.array(pose_bone.matrix_basis)
+
+        # World matrices before the constraints
+        if pose_bone.parent is None:
+            matrices = np.broadcast_to(target_world_matrix @ basis_matrix, (frame_count, 4, 4)).copy()
+        else:
+            matrices = target_world_matrix @ pose_matrices[pose_bone.parent.name] @ basis_matrix
+
+        source_bone = mapping['bones'].get(pose_bone.name)
+        if source_bone is not None and source_bone in source_pose_matrices:
+            # World rotation of the source bone with the roll of the target bone
+            source_rotations, _ = split_rotation_scale(source_world_matrix @ source_pose_matrices[source_bone])
+
+            owner_rotations, owner_scales = split_rotation_scale(matrices)
+
+            if source_bone == ROOT_SOURCE_BONE:
+                matrices[:, :3, 3] += source_pose['channels'][source_bone][:, :3]
+                owner_eulers = matrices_to_eulers(owner_rotations)
+                source_eulers = matrices_to_compatible_eulers(source_rotations, owner_eulers)
+                source_rotations = eulers_to_matrices(source_eulers + owner_eulers)
+
+            matrices[:, :3, :3] = source_rotations * owner_scales[:, np.newaxis, :]
+
+        pose_matrices[pose_bone.name] = target_world_matrix_inverse @ matrices
+
+    return pose_matrices
+
+# Function to retarget the animation of a source armature to a target
+# armature on the frames interval, writing the target bone keyframes
+# directly. The inv_bone_name_map maps the target bone names to the source
+# bone names. A source_pose read with read_source_pose can be passed to
+# retarget the same take to several targets, and a BoneMapResolver to reuse
+# the cached bone rolls of the armatures. Returns False, without changing
+# the armatures, if the retargeting needs the constraints and the bake
+# operator
+def retarget_rig(source_rig: bpy.types.Object,
+                 target_rig: bpy.types.Object,
+                 inv_bone_name_map: dict,
+                 frame_start: int,
+                 frame_end: int,
+                 source_pose: dict=None,
+                 resolver: BoneMapResolver=None) -> bool:
+
+    # The target armature must be static, without constraints and with the
+    # default bone inheritance. The keyframes are written in the rotation
+    # mode of each target bone
+    if target_rig is None or target_rig.type != 'ARMATURE' or not is_static(target_rig):
+        return False
+    for pose_bone in target_rig.pose.bones:
+        if not has_default_inheritance(pose_bone) or len(pose_bone.constraints) != 0:
+            return False
+
+    frames = np.arange(frame_start, frame_end + 1)
+    if source_pose is None or not np.array_equal(source_pose['frames'], frames):
+        source_pose = read_source_pose(source_rig, frames)
+    if source_pose is None:
+        return False
+
+    # Get the bone rolls from the resolver cache if there is one
+    if resolver is None:
+        source_bone_rolls = get_bone_rolls(source_rig)
+        target_bone_rolls = get_bone_rolls(target_rig)
+    else:
+        source_bone_rolls = resolver.resolve(source_rig)['bone_rolls']
+        target_bone_rolls = resolver.resolve(target_rig)['bone_rolls']
+
+    mapping = get_retarget_mapping(source_bone_rolls, target_bone_rolls, inv_bone_name_map)
+    if mapping is None:
+        return False
+
+    pose_matrices = evaluate_target_pose(target_rig, mapping, source_pose)
+
+    write_pose_keyframes(target_rig, pose_matrices, frames)
+
+    return True
@@ -0,0 +1,498 @@
+"""
+Direct evaluation of the rig bone constraints to bake the rig animation.
+The COPY_LOCATION, DAMPED_TRACK and LOCKED_TRACK constraints of the pose
+bones are evaluated for all the frames at once from the target empties
+positions, and the visual transforms of the bones are written as keyframes
+in bulk. The result is the same as the one of bpy.ops.nla.bake with visual
+keying, without stepping through the scene frames.
+"""
+import bpy
+import numpy as np
+
+from .fcurve_functions import (
+    is_static,
+    read_world_positions,
+    write_fcurve_keyframes,
+)
+
+
+# Track axes in the order of the constraints track_axis enum
+TRACK_AXES = ['TRACK_X', 'TRACK_Y', 'TRACK_Z',
+              'TRACK_NEGATIVE_X', 'TRACK_NEGATIVE_Y', 'TRACK_NEGATIVE_Z']
+
+# Unit vector of each track axis
+TRACK_VECTORS = {
+    'TRACK_X': np.array([1.0, 0.0, 0.0]),
+    'TRACK_Y': np.array([0.0, 1.0, 0.0]),
+    'TRACK_Z': np.array([0.0, 0.0, 1.0]),
+    'TRACK_NEGATIVE_X': np.array([-1.0, 0.0, 0.0]),
+    'TRACK_NEGATIVE_Y': np.array([0.0, -1.0, 0.0]),
+    'TRACK_NEGATIVE_Z': np.array([0.0, 0.0, -1.0]),
+}
+
+# Column index of each LOCKED_TRACK lock axis
+LOCK_AXES = {'LOCK_X': 0, 'LOCK_Y': 1, 'LOCK_Z': 2}
+
+# Constraint types that can be evaluated directly
+SUPPORTED_CONSTRAINTS = ['COPY_LOCATION', 'DAMPED_TRACK', 'LOCKED_TRACK']
+
+
+# Function to check if a bone constraint can be evaluated directly. Only the
+# supported types with full influence, world spaces and an empty (not
+# armature) target are evaluated, so the other ones use the bake operator
+def is_constraint_supported(constraint: bpy.types.Constraint) -> bool:
+    if constraint.mute:
+        return True
+
+    if constraint.type not in SUPPORTED_CONSTRAINTS:
+        return False
+
+    if constraint.influence != 1.0 \
+            or constraint.owner_space != 'WORLD' \
+            or constraint.target_space != 'WORLD':
+        return False
+
+    if constraint.target is None or constraint.target.type == 'ARMATURE':
+        return False
+
+    if constraint.type == 'COPY_LOCATION':
+        if not (constraint.use_x and constraint.use_y and constraint.use_z) \
+                or constraint.invert_x or constraint.invert_y or constraint.invert_z \
+                or constraint.use_offset:
+            return False
+
+    return True
+
+# Function to check if the animation of a rig can be baked directly: a static
+# armature object without bone animation, default bone inheritance and only
+# supported constraints
+def can_bake_directly(rig: bpy.types.Object) -> bool:
+    if rig is None or rig.type != 'ARMATURE' or not is_static(rig):
+        return False
+
+    for pose_bone in rig.pose.bones:
+        if not has_default_inheritance(pose_bone):
+            return False
+
+        if not all(is_constraint_supported(constraint) for constraint in pose_bone.constraints):
+            return False
+
+    return True
+
+# Function to check if a pose bone uses the default inheritance of its parent
+# transform
+def has_default_inheritance(pose_bone: bpy.types.PoseBone) -> bool:
+    bone = pose_bone.bone
+
+    return bone.use_inherit_rotation \
+        and getattr(bone, 'inherit_scale', 'FULL') == 'FULL' \
+        and bone.use_local_location \
+        and not bone.use_relative_parent
+
+# Function to check if a pose bone uses the quaternion rotation mode and the
+# default inheritance of its parent transform
+def has_default_transform(pose_bone: bpy.types.PoseBone) -> bool:
+    return pose_bone.rotation_mode == 'QUATERNION' and has_default_inheritance(pose_bone)
+
+# Function to get the rest matrix of a bone relative to its parent (or to the
+# armature if it has no parent)
+def get_offset_matrix(bone: bpy.types.Bone) -> np.ndarray:
+    if bone.parent is None:
+        return np.array(bone.matrix_local)
+
+    return np.linalg.inv(np.array(bone.parent.matrix_local)) @ np.array(bone.matrix_local)
+
+# Function to get the pose bones of a rig with the parents before their children
+def get_ordered_pose_bones(rig: bpy.types.Object) -> list:
+    ordered_bones = []
+    added_bones = set()
+
+    for pose_bone in rig.pose.bones:
+        # Get the chain of the bone parents that are not added yet
+        chain = []
+        while pose_bone is not None and pose_bone.name not in added_bones:
+            chain.append(pose_bone)
+            pose_bone = pose_bone.parent
+
+        for chain_bone in reversed(chain):
+            ordered_bones.append(chain_bone)
+            added_bones.add(chain_bone.name)
+
+    return ordered_bones
+
+# Function to normalize a (n, 3) array of vectors. Also returns the vector
+# lengths. Zero vectors stay as zero vectors
+def normalize_rows(vectors: np.ndarray) -> tuple:
+    lengths = np.linalg.norm(vectors, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        normalized = np.where(lengths[:, np.newaxis] > 0, vectors / lengths[:, np.newaxis], 0.0)
+
+    return normalized, lengths
+
+# Function to apply a DAMPED_TRACK constraint to (n, 4, 4) world matrices.
+# As Blender does, the owner is rotated by the shortest rotation that points
+# its track axis to the target, keeping the owner location
+def apply_damped_track(matrices: np.ndarray,
+                       target_positions: np.ndarray,
+                       track_axis: str) -> np.ndarray:
+
+    target_vectors, target_lengths = normalize_rows(target_positions - matrices[:, :3, 3])
+
+    track_vector = TRACK_VECTORS[track_axis]
+    owner_vectors, owner_lengths = normalize_rows(matrices[:, :3, :3] @ track_vector)
+    owner_vectors[owner_lengths == 0] = track_vector
+
+    rotation_axes = np.cross(owner_vectors, target_vectors)
+    rotation_angles = np.arccos(np.clip(np.einsum('ij,ij->i', owner_vectors, target_vectors), -1, 1))
+    rotation_axes, axes_lengths = normalize_rows(rotation_axes)
+
+    # Near 0 and pi the arcsin has better precision than the arccos
+    near_parallel = (axes_lengths >= np.finfo(np.float32).eps) & (axes_lengths < 0.1)
+    arcsin = np.arcsin(np.minimum(axes_lengths, 1))
+    rotation_angles[near_parallel] = np.where(rotation_angles[near_parallel] > np.pi / 2,
+                                              np.pi - arcsin[near_parallel],
+                                              arcsin[near_parallel])
+
+    # Opposite vectors are rotated by pi around the next local axis
+    apply_rotation = (target_lengths != 0) & (axes_lengths >= np.finfo(np.float32).eps)
+    opposite = (target_lengths != 0) \
+        & (axes_lengths < np.finfo(np.float32).eps) \
+        & (rotation_angles >= np.pi - 0.01)
+    if np.any(opposite):
+        next_axis = TRACK_VECTORS[TRACK_AXES[(TRACK_AXES.index(track_axis) + 1) % 6]]
+        opposite_axes, opposite_lengths = normalize_rows(
+            np.cross(owner_vectors[opposite], matrices[opposite, :3, :3] @ next_axis))
+        rotation_axes[opposite] = opposite_axes
+        rotation_angles[opposite] = np.pi
+        apply_rotation[np.flatnonzero(opposite)[opposite_lengths != 0]] = True
+
+    # Rodrigues rotation matrices of the axis-angle rotations
+    x, y, z = rotation_axes[:, 0], rotation_axes[:, 1], rotation_axes[:, 2]
+    cos = np.cos(rotation_angles)
+    sin = np.sin(rotation_angles)
+    one_minus_cos = 1 - cos
+    rotation_matrices = np.stack([
+        np.stack([cos + x * x * one_minus_cos, x * y * one_minus_cos - z * sin, x * z * one_minus_cos + y * sin], axis=-1),
+        np.stack([y * x * one_minus_cos + z * sin, cos + y * y * one_minus_cos, y * z * one_minus_cos - x * sin], axis=-1),
+        np.stack([z * x * one_minus_cos - y * sin, z * y * one_minus_cos + x * sin, cos + z * z * one_minus_cos], axis=-1),
+    ], axis=-2)
+
+    result = matrices.copy()
+    result[apply_rotation, :3, :3] = rotation_matrices[apply_rotation] @ matrices[apply_rotation, :3, :3]
+
+    return result
+
+# Function to apply a LOCKED_TRACK constraint to (n, 4, 4) world matrices.
+# As Blender does, the lock axis is kept and the track axis is pointed to the
+# projection of the target on the plane perpendicular to the lock axis
+def apply_locked_track(matrices: np.ndarray,
+                       target_positions: np.ndarray,
+                       track_axis: str,
+                       lock_axis: str) -> np.ndarray:
+
+    lock_index = LOCK_AXES[lock_axis]
+    track_index = TRACK_AXES.index(track_axis) % 3
+    # Tracking the locked axis leaves the owner unchanged
+    if lock_index == track_index:
+        return matrices.copy()
+
+    target_vectors = target_positions - matrices[:, :3, 3]
+    lock_vectors, _ = normalize_rows(matrices[:, :3, lock_index])
+
+    # Perpendicular part of the target vector to the lock axis
+    raw_lock_vectors = matrices[:, :3, lock_index]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        projections = raw_lock_vectors \
+            * (np.einsum('ij,ij->i', target_vectors, raw_lock_vectors)
+               / np.einsum('ij,ij->i', raw_lock_vectors, raw_lock_vectors))[:, np.newaxis]
+    track_vectors, _ = normalize_rows(target_vectors - projections)
+    if track_axis.startswith('TRACK_NEGATIVE'):
+        track_vectors = -track_vectors
+
+    # The third axis completes a right handed basis
+    third_index = 3 - lock_index - track_index
+    axes = {lock_index: lock_vectors, track_index: track_vectors}
+    axes[third_index] = np.cross(axes[(third_index + 1) % 3], axes[(third_index + 2) % 3])
+    track_matrices = np.stack([axes[0], axes[1], axes[2]], axis=-1)
+
+    # Rotate the owner from its current orientation to the tracking one
+    current_matrices = matrices[:, :3, :3]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        normalized_matrices = current_matrices / np.linalg.norm(current_matrices, axis=1)[:, np.newaxis, :]
+    rotation_matrices = track_matrices @ np.linalg.inv(normalized_matrices)
+
+    # Degenerate tracking bases leave the owner unchanged
+    valid = np.abs(np.linalg.det(rotation_matrices)) > 0
+
+    result = matrices.copy()
+    result[valid, :3, :3] = rotation_matrices[valid] @ current_matrices[valid]
+
+    return result
+
+# Function to calculate the (n_frames, 4, 4) pose space matrix of each pose
+# bone after evaluating its constraints. The target_positions dictionary has
+# the (n_frames, 3) world positions of the constraint targets
+def evaluate_pose_matrices(rig: bpy.types.Object,
+                           target_positions: dict,
+                           frame_count: int) -> dict:
+
+    rig_matrix = np.array(rig.matrix_world)
+    rig_matrix_inverse = np.linalg.inv(rig_matrix)
+
+    pose_matrices = {}
+    for pose_bone in get_ordered_pose_bones(rig):
+        basis_matrix = get_offset_matrix(pose_bone.bone) @ np.array(pose_bone.matrix_basis)
+
+        # Pose matrix before the constraints
+        if pose_bone.parent is None:
+            matrices = np.broadcast_to(basis_matrix, (frame_count, 4, 4))
+        else:
+            matrices = pose_matrices[pose_bone.parent.name] @ basis_matrix
+
+        # Evaluate the constraints in world space
+        matrices = rig_matrix @ matrices
+        for constraint in pose_bone.constraints:
+            if constraint.mute:
+                continue
+
+            positions = target_positions[constraint.target.name]
+            if constraint.type == 'COPY_LOCATION':
+                matrices = matrices.copy()
+                matrices[:, :3, 3] = positions
+            elif constraint.type == 'DAMPED_TRACK':
+                matrices = apply_damped_track(matrices, positions, constraint.track_axis)
+            elif constraint.type == 'LOCKED_TRACK':
+                matrices = apply_locked_track(matrices, positions, constraint.track_axis, constraint.lock_axis)
+
+        pose_matrices[pose_bone.name] = rig_matrix_inverse @ matrices
+
+    return pose_matrices
+
+# Function to convert (n, 3, 3) rotation matrices to (n, 4) w, x, y, z
+# quaternions with a non negative w
+def matrices_to_quaternions(matrices: np.ndarray) -> np.ndarray:
+    m = matrices
+    trace = m[:, 0, 0] + m[:, 1, 1] + m[:, 2, 2]
+
+    # Get each quaternion from its largest component for numerical stability
+    candidates = np.stack([
+        np.stack([1 + trace, m[:, 2, 1] - m[:, 1, 2], m[:, 0, 2] - m[:, 2, 0], m[:, 1, 0] - m[:, 0, 1]], axis=-1),
+        np.stack([m[:, 2, 1] - m[:, 1, 2], 1 + m[:, 0, 0] - m[:, 1, 1] - m[:, 2, 2], m[:, 0, 1] + m[:, 1, 0], m[:, 0, 2] + m[:, 2, 0]], axis=-1),
+        np.stack([m[:, 0, 2] - m[:, 2, 0], m[:, 0, 1] + m[:, 1, 0], 1 - m[:, 0, 0] + m[:, 1, 1] - m[:, 2, 2], m[:, 1, 2] + m[:, 2, 1]], axis=-1),
+        np.stack([m[:, 1, 0] - m[:, 0, 1], m[:, 0, 2] + m[:, 2, 0], m[:, 1, 2] + m[:, 2, 1], 1 - m[:, 0, 0] - m[:, 1, 1] + m[:, 2, 2]], axis=-1),
+    ], axis=1)
+    diagonals = np.stack([trace, 2 * m[:, 0, 0] - trace, 2 * m[:, 1, 1] - trace, 2 * m[:, 2, 2] - trace], axis=-1)
+    quaternions = candidates[np.arange(len(m)), np.argmax(diagonals, axis=1)]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        quaternions = quaternions / np.linalg.norm(quaternions, axis=1)[:, np.newaxis]
+    quaternions[quaternions[:, 0] < 0] *= -1
+
+    return quaternions
+
+# Function to flip the sign of the quaternions that are in the opposite
+# hemisphere of the previous frame one, as the make_compatible calls of the
+# bake operator do, so the quaternion curves have no jumps
+def make_quaternions_compatible(quaternions: np.ndarray) -> np.ndarray:
+    dots = np.einsum('ij,ij->i', quaternions[1:], quaternions[:-1])
+    flips = np.concatenate(([False], dots < 0))
+    signs = np.where(np.logical_xor.accumulate(flips), -1.0, 1.0)
+
+    return quaternions * signs[:, np.newaxis]
+
+# Function to convert (n, 4) w, x, y, z quaternions with a non negative w to
+# (n, 4) angle, x, y, z axis angle rotations, as quat_to_axis_angle does
+def quaternions_to_axis_angles(quaternions: np.ndarray) -> np.ndarray:
+    half_angles = np.arccos(np.clip(quaternions[:, 0], -1.0, 1.0))
+    sines = np.sin(half_angles)
+    sines[np.abs(sines) < 0.0005] = 1.0
+
+    axes = quaternions[:, 1:] / sines[:, np.newaxis]
+    # The rotations without angle get the Y axis
+    axes[~axes.any(axis=1), 1] = 1.0
+
+    return np.column_stack((2 * half_angles, axes))
+
+# Function to get the two euler decompositions of (n, 3, 3) normalized
+# rotation matrices in the rotation order, as mat3_normalized_to_eulO2 does
+def get_euler_candidates(matrices: np.ndarray, order: str='XYZ') -> tuple:
+    i, j, k = ['XYZ'.index(axis) for axis in order]
+    cy = np.hypot(matrices[:, i, i], matrices[:, j, i])
+    regular = cy > 16 * np.finfo(np.float32).eps
+
+    eulers_1 = np.empty((len(matrices), 3))
+    eulers_1[:, i] = np.where(regular,
+                              np.arctan2(matrices[:, k, j], matrices[:, k, k]),
+                              np.arctan2(-matrices[:, j, k], matrices[:, j, j]))
+    eulers_1[:, j] = np.arctan2(-matrices[:, k, i], cy)
+    eulers_1[:, k] = np.where(regular, np.arctan2(matrices[:, j, i], matrices[:, i, i]), 0.0)
+
+    eulers_2 = np.empty((len(matrices), 3))
+    eulers_2[:, i] = np.arctan2(-matrices[:, k, j], -matrices[:, k, k])
+    eulers_2[:, j] = np.arctan2(-matrices[:, k, i], -cy)
+    eulers_2[:, k] = np.arctan2(-matrices[:, j, i], -matrices[:, i, i])
+    eulers_2 = np.where(regular[:, np.newaxis], eulers_2, eulers_1)
+
+    # The odd permutations of the axes rotate the other way
+    if order not in ('XYZ', 'YZX', 'ZXY'):
+        eulers_1 = -eulers_1
+        eulers_2 = -eulers_2
+
+    return eulers_1, eulers_2
+
+# Function to make (n, 3) eulers compatible with the previous (n, 3) eulers,
+# removing the full turns differences as Blender's compatible_eul does
+def make_eulers_compatible(eulers: np.ndarray, previous_eulers: np.ndarray) -> np.ndarray:
+    eulers = eulers.copy()
+    differences = eulers - previous_eulers
+
+    # Correct the differences of about 360 degrees first
+    turns = np.floor(np.abs(differences) / (2 * np.pi) + 0.5) * 2 * np.pi
+    eulers = np.where(differences > 5.1, eulers - turns,
+                      np.where(differences < -5.1, eulers + turns, eulers))
+    differences = eulers - previous_eulers
+
+    # Rotations larger than 180 degrees in one axis while the other axes are small
+    small = np.abs(differences) < 1.6
+    for axis in range(3):
+        large = (np.abs(differences[:, axis]) > 3.2) \
+            & small[:, (axis + 1) % 3] & small[:, (axis + 2) % 3]
+        eulers[large, axis] -= np.sign(differences[large, axis]) * 2 * np.pi
+
+    return eulers
+
+# Function to convert (n_objects, n_frames, 3, 3) normalized rotation
+# matrices to eulers in the rotation order, each frame compatible with the
+# previous one and the first one compatible with the initial eulers, as the
+# successive to_euler(order, compat) calls of the exporter and of the bake
+# operator do
+def matrices_to_euler_sequence(rotations: np.ndarray,
+                               initial_eulers: np.ndarray,
+                               order: str='XYZ') -> np.ndarray:
+    object_count, frame_count = rotations.shape[:2]
+    eulers_1, eulers_2 = get_euler_candidates(rotations.reshape(-1, 3, 3), order)
+    eulers_1 = eulers_1.reshape(object_count, frame_count, 3)
+    eulers_2 = eulers_2.reshape(object_count, frame_count, 3)
+
+    eulers = np.empty((object_count, frame_count, 3), dtype=np.float64)
+    previous_eulers = initial_eulers
+    for frame_index in range(frame_count):
+        candidate_1 = make_eulers_compatible(eulers_1[:, frame_index], previous_eulers)
+        candidate_2 = make_eulers_compatible(eulers_2[:, frame_index], previous_eulers)
+
+        # Keep the candidate with the lowest difference
+        use_second = np.abs(candidate_1 - previous_eulers).sum(axis=1) \
+            > np.abs(candidate_2 - previous_eulers).sum(axis=1)
+        previous_eulers = np.where(use_second[:, np.newaxis], candidate_2, candidate_1)
+        eulers[:, frame_index] = previous_eulers
+
+    return eulers
+
+# Function to split (n, 4, 4) matrices into normalized rotation matrices and
+# scales. Negative matrices get a negative scale
+def split_rotation_scale(matrices: np.ndarray) -> tuple:
+    scales = np.linalg.norm(matrices[:, :3, :3], axis=1)
+    scales[np.linalg.det(matrices[:, :3, :3]) < 0] *= -1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rotations = matrices[:, :3, :3] / scales[:, np.newaxis, :]
+
+    return rotations, scales
+
+# Function to decompose the (n, 4, 4) local matrices of a pose bone into
+# location, quaternion rotation and scale arrays
+def decompose_matrices(matrices: np.ndarray) -> tuple:
+    rotations, scales = split_rotation_scale(matrices)
+    quaternions = make_quaternions_compatible(matrices_to_quaternions(rotations))
+
+    return matrices[:, :3, 3], quaternions, scales
+
+# Function to get the rotation data path and (n, n_channels) rotation values
+# of the (n, 4, 4) local matrices of a pose bone in its rotation mode, as the
+# bake operator keys them
+def get_rotation_channels(pose_bone: bpy.types.PoseBone,
+                          matrices: np.ndarray,
+                          quaternions: np.ndarray) -> tuple:
+
+    rotation_mode = pose_bone.rotation_mode
+    if rotation_mode == 'QUATERNION':
+        return 'rotation_quaternion', quaternions
+
+    rotations, _ = split_rotation_scale(matrices)
+
+    if rotation_mode == 'AXIS_ANGLE':
+        return 'rotation_axis_angle', quaternions_to_axis_angles(matrices_to_quaternions(rotations))
+
+    # The first frame gets the smallest angles and the next frames are
+    # compatible with the previous one
+    eulers_1, eulers_2 = get_euler_candidates(rotations[:1], rotation_mode)
+    initial_eulers = eulers_2 if np.abs(eulers_1).sum() > np.abs(eulers_2).sum() else eulers_1
+
+    return 'rotation_euler', matrices_to_euler_sequence(rotations[np.newaxis], initial_eulers, rotation_mode)[0]
+
+# Function to bake the animation of a rig on the frames interval evaluating
+# its constraints directly. Returns False, without changing the rig, if the
+# rig has constraints or settings that need the bake operator
+def bake_rig(rig: bpy.types.Object,
+             frame_start: int,
+             frame_end: int,
+             clear_constraints: bool=False) -> bool:
+
+    if not can_bake_directly(rig):
+        return False
+
+    frames = np.arange(frame_start, frame_end + 1)
+
+    # Read the positions of the constraint targets on all the frames
+    targets = list({constraint.target.name: constraint.target
+                    for pose_bone in rig.pose.bones
+                    for constraint in pose_bone.constraints
+                    if not constraint.mute}.values())
+    positions = read_world_positions(targets, frames)
+    if positions is None:
+        return False
+    target_positions = dict(zip([target.name for target in targets], positions))
+
+    pose_matrices = evaluate_pose_matrices(rig, target_positions, len(frames))
+
+    write_pose_keyframes(rig, pose_matrices, frames)
+
+    if clear_constraints:
+        for pose_bone in rig.pose.bones:
+            for constraint in list(pose_bone.constraints):
+                pose_bone.constraints.remove(constraint)
+
+    return True
+
+# Function to write the visual transforms of the (n_frames, 4, 4) pose space
+# matrices of the rig pose bones as keyframes on the frames. The keyframes
+# are written in a new action and in the rotation mode of each bone, as the
+# bake operator does
+def write_pose_keyframes(rig: bpy.types.Object,
+                         pose_matrices: dict,
+                         frames: np.ndarray) -> None:
+
+    if rig.animation_data is None:
+        rig.animation_data_create()
+    action = bpy.data.actions.new("Action")
+    rig.animation_data.action = action
+
+    for pose_bone in rig.pose.bones:
+        # Visual transform of the bone relative to its parent
+        parent_matrices = get_offset_matrix(pose_bone.bone)
+        if pose_bone.parent is not None:
+            parent_matrices = pose_matrices[pose_bone.parent.name] @ parent_matrices
+        local_matrices = np.linalg.inv(parent_matrices) @ pose_matrices[pose_bone.name]
+
+        locations, quaternions, scales = decompose_matrices(local_matrices)
+        rotation_path, rotations = get_rotation_channels(pose_bone, local_matrices, quaternions)
+
+        for data_path, values in (('location', locations),
+                                  (rotation_path, rotations),
+                                  ('scale', scales)):
+            for index in range(values.shape[1]):
+                write_fcurve_keyframes(action,
+                                       pose_bone.path_from_id(data_path),
+                                       index,
+                                       frames,
+                                       values[:, index],
+                                       group=pose_bone.name)